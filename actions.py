@@ -0,0 +1,255 @@
+# -*- coding:utf8 -*-
+"""Module that maps Dialogflow actions to their handlers
+
+Each action is declared once as an Action: which parameters it needs, which
+of them may come from the output contexts of earlier turns, the lookups it
+reads and the Check_Bill method that renders it.  dispatch() finds the
+Action with one dict lookup and runs the shared steps (validate, fill from
+contexts, build Check_Bill, render) for every action alike.
+
+A new intent is added by registering one more Action:
+
+    register(Action('pay_bill', 'get_pay_response', context_keys=('given-name',),
+                    kinds=('latest_bill',)))
+
+Actions listed in ACTION_CONCURRENCY run at most that many requests at
+once; the rest wait up to ACTION_QUEUE_TIMEOUT and are then answered busy,
+so one slow intent cannot hold every worker thread.
+
+The customer name is resolved against the name index (see names.py) before
+any lookup; a name that does not resolve with enough confidence is answered
+with a card of the closest names instead.
+"""
+
+import logging
+import threading
+
+import conversation
+import logs
+import metrics
+import names
+import render
+from get_response import Check_Bill, validate_params
+from config import ACTION_CONCURRENCY, ACTION_QUEUE_TIMEOUT
+
+log = logging.getLogger(__name__)
+
+UNKNOWN_TEXT = "Sorry, I can't help with that yet. You can check your bill, " \
+               "find a new plan, recharge or analyze your usage."
+MISSING_TEXT = "Sorry, who am I talking to? Please tell me your name."
+# What to ask for each missing required parameter; MISSING_TEXT otherwise
+PROMPTS = {
+    'plan': "Which plan would you like to switch to?",
+}
+BUSY_TEXT = "Sorry, I'm a little busy right now. Please ask me again in a moment."
+STALE_TEXT = "I couldn't reach your account just now, so this may be a little out of date."
+UNKNOWN_NAME_TEXT = "Sorry, I couldn't find an account for %s. Could you tell me your full name?"
+CHOOSE_NAME_TEXT = "I'm not sure I heard your name right."
+CHOOSE_NAME_TITLE = "Did you mean one of these?"
+UNAVAILABLE_TEXT = "Sorry, I can't reach your account right now. Please try again in a few minutes."
+
+
+class ActionBusy(Exception):
+    """Raised when an action is at its concurrency limit for too long"""
+
+
+class Action(object):
+    """How one Dialogflow action is fulfilled
+
+    Attributes:
+        name (str): the Dialogflow action
+        renderer (str): the Check_Bill method returning the fulfillmentMessages
+        required (tuple): parameters that must be present
+        context_keys (tuple): parameters taken from the output contexts
+            when the request's own parameters lack them
+        kinds (tuple): the Check_Bill lookups the renderer reads
+        read_only (bool): False when the action writes to the graph
+        slots (threading.BoundedSemaphore): the concurrency limit, or None
+    """
+
+    def __init__(self, name, renderer, required=('given-name',),
+                 context_keys=(), kinds=(), read_only=True, max_concurrent=None):
+        self.name = name
+        self.renderer = renderer
+        self.required = tuple(required)
+        self.context_keys = tuple(context_keys)
+        self.kinds = tuple(kinds)
+        self.read_only = read_only
+        if max_concurrent is None:
+            max_concurrent = ACTION_CONCURRENCY.get(name)
+        self.slots = threading.BoundedSemaphore(max_concurrent) if max_concurrent else None
+
+    def params(self, req, state=None):
+        """Takes a Dialogflow request and the conversation's state, if any
+
+        Returns the validated parameters for Check_Bill, the list of
+        required ones that are missing and the validation error, if any.
+        The customer resolved by an earlier turn is reused before the output
+        contexts are searched
+        """
+        parameters = req['queryResult'].get('parameters') or {}
+        logs.debug_payload('Dialogflow Parameters', parameters)
+        error, params = validate_params(parameters)
+        for key in self.context_keys:
+            if not params.get(key):
+                if key == 'given-name' and state is not None:
+                    params[key] = [state['name']]
+                else:
+                    params[key] = context_value(req, key)
+        logs.debug_payload(self.name + ' params', params)
+        missing = [key for key in self.required if not params.get(key)]
+        return params, missing, error
+
+    def fulfill(self, req, deadline=None):
+        """Takes a Dialogflow request and its Deadline
+
+        raises ActionBusy when the action stays at its concurrency limit
+        Returns the fulfillmentMessages for the request
+        """
+        session = req.get('session')
+        state = conversation.store().get_state(session) if session else None
+        params, missing, error = self.params(req, state)
+        if error:
+            return [Check_Bill.fb_text(error)]
+        if missing:
+            metrics.inc('webhook_missing_params_total', self.name)
+            return [Check_Bill.fb_text(PROMPTS.get(missing[0], MISSING_TEXT))]
+        if params.get('given-name') and (state is None
+                                         or state['name'] != params['given-name'][0]):
+            name, candidates = names.resolve(params['given-name'][0])
+            if name is None:
+                return self.choose_name(params['given-name'][0], candidates)
+            params['given-name'] = [name]
+        params['session'] = session
+        params['response_id'] = req.get('responseId')
+        params['deadline'] = deadline
+        if self.slots is None:
+            return self.render(params, state)
+        timeout = ACTION_QUEUE_TIMEOUT
+        if deadline is not None:
+            timeout = min(timeout, deadline.remaining())
+        if not self.slots.acquire(timeout=max(timeout, 0)):
+            raise ActionBusy(self.name)
+        try:
+            return self.render(params, state)
+        finally:
+            self.slots.release()
+
+    def choose_name(self, spoken, candidates):
+        """Returns the fulfillment for a name that did not resolve: a card
+        with the closest candidates, or a request for the full name
+        """
+        metrics.inc('webhook_unresolved_names_total', self.name)
+        if not candidates:
+            return [Check_Bill.fb_text(UNKNOWN_NAME_TEXT % spoken)]
+        return [Check_Bill.fb_text(CHOOSE_NAME_TEXT),
+                render.card(CHOOSE_NAME_TITLE, None,
+                            [(name, None) for name, _ in candidates])]
+
+    def render(self, params, state=None):
+        """Renders the action for params, starting from the lookups kept in
+        the conversation's state and saving any new ones back to it
+
+        A response built from stale lookups (see Check_Bill.stale) ends with
+        STALE_TEXT and is not saved to the conversation's state.  Lookups
+        kept for another billing period are not reused
+        """
+        checkbill = Check_Bill(params)
+        known = ()
+        if state is not None and state['name'] == checkbill.name:
+            known = state['results']
+            if state['period'] != checkbill.period:
+                known = conversation.period_free(known)
+            checkbill.preload(**known)
+        response = getattr(checkbill, self.renderer)()
+        logs.debug_payload('response', response)
+        if checkbill.stale:
+            return list(response) + [Check_Bill.fb_text(STALE_TEXT)]
+        if checkbill.session:
+            found = checkbill.fetched(conversation.CONVERSATION_KINDS)
+            if state is None or any(kind not in known for kind in found):
+                conversation.store().update_state(checkbill.session, checkbill.name,
+                                                  checkbill.period, found)
+        return response
+
+
+class UnknownAction(Action):
+    """The fallback for actions nobody registered: a short, valid answer
+    without touching the graph
+    """
+
+    def __init__(self):
+        Action.__init__(self, 'unknown', None, required=())
+
+    def fulfill(self, req, deadline=None):
+        metrics.inc('webhook_unknown_actions_total')
+        log.error('Unexpected action: %s', req['queryResult'].get('action'))
+        return [Check_Bill.fb_text(UNKNOWN_TEXT)]
+
+
+# Dialogflow action -> Action
+REGISTRY = {}
+UNKNOWN = UnknownAction()
+
+
+def register(action):
+    """Adds an Action to the registry, replacing any with the same name"""
+    REGISTRY[action.name] = action
+    return action
+
+
+def lookup(name):
+    """Returns the Action registered for name, or UNKNOWN"""
+    return REGISTRY.get(name, UNKNOWN)
+
+
+def dispatch(req, deadline=None):
+    """Takes a Dialogflow request and its Deadline
+
+    Returns the fulfillmentMessages of the request's action
+    """
+    return lookup(req['queryResult'].get('action')).fulfill(req, deadline)
+
+
+def busy_response(action):
+    """Counts a request turned away by the action's concurrency limit
+
+    Returns a short but valid fulfillment telling the user to try again
+    """
+    metrics.inc('webhook_busy_total', action)
+    return [Check_Bill.fb_text(BUSY_TEXT)]
+
+
+def unavailable_response(action):
+    """Counts a request that found neo4j down and nothing to serve stale
+
+    Returns a short but valid fulfillment telling the user to try later
+    """
+    metrics.inc('webhook_unavailable_total', action)
+    return [Check_Bill.fb_text(UNAVAILABLE_TEXT)]
+
+
+def context_value(req, key):
+    """Returns the first value of key in the request's output contexts"""
+    for context in req['queryResult'].get('outputContexts') or ():
+        value = (context.get('parameters') or {}).get(key)
+        if value:
+            return value
+    return None
+
+
+register(Action('check_bill', 'get_current_response',
+                kinds=('current_plan',)))
+register(Action('recommendation', 'get_recommendation_response',
+                context_keys=('given-name',),
+                kinds=('usage_history', 'plan_catalog', 'upgrade_path')))
+register(Action('recharge_exisiting_plan', 'get_recharge_response',
+                context_keys=('given-name',), kinds=('latest_bill',)))
+register(Action('analyze_usage', 'get_analyze_response',
+                context_keys=('given-name',), kinds=('usage_history',)))
+register(Action('confirm_recharge', 'get_confirm_recharge_response',
+                context_keys=('given-name',), kinds=('latest_bill',),
+                read_only=False))
+register(Action('change_plan', 'get_change_plan_response',
+                required=('given-name', 'plan'), context_keys=('given-name',),
+                kinds=('plan_catalog',), read_only=False))
@@ -0,0 +1,86 @@
+# -*- coding:utf8 -*-
+"""Module that computes usage statistics for the analyze_usage action
+
+Usage series are held as a 2-D array with one row per user and one column
+per month (shorter series are padded with NaN), so a single user and a batch
+of users go through the same vectorized code path.
+"""
+
+import numpy as np
+
+# Percentiles of monthly usage reported by summarize()
+PERCENTILES = (50, 90)
+
+
+def to_matrix(series):
+    """Takes a list of per-user monthly usage lists
+
+    Returns a float array of shape (users, longest series), padded with NaN
+    """
+    width = max([len(amounts) for amounts in series] + [1])
+    matrix = np.full((len(series), width), np.nan)
+    for row, amounts in enumerate(series):
+        matrix[row, :len(amounts)] = amounts
+    return matrix
+
+
+def summarize(usage, allowance):
+    """Takes a (users, months) usage array and a per-user allowance array
+
+    allowance may contain NaN for users whose plan has no known allowance.
+    Returns a dict of per-user arrays: months, average, peak, peak_index,
+    trend (least-squares slope per month), p50/p90 and the number of
+    months over the allowance, total and mean overage
+    """
+    usage = np.asarray(usage, dtype=float)
+    allowance = np.asarray(allowance, dtype=float).reshape(-1, 1)
+    present = ~np.isnan(usage)
+    months = present.sum(axis=1)
+    filled = np.where(present, usage, 0.0)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        average = filled.sum(axis=1) / months
+        peak_index = np.where(present, usage, -np.inf).argmax(axis=1)
+        peak = usage[np.arange(len(usage)), peak_index]
+
+        # slope of the least-squares line through (month index, usage)
+        x = np.where(present, np.arange(usage.shape[1]), 0.0)
+        x_mean = x.sum(axis=1) / months
+        dx = np.where(present, x - x_mean[:, None], 0.0)
+        dy = np.where(present, usage - average[:, None], 0.0)
+        trend = (dx * dy).sum(axis=1) / (dx * dx).sum(axis=1)
+
+        over = np.where(present, usage - allowance, np.nan)
+        over = np.where(over > 0, over, 0.0)
+        over_months = (over > 0).sum(axis=1)
+        overage = np.nansum(over, axis=1)
+
+    summary = {
+        'months': months,
+        'average': average,
+        'peak': peak,
+        'peak_index': peak_index,
+        'trend': np.nan_to_num(trend),
+        'over_months': over_months,
+        'overage': overage,
+        'mean_overage': np.where(over_months > 0,
+                                 overage / np.maximum(over_months, 1), 0.0),
+    }
+    empty = months == 0
+    values = np.nanpercentile(np.where(empty[:, None], 0.0, usage),
+                              PERCENTILES, axis=1)
+    values[:, empty] = np.nan
+    for percentile, value in zip(PERCENTILES, values):
+        summary['p%d' % percentile] = value
+    return summary
+
+
+def summarize_one(amounts, allowance):
+    """Summarizes a single user's usage series
+
+    Returns a dict of plain floats/ints with the keys of summarize()
+    """
+    if allowance is None:
+        allowance = np.nan
+    summary = summarize(to_matrix([amounts]), [allowance])
+    return dict((key, value[0].item()) for key, value in summary.items())
@@ -0,0 +1,234 @@
+# -*- coding:utf8 -*-
+"""Async entry point for the Dialogflow webhook
+
+Serves the same POST / contract as the Flask app in main.py as an ASGI
+application, e.g.
+
+    uvicorn asgi:app --host 0.0.0.0 --port 8000
+
+Each action runs as a coroutine.  The blocking neo4j work is offloaded to a
+bounded thread pool; when ASYNC_MAX_PENDING requests are already waiting for
+or running on it, new requests get a short "busy" fulfillment instead of
+queueing forever.  A request that runs out of time keeps its slot until its
+thread is done, so abandoned work is still counted.
+"""
+
+import asyncio
+import contextvars
+import json
+from concurrent.futures import ThreadPoolExecutor
+
+import actions
+import breaker
+import charts
+import driver
+import logs
+import main
+import metrics
+import profiling
+import render
+import warmup
+from graph import Deadline, DeadlineExceeded
+from config import (ASYNC_WORKER_THREADS, ASYNC_MAX_PENDING, ASYNC_QUEUE_TIMEOUT,
+                    WEBHOOK_BUDGET, WARMUP_ON_START, PROFILE_HEADER)
+
+executor = ThreadPoolExecutor(max_workers=ASYNC_WORKER_THREADS)
+_pending = None
+
+
+def _submit(function, *args):
+    """Starts a blocking function on the executor in a copy of the current
+    context, so its metrics land on the current request
+
+    Returns the asyncio future of its result
+    """
+    loop = asyncio.get_event_loop()
+    context = contextvars.copy_context()
+    return loop.run_in_executor(executor, context.run, function, *args)
+
+
+async def _offloaded(function, *args):
+    """Runs a blocking function on the executor (see _submit)"""
+    return await _submit(function, *args)
+
+
+def _release(future):
+    """Done-callback of offloaded webhook work: frees its admission slot
+    once the executor thread is really finished with it
+    """
+    _pending.release()
+    if not future.cancelled():
+        future.exception()  # retrieved, so an abandoned failure is not logged
+
+
+async def webhook(req, profile=False):
+    """Takes a parsed Dialogflow request and whether to profile it (see
+    profiling.py)
+
+    Returns the fulfillmentMessages for its action.  The coroutine stops
+    waiting once WEBHOOK_BUDGET runs out and answers with the deadline
+    fulfillment from main.py; the neo4j transaction timeout then ends the
+    offloaded query on the server side.
+    """
+    global _pending
+    if _pending is None:
+        _pending = asyncio.Semaphore(ASYNC_MAX_PENDING)
+    deadline = Deadline(WEBHOOK_BUDGET)
+
+    handler = actions.lookup(req.get('queryResult').get('action'))
+    action = handler.name
+    outcome = 'error'
+    current = None
+    try:
+        with metrics.request(action) as current:
+            res, outcome = await _serve(action, handler, req, deadline, profile)
+    finally:
+        logs.log_request(action, main.request_user(req), current.stages,
+                         outcome)
+    return res
+
+
+async def _serve(action, handler, req, deadline, profile=False):
+    """Runs the handler's Action for req within the admission limit and the
+    deadline
+
+    Returns the fulfillmentMessages and the outcome for the request log
+    """
+    try:
+        await asyncio.wait_for(_pending.acquire(),
+                               min(ASYNC_QUEUE_TIMEOUT, deadline.remaining()))
+    except asyncio.TimeoutError:
+        return actions.busy_response(action), 'busy'
+    try:
+        if profile:
+            work = _submit(profiling.profiled, action, handler.fulfill, req, deadline)
+        else:
+            work = _submit(handler.fulfill, req, deadline)
+    except BaseException:
+        _pending.release()
+        raise
+    # The slot stays taken until the thread is done, not just until the
+    # deadline: abandoned work still occupies an executor thread, and must
+    # keep counting against ASYNC_MAX_PENDING
+    work.add_done_callback(_release)
+    try:
+        res = await asyncio.wait_for(asyncio.shield(work), deadline.remaining())
+        return res, 'ok'
+    except actions.ActionBusy:
+        return actions.busy_response(action), 'busy'
+    except (asyncio.TimeoutError, DeadlineExceeded):
+        return main.deadline_response(action), 'deadline'
+    except breaker.UNAVAILABLE:
+        return actions.unavailable_response(action), 'unavailable'
+    except Exception:
+        metrics.inc('webhook_errors_total', action)
+        raise
+
+
+async def app(scope, receive, send):
+    """ASGI application serving the webhook on POST /"""
+    if scope['type'] == 'lifespan':
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                if WARMUP_ON_START and not await _offloaded(warmup.warm_up):
+                    warmup.start()
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                executor.shutdown(wait=False)
+                driver.close_driver()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    if scope['method'] == 'GET' and scope['path'] == '/ready':
+        await _respond(send, 200 if warmup.state.ready else 503,
+                       json.dumps(warmup.state.snapshot()).encode('utf8'),
+                       b'application/json')
+        return
+
+    if scope['method'] == 'GET' and scope['path'].startswith('/charts/') \
+            and scope['path'].endswith(charts.EXTENSION):
+        chart = scope['path'][len('/charts/'):-len(charts.EXTENSION)]
+        image = await _offloaded(charts.load, chart)
+        if image is None:
+            await _respond(send, 404, b'not found', b'text/plain')
+        else:
+            await _respond(send, 200, image, charts.CONTENT_TYPE.encode('ascii'))
+        return
+
+    if scope['method'] == 'GET' and scope['path'] == '/metrics':
+        await _respond(send, 200, main.prometheus_text().encode('utf8'),
+                       main.PROMETHEUS_CONTENT_TYPE.encode('ascii'))
+        return
+
+    if scope['method'] == 'GET' and scope['path'].startswith('/metrics/') \
+            and scope['path'][len('/metrics/'):] in main.METRICS_JSON:
+        counters = main.METRICS_JSON[scope['path'][len('/metrics/'):]]()
+        await _respond(send, 200, json.dumps(counters).encode('utf8'),
+                       b'application/json')
+        return
+
+    if scope['method'] == 'GET' and scope['path'].startswith('/admin/profiles'):
+        await _profiles(send, scope['path'], _header(scope, PROFILE_HEADER))
+        return
+
+    if scope['path'] != '/' or scope['method'] != 'POST':
+        await _respond(send, 404, b'not found', b'text/plain')
+        return
+
+    body = b''
+    more_body = True
+    while more_body:
+        message = await receive()
+        body += message.get('body', b'')
+        more_body = message.get('more_body', False)
+
+    try:
+        req = json.loads(body.decode('utf8'))
+        req.get('queryResult').get('action')
+    except (ValueError, AttributeError):
+        await _respond(send, 200, b'json error', b'text/html')
+        return
+
+    res = await webhook(req, profiling.requested(_header(scope, PROFILE_HEADER)))
+    await _respond(send, 200, render.fulfillment(res), b'application/json')
+
+
+def _header(scope, name):
+    """Returns the value of the request header name, or None"""
+    name = name.lower().encode('latin-1')
+    for key, value in scope.get('headers', ()):
+        if key.lower() == name:
+            return value.decode('latin-1')
+    return None
+
+
+async def _profiles(send, path, token):
+    """Serves the /admin/profiles routes of main.py"""
+    trace_id = path[len('/admin/profiles'):].strip('/')
+    if not profiling.authorized(token):
+        await _respond(send, 404, b'not found', b'text/plain')
+    elif not trace_id:
+        await _respond(send, 200, json.dumps(profiling.listing()).encode('utf8'),
+                       b'application/json')
+    else:
+        stats = trace_id.endswith('.prof')
+        trace_id = trace_id[:-len('.prof')] if stats else trace_id
+        trace = profiling.find(int(trace_id)) if trace_id.isdigit() else None
+        if trace is None:
+            await _respond(send, 404, b'not found', b'text/plain')
+        elif stats:
+            await _respond(send, 200, trace.stats, b'application/octet-stream')
+        else:
+            await _respond(send, 200, json.dumps(trace.to_dict(), default=str)
+                           .encode('utf8'), b'application/json')
+
+
+async def _respond(send, status, body, content_type):
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [(b'content-type', content_type),
+                    (b'content-length', str(len(body)).encode('ascii'))],
+    })
+    await send({'type': 'http.response.body', 'body': body})
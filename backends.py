@@ -0,0 +1,402 @@
+# -*- coding:utf8 -*-
+"""Module that defines the graph backends behind Check_Bill
+
+A backend answers the lookups the handlers need (current plans, upgrade
+path, bill for a month, usage series, plan catalog) and returns plain
+Python values, so Check_Bill does not depend on where the graph lives.
+
+    Neo4jBackend   runs Cypher on the pooled neo4j driver
+    MemoryBackend  serves an adjacency-indexed copy of the graph loaded from
+                   a snapshot file, without any network hop
+
+GRAPH_BACKEND in config.py picks the backend for per-user lookups and
+PLAN_BACKEND the one for the plan catalog, so the mostly static catalog can
+be served from memory while users stay in neo4j.  A snapshot is written
+with
+
+    python backends.py export plans.json --labels Plan Plans
+"""
+
+import argparse
+import json
+import math
+import threading
+from collections import defaultdict
+
+import graph
+import results
+from config import (GRAPH_BACKEND, PLAN_BACKEND, GRAPH_SNAPSHOT_FILE,
+                    USAGE_PROPERTY, PLAN_ALLOWANCE_PROPERTY)
+
+
+# The usage months m of the user u that have a usage amount.  Collecting
+# m.Month and the amounts over only these keeps the two lists in step, as
+# collect() skips the nulls toFloat() gives for a missing amount
+USAGE_MONTHS = 'MATCH((u)-[:usage]->(b)-[:Month]->(m)) WHERE toFloat(m[{usage}]) IS NOT NULL'
+
+
+class GraphBackend(object):
+    """The lookups every backend implements
+
+    deadline is the request's graph.Deadline (or None); backends that do
+    I/O must respect it
+    """
+
+    def current_plans(self, name, deadline=None):
+        """Returns the plans the user subscribes to"""
+        raise NotImplementedError
+
+    def upgrade_path(self, name, deadline=None):
+        """Returns the plans one and two upgrades up from the current ones"""
+        raise NotImplementedError
+
+    def bill(self, name, month, deadline=None):
+        """Returns the user's bills for the month ("YYYY-MM")"""
+        raise NotImplementedError
+
+    def usage_series(self, name, deadline=None):
+        """Returns the user's usage as a dict with the months in order, the
+        matching amounts, and the allowance, image url and name of the
+        current plan; an empty dict when there is no usage
+        """
+        raise NotImplementedError
+
+    def plan_catalog(self, deadline=None):
+        """Returns every plan of the catalog"""
+        raise NotImplementedError
+
+    def user_names(self):
+        """Returns the names of all users, for the name index (see names.py)"""
+        raise NotImplementedError
+
+    def user_snapshot(self, name, month, deadline=None):
+        """Returns {'current_plan', 'upgrade_path', 'latest_bill'} at once"""
+        return {
+            'current_plan': self.current_plans(name, deadline),
+            'upgrade_path': self.upgrade_path(name, deadline),
+            'latest_bill': self.bill(name, month, deadline),
+        }
+
+
+class Neo4jBackend(GraphBackend):
+    """Answers the lookups with Cypher on the pooled neo4j driver
+
+    Every per-user query starts from the User node found by name, which the
+    unique constraint from schema.py turns into an index seek.
+    """
+
+    CURRENT_PLANS =\
+    '''MATCH((u:User)-[:subscribe]->(p:Plan)<-[:plan]-(dp:Plans))\
+     Where u.name = {name}\
+     RETURN p\
+    '''
+
+    UPGRADE_PATH =\
+    '''\
+        MATCH((u:User)-[:subscribe]->(p:Plan)<-[:plan]-(dp:Plans))\
+        Where u.name = {name}\
+        OPTIONAL MATCH((p)-[:upgrade]->(up1)-[:upgrade]->(up2))\
+        RETURN up1 AS rec1, up2 AS rec2
+    '''
+
+    BILL =\
+    '''\
+        MATCH (u:User) Where u.name = {name}\
+        MATCH (u)-[:Bill]->(b)-[:Month]->(m:Bill) Where m.Month = {month}\
+        Return m\
+    '''
+
+    USAGE_SERIES =\
+    '''\
+        Match(u:User) Where u.name = {name}\
+        OPTIONAL MATCH((u)-[:subscribe]->(p:Plan))\
+        WITH u, p\
+    ''' + USAGE_MONTHS + '''\
+        WITH p, m ORDER BY m.Month\
+        Return collect(m.Month) AS months,\
+               collect(toFloat(m[{usage}])) AS amounts,\
+               p[{allowance}] AS allowance, p.url AS url,\
+               p.name AS plan\
+    '''
+
+    PLAN_CATALOG =\
+    '''\
+        MATCH((p:Plan)<-[:plan]-(dp:Plans))\
+        RETURN collect(p) AS plans\
+    '''
+
+    USER_SNAPSHOT =\
+    '''\
+        MATCH (u:User) Where u.name = {name}\
+        OPTIONAL MATCH((u)-[:subscribe]->(p:Plan)<-[:plan]-(dp:Plans))\
+        OPTIONAL MATCH((p)-[:upgrade]->(up1)-[:upgrade]->(up2))\
+        OPTIONAL MATCH((u)-[:Bill]->(b)-[:Month]->(m:Bill{Month:{month}}))\
+        RETURN p, up1 AS rec1, up2 AS rec2, m\
+    '''
+
+    USER_NAMES =\
+    '''\
+        MATCH (u:User) WHERE exists(u.name)\
+        RETURN u.name AS user_name\
+    '''
+
+    # The lookups by name, for the plan checks in schema.py
+    QUERIES = ('CURRENT_PLANS', 'UPGRADE_PATH', 'BILL', 'USAGE_SERIES',
+               'PLAN_CATALOG', 'USER_SNAPSHOT')
+
+    @staticmethod
+    def parameters(name, month):
+        """Returns the parameters every lookup query may refer to"""
+        return {'name': name, 'month': month, 'usage': USAGE_PROPERTY,
+                'allowance': PLAN_ALLOWANCE_PROPERTY}
+
+    def current_plans(self, name, deadline=None):
+        response = graph.run_query(self.CURRENT_PLANS, {'name': name}, 'columns',
+                                   deadline)
+        return results.distinct(response.get('p', ()))
+
+    def upgrade_path(self, name, deadline=None):
+        response = graph.run_query(self.UPGRADE_PATH, {'name': name}, 'rows',
+                                   deadline)
+        return results.distinct(plan for row in response for plan in row)
+
+    def bill(self, name, month, deadline=None):
+        parameters = {'name': name, 'month': month}
+        response = graph.run_query(self.BILL, parameters, 'columns', deadline)
+        return results.distinct(response.get('m', ()))
+
+    def usage_series(self, name, deadline=None):
+        parameters = {'name': name, 'usage': USAGE_PROPERTY,
+                      'allowance': PLAN_ALLOWANCE_PROPERTY}
+        response = graph.run_query(self.USAGE_SERIES, parameters, 'rows', deadline)
+        if not response:
+            return {}
+        series = response[0]._asdict()
+        series['allowance'] = _allowance(series.get('allowance'))
+        return series
+
+    def plan_catalog(self, deadline=None):
+        response = graph.run_query(self.PLAN_CATALOG, {}, 'rows', deadline)
+        return list(response[0].plans) if response else []
+
+    def user_snapshot(self, name, month, deadline=None):
+        """Fetches the current plans, upgrade path and bills in one query"""
+        parameters = {'name': name, 'month': month}
+        columns = graph.run_query(self.USER_SNAPSHOT, parameters, 'columns',
+                                  deadline)
+        upgrades = zip(columns.get('rec1', ()), columns.get('rec2', ()))
+        return {
+            'current_plan': results.distinct(columns.get('p', ())),
+            'upgrade_path': results.distinct(plan for row in upgrades for plan in row),
+            'latest_bill': results.distinct(columns.get('m', ())),
+        }
+
+    def user_names(self):
+        """Streams the names of all users, without a deadline"""
+        names = []
+        for chunk in graph.stream_query(self.USER_NAMES, {}):
+            names.extend(row[0] for row in chunk)
+        return names
+
+    def export_snapshot(self, path, labels=None):
+        """Writes the nodes with any of labels (all nodes when None) and the
+        relationships between them to a snapshot file for MemoryBackend
+        """
+        node_cypher =\
+        '''\
+            MATCH (n) WHERE {labels} IS NULL OR any(l IN labels(n) WHERE l IN {labels})\
+            RETURN id(n) AS id, labels(n) AS labels, properties(n) AS properties\
+        '''
+        relationship_cypher =\
+        '''\
+            MATCH (a)-[r]->(b)\
+            WHERE {labels} IS NULL OR\
+                  (any(l IN labels(a) WHERE l IN {labels}) AND\
+                   any(l IN labels(b) WHERE l IN {labels}))\
+            RETURN id(a) AS start, type(r) AS type, id(b) AS end\
+        '''
+        parameters = {'labels': labels}
+        snapshot = {'nodes': [], 'relationships': []}
+        for chunk in graph.stream_query(node_cypher, parameters):
+            snapshot['nodes'].extend(row._asdict() for row in chunk)
+        for chunk in graph.stream_query(relationship_cypher, parameters):
+            snapshot['relationships'].extend(row._asdict() for row in chunk)
+        with open(path, 'w') as snapshot_file:
+            json.dump(snapshot, snapshot_file, default=str)
+        return len(snapshot['nodes']), len(snapshot['relationships'])
+
+
+def _to_float(value):
+    """Converts like Cypher's toFloat(): None when value is not a number"""
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _allowance(value):
+    """Takes a plan allowance such as 10, "10" or "10GB"
+
+    Returns it as a float, or None when there is no number in it
+    """
+    import recommend  # numpy is imported on first use, see warmup.py
+    allowance = recommend.parse_amount(value)
+    return None if math.isnan(allowance) else allowance
+
+
+class MemoryBackend(GraphBackend):
+    """Serves the lookups from an in-memory copy of the graph
+
+    Relationships are indexed by type in both directions, so every hop of a
+    lookup is a dict access.  The graph is read-only once loaded.
+
+    Attributes:
+        properties (dict): node id -> property dict
+        labels (dict): node id -> frozenset of labels
+        outgoing (dict): relationship type -> node id -> [node ids]
+        incoming (dict): relationship type -> node id -> [node ids]
+        users (dict): User name -> node id
+    """
+
+    def __init__(self, nodes, relationships):
+        self.properties = {}
+        self.labels = {}
+        self.outgoing = defaultdict(lambda: defaultdict(list))
+        self.incoming = defaultdict(lambda: defaultdict(list))
+        self.users = {}
+        for node in nodes:
+            self.properties[node['id']] = node['properties']
+            self.labels[node['id']] = frozenset(node['labels'])
+            if 'User' in node['labels']:
+                self.users[node['properties'].get('name')] = node['id']
+        for relationship in relationships:
+            start, end = relationship['start'], relationship['end']
+            self.outgoing[relationship['type']][start].append(end)
+            self.incoming[relationship['type']][end].append(start)
+
+    @classmethod
+    def load(cls, path):
+        """Bulk-loads a snapshot file written by Neo4jBackend.export_snapshot"""
+        with open(path) as snapshot_file:
+            snapshot = json.load(snapshot_file)
+        return cls(snapshot['nodes'], snapshot['relationships'])
+
+    def _hop(self, node, rel_type, label=None):
+        """Returns the ids one outgoing rel_type hop away, optionally only
+        those with label
+        """
+        targets = self.outgoing.get(rel_type, {}).get(node, ())
+        if label is None:
+            return targets
+        return [target for target in targets if label in self.labels[target]]
+
+    def _listed_plans(self, user):
+        """Ids of the user's plans that belong to a Plans catalog"""
+        return [plan for plan in self._hop(user, 'subscribe', 'Plan')
+                if any('Plans' in self.labels[owner]
+                       for owner in self.incoming.get('plan', {}).get(plan, ()))]
+
+    def current_plans(self, name, deadline=None):
+        user = self.users.get(name)
+        if user is None:
+            return []
+        return [self.properties[plan] for plan in self._listed_plans(user)]
+
+    def upgrade_path(self, name, deadline=None):
+        user = self.users.get(name)
+        if user is None:
+            return []
+        found = []
+        for plan in self._listed_plans(user):
+            for up1 in self._hop(plan, 'upgrade'):
+                for up2 in self._hop(up1, 'upgrade'):
+                    for node in (up1, up2):
+                        if node not in found:
+                            found.append(node)
+        return [self.properties[node] for node in found]
+
+    def bill(self, name, month, deadline=None):
+        user = self.users.get(name)
+        if user is None:
+            return []
+        return [self.properties[bill]
+                for period in self._hop(user, 'Bill')
+                for bill in self._hop(period, 'Month', 'Bill')
+                if self.properties[bill].get('Month') == month]
+
+    def usage_series(self, name, deadline=None):
+        user = self.users.get(name)
+        if user is None:
+            return {}
+        months = sorted((self.properties[month] for period in self._hop(user, 'usage')
+                         for month in self._hop(period, 'Month')
+                         if _to_float(self.properties[month].get(USAGE_PROPERTY)) is not None),
+                        key=lambda month: month.get('Month'))
+        if not months:
+            return {}
+        plans = self._hop(user, 'subscribe', 'Plan')
+        plan = self.properties[plans[0]] if plans else {}
+        return {
+            'months': [month.get('Month') for month in months],
+            'amounts': [_to_float(month.get(USAGE_PROPERTY)) for month in months],
+            'allowance': _allowance(plan.get(PLAN_ALLOWANCE_PROPERTY)),
+            'url': plan.get('url'),
+            'plan': plan.get('name'),
+        }
+
+    def plan_catalog(self, deadline=None):
+        plans = []
+        for catalog, labels in self.labels.items():
+            if 'Plans' in labels:
+                plans.extend(plan for plan in self._hop(catalog, 'plan', 'Plan')
+                             if plan not in plans)
+        return [self.properties[plan] for plan in plans]
+
+    def user_names(self):
+        return [name for name in self.users if name]
+
+
+_backends = {}
+_backends_lock = threading.Lock()
+
+
+def get_backend(name):
+    """Returns the shared backend instance called name ('neo4j' or 'memory')"""
+    backend = _backends.get(name)
+    if backend is None:
+        with _backends_lock:
+            backend = _backends.get(name)
+            if backend is None:
+                if name == 'neo4j':
+                    backend = Neo4jBackend()
+                elif name == 'memory':
+                    backend = MemoryBackend.load(GRAPH_SNAPSHOT_FILE)
+                else:
+                    raise ValueError('unknown graph backend: %s' % name)
+                _backends[name] = backend
+    return backend
+
+
+def user_backend():
+    """The backend for per-user lookups, see GRAPH_BACKEND"""
+    return get_backend(GRAPH_BACKEND)
+
+
+def plan_backend():
+    """The backend for the plan catalog, see PLAN_BACKEND"""
+    return get_backend(PLAN_BACKEND)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Export a graph snapshot for MemoryBackend')
+    parser.add_argument('command', choices=['export'])
+    parser.add_argument('path', nargs='?', default=GRAPH_SNAPSHOT_FILE)
+    parser.add_argument('--labels', nargs='*',
+                        help='only export nodes with these labels, e.g. Plan Plans')
+    args = parser.parse_args(argv)
+    nodes, relationships = Neo4jBackend().export_snapshot(args.path, args.labels)
+    print('wrote %d nodes and %d relationships to %s' % (nodes, relationships, args.path))
+
+
+if __name__ == '__main__':
+    main()
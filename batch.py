@@ -0,0 +1,172 @@
+# -*- coding:utf8 -*-
+"""Batch fulfillment for outbound campaigns
+
+Builds the same fulfillmentMessages as the check_bill and recommendation
+actions for many users at once.  Users are split into chunks and every chunk
+is fetched with a single UNWIND query; chunks run in parallel and payloads are
+yielded as soon as their chunk is done.
+
+    python batch.py names.txt --action recommendation > payloads.jsonl
+
+reads one user name per line and writes one JSON line per user, with the
+throughput summary on stderr.
+"""
+
+import argparse
+import collections
+import json
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import recommend
+from backends import USAGE_MONTHS
+from get_response import Check_Bill
+from graph import run_query
+from config import (BATCH_CHUNK_SIZE, BATCH_PARALLELISM, USAGE_PROPERTY,
+                    PLAN_ALLOWANCE_PROPERTY)
+
+CYPHER = '''\
+    UNWIND {names} AS name\
+    MATCH (u:User) Where u.name = name\
+    OPTIONAL MATCH((u)-[:subscribe]->(p:Plan)<-[:plan]-(dp:Plans))\
+    OPTIONAL MATCH((p)-[:upgrade]->(up1)-[:upgrade]->(up2))\
+    WITH name, u, collect(DISTINCT p) AS plans,\
+         collect(DISTINCT up1) + collect(DISTINCT up2) AS upgrades\
+    OPTIONAL ''' + USAGE_MONTHS + '''\
+    WITH name, plans, upgrades, m ORDER BY m.Month\
+    RETURN name, plans, upgrades, collect(m.Month) AS months,\
+           collect(toFloat(m[{usage}])) AS amounts\
+'''
+
+# The Check_Bill renderer used for each batch action
+RENDERERS = {
+    'check_bill': Check_Bill.get_current_response,
+    'recommendation': Check_Bill.get_recommendation_response,
+}
+
+
+class BatchReport(object):
+    """Throughput of a batch run
+
+    Attributes:
+        users (int): payloads produced
+        chunks (int): UNWIND queries completed
+        missing (int): requested users that were not found in the graph
+        started (float): time.time() when the run started
+    """
+
+    def __init__(self):
+        self.users = 0
+        self.chunks = 0
+        self.missing = 0
+        self.started = time.time()
+
+    def summary(self):
+        """Returns the counters and users per second as a dict"""
+        elapsed = time.time() - self.started
+        return {
+            'users': self.users,
+            'chunks': self.chunks,
+            'missing': self.missing,
+            'seconds': round(elapsed, 3),
+            'users_per_second': round(self.users / elapsed, 1) if elapsed else 0.0,
+        }
+
+
+def fetch_chunk(names):
+    """Takes a list of user names
+
+    Returns the rows of the UNWIND query for them, one per user found
+    """
+    parameters = {'names': names, 'usage': USAGE_PROPERTY}
+    return run_query(CYPHER, parameters)
+
+
+def render(row, action):
+    """Takes one row of the UNWIND query and a batch action
+
+    Returns the fulfillmentMessages for that user
+    """
+    plans = list(row.plans)
+    current = plans[0] if plans else {}
+    checkbill = Check_Bill({'given-name': [row.name]})
+    checkbill.preload(
+        current_plan=plans,
+        upgrade_path=[plan for plan in row.upgrades if plan is not None],
+        usage_history={
+            'months': row.months,
+            'amounts': row.amounts,
+            'allowance': recommend.parse_amount(current.get(PLAN_ALLOWANCE_PROPERTY)),
+            'url': current.get('url'),
+            'plan': current.get('name'),
+        })
+    return RENDERERS[action](checkbill)
+
+
+def fulfill(names, action='check_bill', chunk_size=BATCH_CHUNK_SIZE,
+            parallelism=BATCH_PARALLELISM, report=None):
+    """Takes an iterable of user names and a batch action
+
+    Yields (name, fulfillmentMessages) for every user found, chunk by chunk
+    in input order; at most 2 * parallelism chunks are in flight, so the
+    names may be a lazy stream of any length.  report, a BatchReport, is
+    updated as chunks complete
+    """
+    if action not in RENDERERS:
+        raise ValueError('unknown batch action: %s' % action)
+    report = report if report is not None else BatchReport()
+
+    def chunked():
+        chunk = []
+        for name in names:
+            chunk.append(name)
+            if len(chunk) >= chunk_size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+    pending = collections.deque()
+    with ThreadPoolExecutor(max_workers=parallelism) as executor:
+        for chunk in chunked():
+            pending.append((chunk, executor.submit(fetch_chunk, chunk)))
+            if len(pending) >= 2 * parallelism:
+                for item in _drain(pending.popleft(), action, report):
+                    yield item
+        while pending:
+            for item in _drain(pending.popleft(), action, report):
+                yield item
+
+
+def _drain(submitted, action, report):
+    chunk, future = submitted
+    rows = future.result()
+    report.chunks += 1
+    report.missing += len(chunk) - len(rows)
+    for row in rows:
+        report.users += 1
+        yield row.name, render(row, action)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('names', help='file with one user name per line, - for stdin')
+    parser.add_argument('--action', choices=sorted(RENDERERS), default='check_bill')
+    parser.add_argument('--chunk-size', type=int, default=BATCH_CHUNK_SIZE)
+    parser.add_argument('--parallelism', type=int, default=BATCH_PARALLELISM)
+    args = parser.parse_args(argv)
+
+    source = sys.stdin if args.names == '-' else open(args.names)
+    names = (line.strip() for line in source if line.strip())
+    report = BatchReport()
+    for name, messages in fulfill(names, args.action, args.chunk_size,
+                                  args.parallelism, report):
+        sys.stdout.write(json.dumps({'name': name,
+                                     'fulfillmentMessages': messages},
+                                    default=str) + '\n')
+    sys.stderr.write(json.dumps(report.summary()) + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,194 @@
+# -*- coding:utf8 -*-
+"""In-process stand-in for the neo4j driver used by the benchmarks
+
+FakeGraphDatabase.driver() returns a driver whose sessions answer the Cypher
+statements issued by get_response.py and batch.py from synthetic data,
+after sleeping for a configurable round-trip latency.  Statements are
+recognized by their RETURN clause, so the stand-in needs updating whenever a
+query's returned columns change.
+"""
+
+import random
+import threading
+import time
+
+
+class FakeRecord(tuple):
+    """A record with the keys()/values() interface of neo4j.v1.Record"""
+
+    def __new__(cls, keys, values):
+        record = tuple.__new__(cls, values)
+        record._keys = keys
+        return record
+
+    def keys(self):
+        return list(self._keys)
+
+    def values(self):
+        return list(self)
+
+    def items(self):
+        return list(zip(self._keys, self))
+
+
+class FakeResult(object):
+    def __init__(self, keys, rows):
+        self._keys = keys
+        self._rows = rows
+
+    def keys(self):
+        return list(self._keys)
+
+    def __iter__(self):
+        return (FakeRecord(self._keys, row) for row in self._rows)
+
+
+class FakeGraph(object):
+    """Synthetic users, plans, bills and usage
+
+    Attributes:
+        users (int): number of users, named user0 .. user<n-1>
+        plans (int): size of the plan catalog
+        months (int): months of usage and bills per user
+        latency (float): seconds slept per statement
+        jitter (float): extra random latency of up to this many seconds
+        statements (int): statements answered so far
+    """
+
+    def __init__(self, users=1000, plans=20, months=24, latency=0.002,
+                 jitter=0.0, seed=0):
+        self.users = users
+        self.months = months
+        self.latency = latency
+        self.jitter = jitter
+        self.statements = 0
+        self.lock = threading.Lock()
+        rand = random.Random(seed)
+        self.plan_nodes = [{
+            'name': 'Plan %d' % index,
+            'fee': '$%d' % (10 + 5 * index),
+            'data': '%dGB' % (2 + 3 * index),
+            'overage_fee': '%d' % (12 - index % 10),
+            'url': 'https://example.com/plans/%d.png' % index,
+        } for index in range(plans)]
+        self.month_names = ['%d-%02d' % (2017 + month // 12, month % 12 + 1)
+                            for month in range(months)]
+        self.usage = [[round(rand.uniform(0.5, 3 * plans), 1)
+                       for _ in range(months)] for _ in range(users)]
+
+    def _user(self, name):
+        if not name or not name.startswith('user'):
+            return None
+        try:
+            index = int(name[4:])
+        except ValueError:
+            return None
+        return index if index < self.users else None
+
+    def _plan(self, user):
+        return self.plan_nodes[user % len(self.plan_nodes)]
+
+    def _upgrades(self, user):
+        row = user % len(self.plan_nodes)
+        return [self.plan_nodes[min(row + step, len(self.plan_nodes) - 1)]
+                for step in (1, 2)]
+
+    def _bill(self, user, month=None):
+        """The user's bill for month, or for the last month when there is no
+        such month; each month further back costs a dollar more
+        """
+        if month not in self.month_names:
+            month = self.month_names[-1]
+        fee = int(self._plan(user)['fee'].lstrip('$'))
+        fee += len(self.month_names) - 1 - self.month_names.index(month)
+        return {'Month': month, 'fee': '$%d' % fee}
+
+    def run(self, cypher, parameters):
+        """Returns a FakeResult for one statement"""
+        with self.lock:
+            self.statements += 1
+        delay = self.latency + (random.random() * self.jitter if self.jitter else 0)
+        if delay:
+            time.sleep(delay)
+        parameters = parameters or {}
+        user = self._user(parameters.get('name'))
+
+        if 'UNWIND' in cypher:
+            keys = ('name', 'plans', 'upgrades', 'months', 'amounts')
+            rows = []
+            for name in parameters.get('names', ()):
+                index = self._user(name)
+                if index is not None:
+                    rows.append((name, [self._plan(index)], self._upgrades(index),
+                                 self.month_names, self.usage[index]))
+            return FakeResult(keys, rows)
+        if 'AS user_name' in cypher:
+            return FakeResult(('user_name',),
+                              [('user%d' % index,) for index in range(self.users)])
+        if 'AS plans' in cypher:
+            return FakeResult(('plans',), [(self.plan_nodes,)])
+        if user is None:
+            return FakeResult((), [])
+        if 'AS amounts' in cypher:
+            plan = self._plan(user)
+            keys = ('months', 'amounts', 'allowance', 'url', 'plan')
+            return FakeResult(keys, [(self.month_names, self.usage[user],
+                                      plan['data'], plan['url'], plan['name'])])
+        if 'up2 AS rec2, m' in cypher:
+            up1, up2 = self._upgrades(user)
+            return FakeResult(('p', 'rec1', 'rec2', 'm'),
+                              [(self._plan(user), up1, up2, self._bill(user, parameters.get('month')))])
+        if 'AS rec1' in cypher:
+            return FakeResult(('rec1', 'rec2'), [tuple(self._upgrades(user))])
+        if ':Bill' in cypher:
+            return FakeResult(('m',), [(self._bill(user, parameters.get('month')),)])
+        if 'subscribe' in cypher:
+            return FakeResult(('p',), [(self._plan(user),)])
+        return FakeResult((), [])
+
+
+class FakeTransaction(object):
+    def __init__(self, graph):
+        self.graph = graph
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def run(self, cypher, parameters=None, **kwparameters):
+        return self.graph.run(cypher, dict(parameters or {}, **kwparameters))
+
+
+class FakeSession(FakeTransaction):
+    def begin_transaction(self, bookmark=None, metadata=None, timeout=None):
+        return FakeTransaction(self.graph)
+
+    def close(self):
+        pass
+
+
+class FakeDriver(object):
+    def __init__(self, graph):
+        self.graph = graph
+
+    def session(self, *args, **kwargs):
+        return FakeSession(self.graph)
+
+    def close(self):
+        pass
+
+
+class FakeGraphDatabase(object):
+    """Drop-in for neo4j.v1.GraphDatabase serving one shared FakeGraph"""
+
+    graph = FakeGraph()
+
+    @classmethod
+    def driver(cls, uri, **config):
+        return FakeDriver(cls.graph)
+
+
+def fake_basic_auth(user, password):
+    return (user, password)
@@ -0,0 +1,76 @@
+# -*- coding:utf8 -*-
+"""Dialogflow v2 webhook requests replayed by the benchmarks
+
+Each conversation is the usual check bill -> find a new plan -> recharge ->
+analyze sequence for one user in one Dialogflow session, followed by the two
+writes: paying the bill and switching plans.  The first turn carries the
+customer name as a parameter; later turns only have it in the output
+context, as the real agent sends them.
+"""
+
+import uuid
+
+PROJECT = 'projects/billing-agent-bench'
+
+# Plan the change_plan turn switches to; the fake graph names plans "Plan <n>"
+NEW_PLAN = 'Plan 3'
+
+# (action, query text, intent display name, parameters) of each turn of a
+# conversation
+TURNS = (
+    ('check_bill', 'Hi, I am {name}, can you check my bill?', 'Check Bill', {}),
+    ('recommendation', 'Find a New Plan', 'Recommendation', {}),
+    ('recharge_exisiting_plan', 'recharge exisiting plan', 'Recharge', {}),
+    ('analyze_usage', 'Analyze my Usage', 'Analyze Usage', {}),
+    ('confirm_recharge', 'Yes, pay my bill', 'Confirm Recharge', {}),
+    ('change_plan', 'Switch me to ' + NEW_PLAN, 'Change Plan', {'plan': NEW_PLAN}),
+)
+
+ACTIONS = tuple(action for action, _, _, _ in TURNS)
+
+
+def request(action, query_text, intent, name, session, first_turn, extra=None):
+    """Returns one webhook request body as a dict; extra holds the turn's
+    own parameters besides the customer name
+    """
+    session_path = '%s/agent/sessions/%s' % (PROJECT, session)
+    context_parameters = {'given-name': [name], 'given-name.original': [name]}
+    parameters = {'given-name': [name]} if first_turn else {'given-name': ''}
+    parameters.update(extra or {})
+    return {
+        'responseId': str(uuid.uuid4()),
+        'session': session_path,
+        'queryResult': {
+            'queryText': query_text.format(name=name),
+            'action': action,
+            'parameters': parameters,
+            'allRequiredParamsPresent': True,
+            'fulfillmentText': '',
+            'fulfillmentMessages': [{'text': {'text': ['']}}],
+            'outputContexts': [{
+                'name': '%s/contexts/customer' % session_path,
+                'lifespanCount': 5,
+                'parameters': context_parameters,
+            }],
+            'intent': {
+                'name': '%s/agent/intents/%s' % (PROJECT, uuid.uuid5(uuid.NAMESPACE_URL, intent)),
+                'displayName': intent,
+            },
+            'intentDetectionConfidence': 1.0,
+            'languageCode': 'en',
+        },
+        'originalDetectIntentRequest': {'payload': {}},
+    }
+
+
+def conversation(name):
+    """Returns the requests of one full conversation for the user"""
+    session = str(uuid.uuid4())
+    return [request(action, text, intent, name, session, index == 0, extra)
+            for index, (action, text, intent, extra) in enumerate(TURNS)]
+
+
+def conversations(count, users):
+    """Yields count conversations spread over users user0 .. user<users-1>"""
+    for index in range(count):
+        yield conversation('user%d' % (index % users))
@@ -0,0 +1,263 @@
+# -*- coding:utf8 -*-
+"""Load test and benchmark for the webhook, without a real neo4j
+
+Replays full Dialogflow conversations (see payloads.py) against the Flask
+webhook() route with the neo4j driver replaced by the in-process stand-in
+from fake_graph.py, then reports per-action p50/p95/p99 latency and peak
+memory allocated per request, and the overall requests per second.
+
+    python -m bench.run --conversations 500 --concurrency 8
+    python -m bench.run --save-baseline          # write bench/baseline.json
+    python -m bench.run --check-baseline         # exit 1 on a regression
+
+The baseline records the settings it was made with; a run is only compared
+with a baseline made with the same settings, as latency and throughput
+depend on them.
+
+Run it from the repository root.
+"""
+
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from collections import defaultdict
+
+import driver
+from bench import payloads
+from bench.fake_graph import FakeGraph, FakeGraphDatabase, fake_basic_auth
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+
+# Arguments that change what is measured; recorded in the baseline
+SETTINGS = ('conversations', 'concurrency', 'users', 'plans', 'months',
+            'latency_ms', 'jitter_ms', 'cold', 'alloc_conversations')
+
+
+def install_fake_graph(graph):
+    """Points the process-wide driver at the in-process stand-in"""
+    FakeGraphDatabase.graph = graph
+    driver.GraphDatabase = FakeGraphDatabase
+    driver.basic_auth = fake_basic_auth
+    driver.close_driver()
+
+
+def percentile(sorted_values, percent):
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return 0.0
+    rank = max(int(round(percent / 100.0 * len(sorted_values) + 0.5)) - 1, 0)
+    return sorted_values[min(rank, len(sorted_values) - 1)]
+
+
+class Runner(object):
+    """Posts webhook requests through the Flask test client
+
+    Attributes:
+        latencies (dict): action -> list of request latencies in seconds
+        failures (int): requests that did not answer 200 with messages
+    """
+
+    def __init__(self, app, cold=False):
+        self.app = app
+        self.cold = cold
+        self.latencies = defaultdict(list)
+        self.failures = 0
+        self.lock = threading.Lock()
+
+    def post(self, client, body):
+        if self.cold:
+            from get_response import query_cache
+            query_cache.clear()
+        data = json.dumps(body)
+        start = time.perf_counter()
+        response = client.post('/', data=data, content_type='application/json')
+        elapsed = time.perf_counter() - start
+        ok = response.status_code == 200 and b'fulfillmentMessages' in response.data
+        with self.lock:
+            self.latencies[body['queryResult']['action']].append(elapsed)
+            self.failures += not ok
+
+    def replay(self, conversations, concurrency):
+        """Replays the conversations on concurrency threads
+
+        Returns the wall clock seconds it took
+        """
+        conversations = list(conversations)
+        cursor = iter(conversations)
+        cursor_lock = threading.Lock()
+
+        def worker():
+            client = self.app.test_client()
+            while True:
+                with cursor_lock:
+                    turns = next(cursor, None)
+                if turns is None:
+                    return
+                for body in turns:
+                    self.post(client, body)
+
+        threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return time.perf_counter() - start
+
+
+def allocations(conversations, warmup):
+    """Returns action -> mean peak bytes allocated while answering a request
+
+    Only the action and the rendering of its fulfillment are measured: the
+    HTTP stack allocates the same 64 KiB read buffer for every request, which
+    would hide the differences between actions.  The warmup conversations
+    are answered first, untraced, so imports and first-use caches are not
+    counted against the first requests.
+    """
+    import actions
+    import render
+    from graph import Deadline
+    from config import WEBHOOK_BUDGET
+
+    def answer(body):
+        res = actions.dispatch(body, Deadline(WEBHOOK_BUDGET))
+        render.fulfillment(res)
+
+    for turns in warmup:
+        for body in turns:
+            answer(body)
+    peaks = defaultdict(list)
+    tracemalloc.start()
+    try:
+        for turns in conversations:
+            for body in turns:
+                tracemalloc.reset_peak()
+                before = tracemalloc.get_traced_memory()[0]
+                answer(body)
+                peaks[body['queryResult']['action']].append(
+                    tracemalloc.get_traced_memory()[1] - before)
+    finally:
+        tracemalloc.stop()
+    return dict((action, sum(values) / len(values)) for action, values in peaks.items())
+
+
+def report(runner, wall, allocated, settings):
+    """Returns the benchmark results as a dict keyed by action (and 'all'),
+    with the run settings under 'settings'
+    """
+    results = {'settings': settings}
+    everything = []
+    for action in payloads.ACTIONS:
+        values = sorted(runner.latencies.get(action, ()))
+        everything.extend(values)
+        results[action] = summarize(values, allocated.get(action))
+    results['all'] = summarize(sorted(everything), None)
+    results['all']['rps'] = round(len(everything) / wall, 1) if wall else 0.0
+    results['all']['failures'] = runner.failures
+    return results
+
+
+def summarize(values, allocated):
+    summary = {
+        'requests': len(values),
+        'p50_ms': round(percentile(values, 50) * 1000, 3),
+        'p95_ms': round(percentile(values, 95) * 1000, 3),
+        'p99_ms': round(percentile(values, 99) * 1000, 3),
+    }
+    if allocated is not None:
+        summary['alloc_kib'] = round(allocated / 1024.0, 1)
+    return summary
+
+
+def regressions(results, baseline, tolerance, min_delta_ms):
+    """Returns a list of (action, metric, baseline, current) that got worse
+    by more than tolerance (a fraction); latencies must also have grown by
+    at least min_delta_ms, so sub-millisecond noise is not reported
+    """
+    worse = []
+    for action, current in results.items():
+        previous = baseline.get(action)
+        if not previous or action == 'settings':
+            continue
+        for metric in ('p50_ms', 'p95_ms', 'p99_ms', 'alloc_kib'):
+            if metric not in previous or metric not in current:
+                continue
+            allowed = previous[metric] * tolerance
+            if metric.endswith('_ms'):
+                allowed = max(allowed, min_delta_ms)
+            if current[metric] > previous[metric] + allowed:
+                worse.append((action, metric, previous[metric], current[metric]))
+        if 'rps' in previous and current['rps'] < previous['rps'] * (1 - tolerance):
+            worse.append((action, 'rps', previous['rps'], current['rps']))
+    return worse
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--conversations', type=int, default=200)
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--plans', type=int, default=20)
+    parser.add_argument('--months', type=int, default=24)
+    parser.add_argument('--latency-ms', type=float, default=2.0,
+                        help='synthetic neo4j round trip per statement')
+    parser.add_argument('--jitter-ms', type=float, default=0.0)
+    parser.add_argument('--cold', action='store_true',
+                        help='clear the query cache before every request')
+    parser.add_argument('--alloc-conversations', type=int, default=20)
+    parser.add_argument('--save-baseline', action='store_true')
+    parser.add_argument('--check-baseline', action='store_true')
+    parser.add_argument('--tolerance', type=float, default=0.25)
+    parser.add_argument('--min-delta-ms', type=float, default=1.0)
+    args = parser.parse_args(argv)
+
+    settings = dict((key, value) for key, value in vars(args).items()
+                    if key in SETTINGS)
+    install_fake_graph(FakeGraph(users=args.users, plans=args.plans,
+                                 months=args.months,
+                                 latency=args.latency_ms / 1000.0,
+                                 jitter=args.jitter_ms / 1000.0))
+    import logs
+    import main as webhook_app
+    logs.LOG_SAMPLE_RATE = 0.0
+
+    runner = Runner(webhook_app.app, cold=args.cold)
+    runner.replay(payloads.conversations(min(args.conversations, 20), args.users), 1)
+    runner = Runner(webhook_app.app, cold=args.cold)
+    wall = runner.replay(payloads.conversations(args.conversations, args.users),
+                         args.concurrency)
+    allocated = allocations(payloads.conversations(args.alloc_conversations, args.users),
+                            payloads.conversations(min(args.alloc_conversations, 5),
+                                                   args.users))
+    results = report(runner, wall, allocated, settings)
+    results['all']['statements'] = FakeGraphDatabase.graph.statements
+    print(json.dumps(results, indent=2, sort_keys=True))
+
+    if args.save_baseline:
+        with open(BASELINE, 'w') as baseline_file:
+            json.dump(results, baseline_file, indent=2, sort_keys=True)
+            baseline_file.write('\n')
+    if args.check_baseline:
+        with open(BASELINE) as baseline_file:
+            baseline = json.load(baseline_file)
+        if baseline.get('settings') != settings:
+            sys.stderr.write('baseline was made with %s, not %s; rerun with its '
+                             'settings or save a new baseline\n'
+                             % (json.dumps(baseline.get('settings'), sort_keys=True),
+                                json.dumps(settings, sort_keys=True)))
+            return 2
+        worse = regressions(results, baseline, args.tolerance, args.min_delta_ms)
+        for action, metric, previous, current in worse:
+            sys.stderr.write('regression: %s %s %s -> %s\n'
+                             % (action, metric, previous, current))
+        if worse or results['all']['failures']:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
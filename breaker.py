@@ -0,0 +1,192 @@
+# -*- coding:utf8 -*-
+"""Module that stops calling neo4j for a while once it fails or slows down
+
+A CircuitBreaker counts consecutive calls that failed with one of its
+errors (for neo4j: unreachable, transient or socket errors), and calls with
+a deadline that took longer than its latency threshold.  Other exceptions,
+such as the request's own DeadlineExceeded or this worker's connection pool
+running out, count neither way unless the call was also too slow; calls
+without a deadline (batch work) are never too slow.  After BREAKER_FAILURES of them it opens:
+calls are refused right away with CircuitOpen for BREAKER_RESET seconds,
+instead of each one waiting for a connect timeout.  Then it is half-open and
+lets a single probe through; the breaker closes when the probe succeeds and
+opens again when it fails.  Functions added with on_close() run on a
+background thread whenever it closes again.
+
+graph.run_query() runs every query through the breaker `neo4j`; see
+get_response.py for what the handlers serve while it is open (or neo4j
+otherwise fails with one of UNAVAILABLE).
+"""
+
+import logging
+import socket
+import threading
+import time
+
+from neo4j.exceptions import ClientError, ServiceUnavailable, TransientError
+
+import driver
+import metrics
+from config import BREAKER_FAILURES, BREAKER_SLOW_QUERY, BREAKER_RESET
+
+log = logging.getLogger(__name__)
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+# Gauge value of each state on /metrics
+STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+
+class CircuitOpen(Exception):
+    """Raised instead of calling a dependency whose breaker is open"""
+
+
+# Errors meaning neo4j cannot answer right now, whether or not the breaker
+# has opened yet; graph.run_query() raises socket errors as ServiceUnavailable
+UNAVAILABLE = (CircuitOpen, ServiceUnavailable, TransientError)
+
+
+class CircuitBreaker(object):
+    """Fails calls fast while a dependency is down or too slow
+
+    Attributes:
+        name (str): the dependency, for logs and metrics
+        failures (int): consecutive failures that open the breaker
+        slow (float): seconds after which a successful call counts as failed
+        reset (float): seconds the breaker stays open before a probe
+        errors (tuple): exception types (raised or chained as the cause)
+            that count as failures
+        ignore (tuple): exception types showing the dependency answered,
+            e.g. errors in the query itself; they count as successes
+        neutral (tuple): exception types among errors that count neither
+            way, e.g. local timeouts
+        state (str): CLOSED, OPEN or HALF_OPEN
+        failed (int): consecutive failures so far
+        opened_at (float): when the breaker last opened
+    """
+
+    def __init__(self, name, failures=BREAKER_FAILURES, slow=BREAKER_SLOW_QUERY,
+                 reset=BREAKER_RESET, errors=(Exception,), ignore=(), neutral=()):
+        self.name = name
+        self.failures = failures
+        self.slow = slow
+        self.reset = reset
+        self.errors = tuple(errors)
+        self.ignore = tuple(ignore)
+        self.neutral = tuple(neutral)
+        self.lock = threading.Lock()
+        self.state = CLOSED
+        self.failed = 0
+        self.opened_at = 0.0
+        self.probing = False
+        self.listeners = []
+
+    def on_close(self, function):
+        """Registers function to run (on a new thread) when the breaker
+        closes after being open
+        """
+        self.listeners.append(function)
+        return function
+
+    def allow(self):
+        """Returns True when a call may go through now
+
+        In the half-open state only the first caller, the probe, may
+        """
+        with self.lock:
+            if self.state == CLOSED:
+                return True
+            if self.state == OPEN:
+                if time.time() - self.opened_at < self.reset:
+                    return False
+                self.state = HALF_OPEN
+                self.probing = False
+                log.info('breaker %s half-open', self.name)
+            if self.probing:
+                return False
+            self.probing = True
+            return True
+
+    def call(self, function, *args, timed=True):
+        """Runs function(*args) through the breaker
+
+        timed is False for calls without a deadline, which are never
+        counted as too slow
+        raises CircuitOpen without calling function while the breaker is
+        open, and whatever function raises otherwise
+        Returns what function returns
+        """
+        if not self.allow():
+            metrics.inc('breaker_rejected_total', metrics.current_action())
+            raise CircuitOpen('%s is unavailable' % self.name)
+        start = time.perf_counter()
+        try:
+            result = function(*args)
+        except BaseException as error:
+            seconds = time.perf_counter() - start if timed else 0.0
+            if isinstance(error, self.ignore):
+                self.succeeded(seconds)
+            elif self.counts(error) or (self.slow and seconds > self.slow):
+                self.failure()
+            else:
+                self.released()
+            raise
+        self.succeeded(time.perf_counter() - start if timed else 0.0)
+        return result
+
+    def counts(self, error):
+        """Returns True when error (or its cause) is a failure of the
+        dependency
+        """
+        for candidate in (error, error.__cause__):
+            if isinstance(candidate, self.errors) and not isinstance(candidate, self.neutral):
+                return True
+        return False
+
+    def succeeded(self, seconds):
+        """Records a call that returned after seconds"""
+        if self.slow and seconds > self.slow:
+            self.failure()
+            return
+        with self.lock:
+            recovered = self.state != CLOSED
+            self.state = CLOSED
+            self.failed = 0
+            self.probing = False
+        if recovered:
+            log.info('breaker %s closed', self.name)
+            for function in self.listeners:
+                thread = threading.Thread(target=function, name='breaker-' + self.name)
+                thread.daemon = True
+                thread.start()
+
+    def released(self):
+        """Records a call that ended without telling whether the dependency
+        works; a half-open breaker lets the next call probe instead
+        """
+        with self.lock:
+            self.probing = False
+
+    def failure(self):
+        """Records a failed (or too slow) call"""
+        with self.lock:
+            self.failed += 1
+            if self.state == CLOSED and self.failed < self.failures:
+                return
+            if self.state != OPEN:
+                metrics.inc('breaker_opened_total')
+                log.warning('breaker %s open after %d failures', self.name, self.failed)
+            self.state = OPEN
+            self.opened_at = time.time()
+            self.probing = False
+
+    def stats(self):
+        with self.lock:
+            return {'state': STATE_VALUES[self.state], 'failures': self.failed}
+
+
+# Errors in a query itself (syntax, constraints) show neo4j is answering
+neo4j = CircuitBreaker('neo4j', errors=(ServiceUnavailable, TransientError, socket.error),
+                       ignore=(ClientError,), neutral=(driver.PoolTimeout,))
@@ -0,0 +1,78 @@
+# -*- coding:utf8 -*-
+"""Module with the in-process cache shared by the lookup, conversation and
+chart caches
+"""
+
+import threading
+import time
+from collections import OrderedDict
+
+
+class TTLCache(object):
+    """A bounded least-recently-used cache whose entries expire
+
+    Each entry carries its own time to live, so mostly static data can be
+    kept longer than per-user data in the same cache.  Safe to share between
+    threads.
+
+    Attributes:
+        hits (int): lookups served from the cache
+        misses (int): lookups that were absent or expired
+        evictions (int): entries dropped to stay within max_entries
+        expirations (int): entries dropped because their TTL ran out
+    """
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key):
+        """Returns (True, value) for a live entry, otherwise (False, None)"""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] < time.time():
+                del self.entries[key]
+                self.expirations += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return False, None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return True, entry[1]
+
+    def set(self, key, value, ttl):
+        """Stores value under key for ttl seconds"""
+        with self.lock:
+            self.entries[key] = (time.time() + ttl, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, match):
+        """Drops every entry whose key satisfies match(key)"""
+        with self.lock:
+            for key in [key for key in self.entries if match(key)]:
+                del self.entries[key]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        """Returns the cache counters as a dict"""
+        with self.lock:
+            return {
+                'size': len(self.entries),
+                'max_entries': self.max_entries,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+            }
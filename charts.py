@@ -0,0 +1,270 @@
+# -*- coding:utf8 -*-
+"""Module that renders usage charts for the analyze_usage card
+
+chart_url() names a chart by a token hashed from the user and their usage
+series, queues it for rendering on a small worker pool and returns its URL
+right away, so the card does not wait for the chart.  The same user and data
+always give the same token: a chart is rendered once and then served from
+memory, or from CHART_DIR by whichever worker gets the image request.
+
+Charts are PNG bar charts, one bar per month, with the plan allowance as a
+dashed line; Messenger cards do not show SVG images.  They are drawn on a
+numpy pixel array with a small built-in font, so no imaging library is
+needed.
+"""
+
+import hashlib
+import logging
+import os
+import struct
+import tempfile
+import threading
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+import metrics
+from cache import TTLCache
+from config import (CHART_BASE_URL, CHART_DIR, CHART_TTL, CHART_CACHE_SIZE,
+                    CHART_WORKERS, CHART_WAIT, USAGE_UNIT)
+
+log = logging.getLogger(__name__)
+
+WIDTH = 480
+HEIGHT = 240
+MARGIN = 32
+BACKGROUND = (0xff, 0xff, 0xff)
+BAR_COLOR = (0x42, 0x85, 0xf4)
+OVER_COLOR = (0xea, 0x43, 0x35)
+LINE_COLOR = (0x55, 0x55, 0x55)
+TEXT_COLOR = (0x33, 0x33, 0x33)
+CONTENT_TYPE = 'image/png'
+EXTENSION = '.png'
+
+# Expired chart files are deleted after every this many renders
+PRUNE_EVERY = 500
+
+# 3x5 glyphs, row by row; other characters are drawn as blanks
+FONT = {
+    '0': '111101101101111', '1': '010110010010111', '2': '110001010100111',
+    '3': '110001010001110', '4': '101101111001001', '5': '111100110001110',
+    '6': '111100111101111', '7': '111001010010010', '8': '111101111101111',
+    '9': '111101111001111', '-': '000000111000000', '.': '000000000000010',
+    'A': '010101111101101', 'B': '110101110101110', 'C': '011100100100011',
+    'D': '110101101101110', 'E': '111100110100111', 'F': '111100110100100',
+    'G': '011100101101011', 'H': '101101111101101', 'I': '111010010010111',
+    'J': '001001001101010', 'K': '101101110101101', 'L': '100100100100111',
+    'M': '101111111101101', 'N': '110101101101101', 'O': '010101101101010',
+    'P': '110101110100100', 'Q': '010101101110011', 'R': '110101110101101',
+    'S': '011100010001110', 'T': '111010010010010', 'U': '101101101101111',
+    'V': '101101101101010', 'W': '101101111111101', 'X': '101101010101101',
+    'Y': '101101010010010', 'Z': '111001010100111',
+}
+SCALE = 2                 # pixels per font dot
+ADVANCE = 4 * SCALE       # pixels from one character to the next
+TEXT_HEIGHT = 5 * SCALE
+
+# token -> PNG bytes of the charts rendered by this worker
+rendered = TTLCache(CHART_CACHE_SIZE)
+
+_executor = None
+_executor_pid = None
+_pending = {}
+_lock = threading.Lock()
+
+
+def token(name, months, amounts, allowance):
+    """Returns the chart token for a user and their usage series"""
+    digest = hashlib.sha1()
+    digest.update(repr((name, list(months), list(amounts), allowance)).encode('utf8'))
+    return digest.hexdigest()
+
+
+def _fill(pixels, left, top, right, bottom, color):
+    """Paints the rectangle [left, right) x [top, bottom), clipped"""
+    left, right = max(int(round(left)), 0), min(int(round(right)), WIDTH)
+    top, bottom = max(int(round(top)), 0), min(int(round(bottom)), HEIGHT)
+    if left < right and top < bottom:
+        pixels[top:bottom, left:right] = color
+
+
+def _text(pixels, x, top, text, anchor='start'):
+    """Draws text (upper-cased) with its top at top, starting, centered or
+    ending at x depending on anchor
+    """
+    text = str(text).upper()
+    width = len(text) * ADVANCE - SCALE
+    if anchor == 'middle':
+        x -= width / 2.0
+    elif anchor == 'end':
+        x -= width
+    for index, char in enumerate(text):
+        glyph = FONT.get(char)
+        if glyph is None:
+            continue
+        for dot, on in enumerate(glyph):
+            if on == '1':
+                left = x + index * ADVANCE + dot % 3 * SCALE
+                _fill(pixels, left, top + dot // 3 * SCALE, left + SCALE,
+                      top + (dot // 3 + 1) * SCALE, TEXT_COLOR)
+
+
+def encode_png(pixels):
+    """Takes a HEIGHT x WIDTH x 3 uint8 array
+
+    Returns it as PNG bytes (8-bit RGB, no filtering)
+    """
+    import numpy as np  # imported on first use, see warmup.py
+    height, width = pixels.shape[:2]
+    rows = np.concatenate([np.zeros((height, 1), np.uint8),
+                           pixels.reshape(height, width * 3)], axis=1)
+
+    def chunk(kind, data):
+        return (struct.pack('>I', len(data)) + kind + data
+                + struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff))
+
+    return (b'\x89PNG\r\n\x1a\n'
+            + chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0))
+            + chunk(b'IDAT', zlib.compress(rows.tobytes(), 6))
+            + chunk(b'IEND', b''))
+
+
+def render_png(months, amounts, allowance=None, unit=USAGE_UNIT):
+    """Takes the months, the usage of each month and the plan allowance
+
+    Returns the bar chart as PNG bytes
+    """
+    import numpy as np  # imported on first use, see warmup.py
+    amounts = [amount if amount is not None else 0.0 for amount in amounts]
+    top = max(amounts + [allowance or 0.0, 1.0]) * 1.1
+    plot_width = WIDTH - 2 * MARGIN
+    plot_height = HEIGHT - 2 * MARGIN
+    step = plot_width / float(max(len(amounts), 1))
+
+    def y(value):
+        return MARGIN + plot_height - value / top * plot_height
+
+    pixels = np.empty((HEIGHT, WIDTH, 3), np.uint8)
+    pixels[:] = BACKGROUND
+    for index, amount in enumerate(amounts):
+        over = allowance is not None and amount > allowance
+        left = MARGIN + index * step + step * 0.1
+        _fill(pixels, left, y(amount), left + max(step * 0.8, 1), MARGIN + plot_height,
+              OVER_COLOR if over else BAR_COLOR)
+    _fill(pixels, MARGIN, MARGIN + plot_height, WIDTH - MARGIN, MARGIN + plot_height + 1,
+          LINE_COLOR)
+    label_every = max(len(months) // 6, 1)
+    for index, month in enumerate(months):
+        if index % label_every == 0:
+            _text(pixels, MARGIN + (index + 0.5) * step, HEIGHT - MARGIN + 6, month,
+                  'middle')
+    if allowance is not None:
+        for left in range(MARGIN, WIDTH - MARGIN, 7):
+            _fill(pixels, left, y(allowance), min(left + 4, WIDTH - MARGIN),
+                  y(allowance) + 1, LINE_COLOR)
+        _text(pixels, WIDTH - MARGIN, y(allowance) - TEXT_HEIGHT - 4,
+              '%g %s' % (allowance, unit), 'end')
+    _text(pixels, MARGIN, MARGIN - TEXT_HEIGHT - 10,
+          '%g %s peak' % (max(amounts + [0.0]), unit))
+    return encode_png(pixels)
+
+
+def _path(chart):
+    return os.path.join(CHART_DIR, chart + EXTENSION)
+
+
+def _render(chart, months, amounts, allowance):
+    """Renders one chart into the memory cache and CHART_DIR"""
+    try:
+        image = render_png(months, amounts, allowance)
+        rendered.set(chart, image, CHART_TTL)
+        if not os.path.isdir(CHART_DIR):
+            os.makedirs(CHART_DIR)
+        handle, temporary = tempfile.mkstemp(dir=CHART_DIR, suffix='.tmp')
+        with os.fdopen(handle, 'wb') as chart_file:
+            chart_file.write(image)
+        os.rename(temporary, _path(chart))
+        if metrics.counter_values('charts_rendered_total').get(None, 0) % PRUNE_EVERY == 0:
+            prune()
+        return image
+    finally:
+        with _lock:
+            _pending.pop(chart, None)
+
+
+def _pool():
+    global _executor, _executor_pid
+    if _executor is None or _executor_pid != os.getpid():
+        _executor = ThreadPoolExecutor(max_workers=CHART_WORKERS)
+        _executor_pid = os.getpid()
+    return _executor
+
+
+def chart_url(name, history):
+    """Takes a user name and their usage_history
+
+    Returns the URL of the user's usage chart, queuing it for rendering
+    unless it is already rendered or on its way; None without usage
+    """
+    months = history.get('months') or []
+    if not months:
+        return None
+    amounts = history.get('amounts') or []
+    allowance = history.get('allowance')
+    chart = token(name, months, amounts, allowance)
+    found, _ = rendered.get(chart)
+    if not found:
+        with _lock:
+            if chart not in _pending and not os.path.exists(_path(chart)):
+                metrics.inc('charts_rendered_total')
+                _pending[chart] = _pool().submit(_render, chart, list(months),
+                                                 list(amounts), allowance)
+    return '%s/charts/%s%s' % (CHART_BASE_URL.rstrip('/'), chart, EXTENSION)
+
+
+def load(chart):
+    """Takes a chart token
+
+    Returns the chart's PNG bytes, waiting up to CHART_WAIT seconds for one
+    that is still rendering; None for an unknown or expired chart
+    """
+    if len(chart) != 40 or chart.strip('0123456789abcdef'):
+        return None
+    found, image = rendered.get(chart)
+    if found:
+        return image
+    with _lock:
+        future = _pending.get(chart)
+    if future is not None:
+        try:
+            return future.result(CHART_WAIT)
+        except Exception as error:
+            log.warning('chart %s not ready: %s', chart, error)
+            return None
+    try:
+        with open(_path(chart), 'rb') as chart_file:
+            image = chart_file.read()
+    except (IOError, OSError):
+        return None
+    rendered.set(chart, image, CHART_TTL)
+    return image
+
+
+def prune(max_age=CHART_TTL):
+    """Deletes chart files older than max_age seconds from CHART_DIR
+
+    Returns the number of files deleted
+    """
+    if not os.path.isdir(CHART_DIR):
+        return 0
+    cutoff = time.time() - max_age
+    deleted = 0
+    for filename in os.listdir(CHART_DIR):
+        path = os.path.join(CHART_DIR, filename)
+        try:
+            if os.path.getmtime(path) < cutoff:
+                os.remove(path)
+                deleted += 1
+        except OSError:
+            pass
+    return deleted
@@ -25,6 +25,125 @@ a valid WWO API key for retrieving weather up to 14 days in the future. Get an
 WWO API key here: https://developer.worldweatheronline.com/api/
 """
 
+import os
+
 NEO4J_URL = 'bolt://localhost'
 USERNAME = "neo4j"
 PASSWORD=" "
+
+# Connection pool for the process-wide neo4j driver (see driver.py)
+NEO4J_MAX_POOL_SIZE = 50            # connections per worker process
+NEO4J_ACQUISITION_TIMEOUT = 5.0     # seconds to wait for a free connection
+NEO4J_MAX_CONNECTION_LIFETIME = 3600  # seconds before a connection is recycled
+NEO4J_CONNECTION_TIMEOUT = 5.0      # seconds to establish a new connection
+
+# In-process cache of graph lookups (see cache.py and get_response.py)
+CACHE_MAX_ENTRIES = 10000
+CACHE_PLAN_TTL = 3600   # seconds; plan catalog and upgrade chain
+CACHE_USER_TTL = 300    # seconds; a user's subscription, bills and usage
+CACHE_SESSION_TTL = 1200  # seconds; a Dialogflow session's user snapshot
+
+# Async (ASGI) entry point, see asgi.py
+ASYNC_WORKER_THREADS = 32   # threads running blocking neo4j work
+ASYNC_MAX_PENDING = 256     # requests admitted to the thread pool at once
+ASYNC_QUEUE_TIMEOUT = 0.5   # seconds to wait for admission before answering busy
+
+# Concurrent identical read queries share one execution (see graph.py)
+GRAPH_COALESCE = True
+
+# Circuit breaker around neo4j, see breaker.py
+BREAKER_FAILURES = 5        # consecutive failed or slow queries that open it
+BREAKER_SLOW_QUERY = 2.0    # seconds; a slower query counts as failed
+BREAKER_RESET = 10.0        # seconds open before a probe query is let through
+BREAKER_STALE_TTL = 86400   # seconds the last known lookups are kept for it
+
+# Customer name resolution, see names.py
+NAMES_MIN_CONFIDENCE = 0.8  # below it the user picks from a "did you mean" card
+NAMES_CANDIDATES = 3        # names offered on that card
+NAMES_REFRESH = 300         # seconds between reloads of the user names
+
+# On-demand request profiling, see profiling.py
+PROFILE_HEADER = 'X-Profile'  # profiles the request when it carries PROFILE_TOKEN
+PROFILE_TOKEN = ''            # also guards /admin/profiles; empty turns both off
+PROFILE_SAMPLE_RATE = 0.0     # share of all requests profiled
+PROFILE_BUFFER = 50           # traces kept per worker
+PROFILE_TOP = 40              # functions listed in a trace's text profile
+
+# Time budget for one webhook call; Dialogflow gives up after about 5 seconds
+WEBHOOK_BUDGET = 4.0  # seconds
+
+# Structured request logging, see logs.py
+LOG_SAMPLE_RATE = 0.1        # share of successful requests that are logged
+LOG_DEBUG_PAYLOADS = False   # dump Dialogflow parameters and query results
+LOG_QUEUE_SIZE = 10000       # log records buffered before dropping
+
+# Usage analysis, see analytics.py
+USAGE_PROPERTY = 'usage'            # amount used, on the monthly usage nodes
+PLAN_ALLOWANCE_PROPERTY = 'data'    # monthly allowance, on Plan nodes
+USAGE_UNIT = 'GB'
+
+# Plan recommendation, see recommend.py
+PLAN_OVERAGE_PROPERTY = 'overage_fee'  # price per unit over the allowance
+DEFAULT_OVERAGE_PRICE = 10.0           # used when a plan has no overage price
+RECOMMENDATION_COUNT = 2               # plans shown by the recommendation
+
+# Records per chunk when streaming long query results (see results.py)
+RESULT_FETCH_SIZE = 1000
+
+# Batch fulfillment for outbound campaigns, see batch.py
+BATCH_CHUNK_SIZE = 500    # users per UNWIND query
+BATCH_PARALLELISM = 4     # chunks queried at the same time
+
+# Graph backends, see backends.py
+GRAPH_BACKEND = 'neo4j'                 # per-user lookups: 'neo4j' or 'memory'
+PLAN_BACKEND = 'neo4j'                  # the plan catalog: 'neo4j' or 'memory'
+GRAPH_SNAPSHOT_FILE = 'graph.json'      # loaded by the memory backend
+
+# Response rendering, see render.py
+RENDER_CACHE_SIZE = 1000  # plan card templates kept
+
+# Action routing, see actions.py
+ACTION_CONCURRENCY = {}     # action -> requests served at once, e.g. {'analyze_usage': 8}
+ACTION_QUEUE_TIMEOUT = 0.5  # seconds to wait for a slot before answering busy
+
+# Conversation state across turns, see conversation.py; kept for CACHE_SESSION_TTL
+CONVERSATION_BACKEND = 'memory'        # 'memory' (per worker) or 'socket' (per host)
+CONVERSATION_MAX_ENTRIES = 10000       # conversations kept per store
+# The socket lives in a directory only the webhook's user may enter (0700)
+CONVERSATION_SOCKET_DIR = os.path.join(os.environ.get('XDG_RUNTIME_DIR')
+                                       or os.path.expanduser('~'), '.dialogflow_neo4j')
+CONVERSATION_SOCKET = os.path.join(CONVERSATION_SOCKET_DIR, 'conversations.sock')
+# Secret shared by the store and the workers, one per deployment; the socket
+# backend refuses to run without it
+CONVERSATION_AUTHKEY = os.environ.get('CONVERSATION_AUTHKEY', '').encode('utf8') or None
+
+# Usage charts of the analyze_usage card, see charts.py
+CHARTS_ENABLED = True
+CHART_BASE_URL = 'http://localhost:5000'  # public URL of this webhook
+CHART_DIR = '/tmp/dialogflow_neo4j_charts'  # shared by the workers of a host
+CHART_TTL = 86400         # seconds a rendered chart is kept
+CHART_CACHE_SIZE = 1000   # charts kept in memory per worker
+CHART_WORKERS = 2         # threads rendering charts
+CHART_WAIT = 2.0          # seconds an image request waits for its chart
+
+# Billing period of the recharge action; None derives it (YYYY-MM) from the
+# request's date parameter or today.  Set '2019-01' for the demo graph.
+BILL_MONTH = None
+
+# Neo4j schema, see schema.py
+SCHEMA_ON_STARTUP = True    # create missing indexes when gunicorn starts
+SCHEMA_INDEX_TIMEOUT = 300  # seconds to wait for new indexes to come online
+SCHEMA_MAX_DB_HITS = 1000   # db hits above which `schema.py check --profile` complains
+
+# Worker warm-up before /ready reports ready, see warmup.py
+WARMUP_ON_START = True
+WARMUP_USER = ''          # user whose lookups prime the query plans
+WARMUP_CONNECTIONS = 4    # pooled neo4j connections opened ahead of time
+WARMUP_RETRY = 5.0        # seconds between failed warm-ups
+
+# Recharge and plan change writes, see writer.py
+WRITER_BATCH_SIZE = 100       # events committed per transaction
+WRITER_FLUSH_INTERVAL = 0.05  # seconds to collect a batch after its first event
+WRITER_QUEUE_SIZE = 10000     # events queued before new ones are dropped
+WRITER_RETRIES = 3            # retries of a failed batch
+WRITER_TX_TIMEOUT = 10.0      # seconds per write transaction
@@ -0,0 +1,252 @@
+# -*- coding:utf8 -*-
+"""Module that keeps conversation state across the turns of a session
+
+The state of a conversation is keyed by its Dialogflow session id and holds
+the resolved customer name and the lookups fetched for them so far (see
+CONVERSATION_KINDS), so later turns neither re-read the output contexts nor
+query the graph again.  The lookups that depend on the billing period
+(PERIOD_KINDS) are only reused by turns about the same period.  Entries expire CACHE_SESSION_TTL seconds after the
+last turn that updated them.
+
+CONVERSATION_BACKEND picks where the state lives:
+
+    memory  a dict in each worker process; fastest, but a conversation whose
+            turns land on different workers fetches once per worker
+    socket  one store shared by every worker on the host, served over a
+            local socket by
+
+                python conversation.py serve
+
+The store speaks pickle, so whoever can connect to it can run code in the
+workers: the socket lives in a 0700 directory (CONVERSATION_SOCKET_DIR) and
+both sides need the per-deployment secret from the CONVERSATION_AUTHKEY
+environment variable, without which the socket backend does not start.
+
+The state is only a cache: when the socket store cannot be reached, rejects
+the authkey or fails on its side, a turn runs as if the conversation were
+new.
+"""
+
+import argparse
+import logging
+import os
+import threading
+
+from cache import TTLCache
+from config import (CONVERSATION_BACKEND, CONVERSATION_MAX_ENTRIES,
+                    CONVERSATION_SOCKET, CONVERSATION_AUTHKEY, CACHE_SESSION_TTL)
+
+log = logging.getLogger(__name__)
+
+# The Check_Bill lookups kept in a conversation's state; the plan catalog is
+# shared by every user and stays in get_response.query_cache
+CONVERSATION_KINDS = ('snapshot', 'current_plan', 'upgrade_path',
+                      'latest_bill', 'usage_history')
+
+# The kinds whose result depends on the billing period of the turn
+PERIOD_KINDS = ('snapshot', 'latest_bill')
+
+
+def period_free(results):
+    """Takes the results of a state kept for another billing period
+
+    Returns them without the PERIOD_KINDS
+    """
+    return dict((kind, result) for kind, result in results.items()
+                if kind not in PERIOD_KINDS)
+
+
+class MemoryStore(TTLCache):
+    """Conversation states of this process, keyed by session id"""
+
+    def get_state(self, session):
+        """Returns a copy of the session's state, or None"""
+        found, state = self.get(session)
+        if not found:
+            return None
+        return {'name': state['name'], 'period': state['period'],
+                'results': dict(state['results'])}
+
+    def update_state(self, session, name, period, results):
+        """Merges results into the session's state for the customer name and
+        billing period; a state kept for another name is replaced, and one
+        kept for another period loses its PERIOD_KINDS
+        """
+        with self.lock:
+            entry = self.entries.get(session)
+        if entry is None or entry[1]['name'] != name:
+            merged = dict(results)
+        elif entry[1]['period'] != period:
+            merged = dict(period_free(entry[1]['results']), **results)
+        else:
+            merged = dict(entry[1]['results'], **results)
+        self.set(session, {'name': name, 'period': period, 'results': merged},
+                 CACHE_SESSION_TTL)
+
+    def forget_user(self, name):
+        """Drops the state of every conversation with the customer, e.g.
+        after their plan or bills changed
+        """
+        with self.lock:
+            for session in [session for session, (_, state) in self.entries.items()
+                            if state['name'] == name]:
+                del self.entries[session]
+
+    def drop(self, session):
+        self.invalidate(lambda key: key == session)
+
+
+def _portable(value):
+    """Converts neo4j nodes (anything with items()) to dicts, recursively,
+    so a state can be pickled to the socket store
+    """
+    if isinstance(value, dict) or hasattr(value, 'items'):
+        return dict((key, _portable(item)) for key, item in value.items())
+    if isinstance(value, (list, tuple)):
+        return [_portable(item) for item in value]
+    return value
+
+
+_StoreManager = None
+
+
+def _store_manager():
+    """Returns the BaseManager class that serves the store over the socket;
+    multiprocessing.managers is only imported by the socket backend
+    """
+    global _StoreManager
+    if _StoreManager is None:
+        from multiprocessing.managers import BaseManager
+
+        class StoreManager(BaseManager):
+            pass
+
+        StoreManager.register('store')
+        _StoreManager = StoreManager
+    return _StoreManager
+
+
+class SocketStore(object):
+    """A client of the MemoryStore served by `python conversation.py serve`
+
+    Connects lazily once per process and reconnects after an error.
+    """
+
+    def __init__(self, address=CONVERSATION_SOCKET, authkey=CONVERSATION_AUTHKEY):
+        _check_authkey(authkey)
+        self.address = address
+        self.authkey = authkey
+        self.lock = threading.Lock()
+        self.proxy = None
+        self.pid = None
+
+    def _store(self):
+        with self.lock:
+            if self.proxy is None or self.pid != os.getpid():
+                manager = _store_manager()(address=self.address, authkey=self.authkey)
+                manager.connect()
+                self.proxy = manager.store()
+                self.pid = os.getpid()
+            return self.proxy
+
+    def _call(self, method, *args):
+        """Calls method on the store; any error (unreachable, authkey
+        rejected, or raised by the server and re-raised here, e.g. as
+        RemoteError) is logged and the turn goes on without state
+        """
+        try:
+            return getattr(self._store(), method)(*args)
+        except Exception as error:
+            log.warning('conversation store unavailable: %s', error)
+            with self.lock:
+                self.proxy = None
+            return None
+
+    def get_state(self, session):
+        return self._call('get_state', session)
+
+    def update_state(self, session, name, period, results):
+        self._call('update_state', session, name, period, _portable(results))
+
+    def forget_user(self, name):
+        self._call('forget_user', name)
+
+    def drop(self, session):
+        self._call('drop', session)
+
+
+def _check_authkey(authkey):
+    """raises ValueError unless an authkey is configured"""
+    if not authkey:
+        raise ValueError('the socket conversation store needs the '
+                         'CONVERSATION_AUTHKEY environment variable')
+
+
+def _private_directory(path):
+    """Creates the directory path (if needed) so only this user may enter it
+
+    raises OSError when it exists and belongs to another user
+    """
+    if not os.path.isdir(path):
+        os.makedirs(path, 0o700)
+    if os.stat(path).st_uid != os.getuid():
+        raise OSError('%s belongs to another user' % path)
+    os.chmod(path, 0o700)
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def store():
+    """Returns the conversation store chosen by CONVERSATION_BACKEND"""
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                if CONVERSATION_BACKEND == 'memory':
+                    _store = MemoryStore(CONVERSATION_MAX_ENTRIES)
+                elif CONVERSATION_BACKEND == 'socket':
+                    _store = SocketStore()
+                else:
+                    raise ValueError('unknown conversation backend: %s'
+                                     % CONVERSATION_BACKEND)
+    return _store
+
+
+def serve(address=CONVERSATION_SOCKET, authkey=CONVERSATION_AUTHKEY):
+    """Serves one MemoryStore to every worker on the host until killed
+
+    raises ValueError without an authkey
+    """
+    _check_authkey(authkey)
+    shared = MemoryStore(CONVERSATION_MAX_ENTRIES)
+    _store_manager().register('store', callable=lambda: shared,
+                           exposed=('get_state', 'update_state', 'forget_user',
+                                    'drop', 'stats'))
+    if isinstance(address, str):
+        _private_directory(os.path.dirname(address))
+        if os.path.exists(address):
+            os.unlink(address)
+    manager = _store_manager()(address=address, authkey=authkey)
+    umask = os.umask(0o077)
+    try:
+        server = manager.get_server()
+    finally:
+        os.umask(umask)
+    server.serve_forever()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Shared conversation state store')
+    parser.add_argument('command', choices=['serve'])
+    parser.add_argument('--address', default=CONVERSATION_SOCKET)
+    args = parser.parse_args(argv)
+    try:
+        serve(args.address)
+    except (ValueError, OSError) as error:
+        parser.exit(1, 'conversation store: %s\n' % error)
+
+
+if __name__ == '__main__':
+    main()
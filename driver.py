@@ -0,0 +1,157 @@
+# -*- coding:utf8 -*-
+"""Module that owns the neo4j driver for the worker process
+
+One driver (and so one connection pool) is created lazily per process and
+shared by every request.  Sessions are handed out through the session()
+context manager, which bounds the number of concurrent sessions to the pool
+size and records pool metrics.  The driver is closed on interpreter exit or
+from the gunicorn worker_exit hook in gunicorn.conf.py.
+"""
+
+import atexit
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from neo4j.v1 import GraphDatabase, basic_auth
+from config import (NEO4J_URL, USERNAME, PASSWORD, NEO4J_MAX_POOL_SIZE,
+                    NEO4J_ACQUISITION_TIMEOUT, NEO4J_MAX_CONNECTION_LIFETIME,
+                    NEO4J_CONNECTION_TIMEOUT)
+
+_driver = None
+_driver_pid = None
+_driver_lock = threading.Lock()
+_slots = threading.BoundedSemaphore(NEO4J_MAX_POOL_SIZE)
+
+
+class PoolMetrics(object):
+    """Counters describing how the session pool is being used
+
+    Attributes:
+        in_use (int): sessions currently checked out
+        acquisitions (int): sessions handed out since start
+        waits (int): acquisitions that had to wait for a free slot
+        timeouts (int): acquisitions that gave up after the timeout
+        acquire_seconds_total (float): time spent waiting for a slot
+        acquire_seconds_max (float): slowest single acquisition
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.in_use = 0
+        self.acquisitions = 0
+        self.waits = 0
+        self.timeouts = 0
+        self.acquire_seconds_total = 0.0
+        self.acquire_seconds_max = 0.0
+
+    def snapshot(self):
+        """Returns the current counters as a dict"""
+        with self.lock:
+            mean = (self.acquire_seconds_total / self.acquisitions
+                    if self.acquisitions else 0.0)
+            return {
+                'size': NEO4J_MAX_POOL_SIZE,
+                'in_use': self.in_use,
+                'idle': _idle_connections(),
+                'acquisitions': self.acquisitions,
+                'waits': self.waits,
+                'timeouts': self.timeouts,
+                'acquire_seconds_total': self.acquire_seconds_total,
+                'acquire_seconds_mean': mean,
+                'acquire_seconds_max': self.acquire_seconds_max,
+            }
+
+
+metrics = PoolMetrics()
+
+
+def get_driver():
+    """Returns the driver for this process, creating it on first use
+
+    A driver inherited from a parent process (e.g. gunicorn preload) is not
+    reused since its sockets are shared with the parent.
+    """
+    global _driver, _driver_pid
+    if _driver is not None and _driver_pid == os.getpid():
+        return _driver
+    with _driver_lock:
+        if _driver is None or _driver_pid != os.getpid():
+            _driver = GraphDatabase.driver(
+                NEO4J_URL,
+                auth=basic_auth(USERNAME, PASSWORD),
+                max_connection_pool_size=NEO4J_MAX_POOL_SIZE,
+                connection_acquisition_timeout=NEO4J_ACQUISITION_TIMEOUT,
+                max_connection_lifetime=NEO4J_MAX_CONNECTION_LIFETIME,
+                connection_timeout=NEO4J_CONNECTION_TIMEOUT)
+            _driver_pid = os.getpid()
+    return _driver
+
+
+def close_driver():
+    """Closes the driver of this process and its pooled connections"""
+    global _driver, _driver_pid
+    with _driver_lock:
+        if _driver is not None and _driver_pid == os.getpid():
+            _driver.close()
+        _driver = None
+        _driver_pid = None
+
+
+class PoolTimeout(IOError):
+    """Raised when no connection slot of this worker frees up in time"""
+
+
+@contextmanager
+def session(timeout=None):
+    """Yields a session from the process-wide driver
+
+    raises PoolTimeout (an IOError) when no connection slot frees up within
+    timeout seconds
+    (at most NEO4J_ACQUISITION_TIMEOUT)
+    """
+    if timeout is None or timeout > NEO4J_ACQUISITION_TIMEOUT:
+        timeout = NEO4J_ACQUISITION_TIMEOUT
+    start = time.time()
+    waited = not _slots.acquire(False)
+    if waited and not _slots.acquire(True, max(timeout, 0)):
+        with metrics.lock:
+            metrics.timeouts += 1
+        raise PoolTimeout('timed out waiting for a neo4j connection')
+    elapsed = time.time() - start
+    with metrics.lock:
+        metrics.in_use += 1
+        metrics.acquisitions += 1
+        metrics.waits += waited
+        metrics.acquire_seconds_total += elapsed
+        metrics.acquire_seconds_max = max(metrics.acquire_seconds_max, elapsed)
+    try:
+        with get_driver().session() as graph_session:
+            yield graph_session
+    finally:
+        with metrics.lock:
+            metrics.in_use -= 1
+        _slots.release()
+
+
+def _idle_connections():
+    """Counts pooled connections that are open but not in use
+
+    The count comes from the driver's private pool, so it returns None
+    when there is no driver yet or the installed driver version keeps its
+    pool differently
+    """
+    pool = getattr(_driver, '_pool', None)
+    connections = getattr(pool, 'connections', None)
+    if connections is None or not hasattr(connections, 'get'):
+        return None
+    try:
+        return sum(1 for address in list(connections)
+                   for connection in list(connections.get(address, ()))
+                   if not getattr(connection, 'in_use', False))
+    except TypeError:
+        return None
+
+
+atexit.register(close_driver)
@@ -24,95 +24,266 @@ This sample uses the WWO Weather Forecast API and requires an WWO API key
 Get a WWO API key here: https://developer.worldweatheronline.com/api/
 """
 
+import logging
 import random
+import threading
 from datetime import datetime as dt
 from datetime import timedelta
 
-import requests
-from neo4j.v1 import GraphDatabase, basic_auth
-from config import (NEO4J_URL, USERNAME, PASSWORD)
+import backends
+import breaker
+import charts
+import logs
+import metrics
+import render
+from cache import TTLCache
+from config import (CACHE_MAX_ENTRIES, CACHE_PLAN_TTL, CACHE_USER_TTL,
+                    USAGE_UNIT, RECOMMENDATION_COUNT, BILL_MONTH,
+                    CHARTS_ENABLED, BREAKER_STALE_TTL)
+
+log = logging.getLogger(__name__)
+
+
+# Graph lookups keyed by (query kind, user name)
+query_cache = TTLCache(CACHE_MAX_ENTRIES)
+
+# How long each kind of lookup may be served from query_cache
+QUERY_TTLS = {
+    'current_plan': CACHE_USER_TTL,
+    'upgrade_path': CACHE_PLAN_TTL,
+    'latest_bill': CACHE_USER_TTL,
+    'usage_history': CACHE_USER_TTL,
+    'plan_catalog': CACHE_PLAN_TTL,
+}
+
+# Lookups that are the same for every user and so are cached only once
+SHARED_KINDS = ('plan_catalog',)
+
+# Lookups that depend on the billing period, which is part of their key
+PERIOD_KINDS = ('latest_bill',)
+
+
+# Answer when a write could not be queued; %s is what failed
+WRITE_FAILED_TEXT = "Sorry, I couldn't %s just now. Please try again in a moment."
+
+# Lookups answered by the single user snapshot (see GraphBackend.user_snapshot)
+SNAPSHOT_KINDS = ('current_plan', 'upgrade_path', 'latest_bill')
+
+# The last result of every lookup, served (marked stale) while neo4j is
+# unavailable
+stale_results = TTLCache(CACHE_MAX_ENTRIES)
+
+# key -> (user name, billing period, kind) of the lookups served stale, to be
+# refreshed once neo4j is back
+_stale_keys = {}
+_stale_lock = threading.Lock()
 
-class Check_Bill(object):
-    """The Forecast object implements tracking of and forecast retrieval for
-    a request for a weather forecast.  Several methods return various human
-    readable strings that contain the weather forecast, condition, temperature
-    and the appropriateness of outfits and activities to for forecasted weather
 
-    This requires setting the WWO_API_KEY constant in config.py to a string
-    with a valid WWO API key for retrieving weather forecasts
+def invalidate_user(name):
+    """Forgets every cached lookup for the user, e.g. after a plan change"""
+    query_cache.invalidate(lambda key: key[1] == name)
+
+
+@breaker.neo4j.on_close
+def refresh_stale():
+    """Runs the lookups served stale while neo4j was down again, so the next
+    requests find fresh results in query_cache; stops at the first failure
+    and leaves the rest for the next recovery
+    """
+    with _stale_lock:
+        pending = list(_stale_keys.items())
+        _stale_keys.clear()
+    for index, (key, (name, period, kind)) in enumerate(pending):
+        checkbill = Check_Bill({'given-name': [name]})
+        checkbill.period = period
+        try:
+            getattr(checkbill, kind)
+        except Exception as error:
+            log.warning('refreshing stale lookups failed: %s', error)
+            with _stale_lock:
+                for key, item in pending[index:]:
+                    _stale_keys.setdefault(key, item)
+            return
+    if pending:
+        log.info('refreshed %d stale lookups', len(pending))
+
+
+class Check_Bill(object):
+    """The Check_Bill object answers one Dialogflow request about a user's
+    bill, plans and usage.  The get_*_response methods return the
+    fulfillmentMessages of each action (see actions.py).
+
+    The graph data is read through memoized properties: current_plan,
+    upgrade_path, latest_bill, usage_history, plan_catalog and snapshot.
+    Each runs its query on first access only, and only the properties a
+    handler reads are queried.  Results are shared across requests through
+    query_cache for as long as QUERY_TTLS allows.  Within a Dialogflow
+    session, current_plan, upgrade_path and latest_bill come from a single
+    snapshot query.  While neo4j is unavailable, the last known results are
+    served and stale is set.
 
     Attributes:
-        city (str): the city for the weather forecast
-        datetime_start (datetime.datetime): forecast start date or datetime
-        datetime_end (datetime.datetime): forecast end date or datetime
-        unit (str): the unit of temperature: Celsius ('C') or Fahrenheit ('F')
-        action (dict): any actions in the request (activity, condition, outfit)
-        forecast (dict): structure containing the weather forecast from WWO
+        name (str): the customer name, from the given-name parameter
+        session (str): the Dialogflow session, or None outside a conversation
+        deadline (graph.Deadline): the request's time budget, or None
+        period (str): the billing period, from the date parameter
+        response_id (str): the Dialogflow responseId, used to deduplicate writes
+        plan (str): the plan to switch to, for change_plan
+        stale (bool): whether a result was served from before an outage
     """
 
     def __init__(self, params):
-        """Initializes the Forecast object
+        """Initializes the Check_Bill object
 
-        gets the forecast for the provided dates
+        No query is run here; each handler only pays for the properties it
+        reads (current_plan, upgrade_path, latest_bill, usage_history)
         """
 
         self.name = params['given-name'][0]
-        self.check = self.__check_bill()
+        self.session = params.get('session')
+        self.deadline = params.get('deadline')
+        self.period = billing_period(params.get('date'))
+        self.response_id = params.get('response_id')
+        self.plan = params.get('plan')
+        self.stale = False
+        self.__results = {}
+
+    def __memoize(self, kind, query):
+        """Runs query once per Check_Bill object and remembers its result
+
+        Results are shared across requests through query_cache for as long
+        as QUERY_TTLS allows
+        """
+        if kind not in self.__results:
+            if self.session and kind in SNAPSHOT_KINDS:
+                self.__results[kind] = self.snapshot[kind]
+                return self.__results[kind]
+            key = self.__key(kind)
+            found, result = query_cache.get(key)
+            if not found:
+                result, fresh = self.__fetch(key, kind, query)
+                if fresh:
+                    query_cache.set(key, result, QUERY_TTLS[kind])
+            self.__results[kind] = result
+        return self.__results[kind]
+
+    def __key(self, kind):
+        """Returns the query_cache key of a lookup kind for this user"""
+        key = (kind, None if kind in SHARED_KINDS else self.name)
+        if kind in PERIOD_KINDS:
+            key += (self.period,)
+        return key
+
+    def __fetch(self, key, kind, query):
+        """Runs query, falling back to the last known result for key while
+        neo4j is unavailable (see breaker.UNAVAILABLE); that sets stale and
+        queues the lookup for refresh_stale()
+
+        raises the query's error when there is no result to fall back to
+        Returns the result and whether it is fresh
+        """
+        try:
+            result = query()
+        except breaker.UNAVAILABLE:
+            found, result = stale_results.get(key)
+            if not found:
+                raise
+            self.stale = True
+            metrics.inc('stale_lookups_total', metrics.current_action())
+            with _stale_lock:
+                _stale_keys[key] = (self.name, self.period, kind)
+            return result, False
+        stale_results.set(key, result, BREAKER_STALE_TTL)
+        return result, True
+
+    @property
+    def snapshot(self):
+        """The current plans, upgrade path and latest bills in one dict
+
+        Fetched with a single query once per user per Dialogflow session; the
+        conversation store (see conversation.py) hands it to later turns.
+        Its parts go into query_cache as the SNAPSHOT_KINDS lookups, and a
+        snapshot whose parts are all cached is built from them instead
+        """
+        if 'snapshot' not in self.__results:
+            keys = dict((kind, self.__key(kind)) for kind in SNAPSHOT_KINDS)
+            snapshot = {}
+            for kind, key in keys.items():
+                found, result = query_cache.get(key)
+                if not found:
+                    break
+                snapshot[kind] = result
+            else:
+                self.__results['snapshot'] = snapshot
+                return snapshot
+            key = ('snapshot', self.name, self.period)
+            snapshot, fresh = self.__fetch(key, 'snapshot', self.__user_snapshot)
+            if fresh:
+                for kind, key in keys.items():
+                    query_cache.set(key, snapshot[kind], QUERY_TTLS[kind])
+            self.__results['snapshot'] = snapshot
+        return self.__results['snapshot']
+
+    @property
+    def current_plan(self):
+        """The plans the user subscribes to, queried on first access"""
+        return self.__memoize('current_plan', self.__check_bill)
+
+    @property
+    def upgrade_path(self):
+        """The plans two upgrades up from the current ones, queried on first access"""
+        return self.__memoize('upgrade_path', self.recommendation)
+
+    @property
+    def plan_catalog(self):
+        """The scoring matrix of all plans, shared by every user"""
+        return self.__memoize('plan_catalog', self.plans)
+
+    @property
+    def latest_bill(self):
+        """The user's latest bills, queried on first access"""
+        return self.__memoize('latest_bill', self.recharge)
+
+    @property
+    def usage_history(self):
+        """The user's monthly usage, queried on first access"""
+        return self.__memoize('usage_history', self.analyze)
 
     def __check_bill(self):
-        """Takes a date or date period and a city
+        """Takes the user name
 
-        raises an exception when dates are outside what can be forecasted
-        Returns the weather for the period and city as a dict
+        Returns the plans the user subscribes to
         """
-        cypher =\
-        '''MATCH((u:User)-[:subscribe]->(p:Plan)<-[:plan]-(dp:Plans))\
-         Where u.name = {name}\
-         RETURN p\
-        '''
-        parameters={'name':self.name}
-        response = self.__call_neo4j_api(cypher, parameters)
-        forecast = response
-
-        return forecast
-
-    def __call_neo4j_api(self, cypher,parameters):
-        """Calls the neo4j driver for query a result
-
-        raises an exception for network errors
-        Returns a dict of the JSON 'data' attribute in the response
+        return backends.user_backend().current_plans(self.name, self.deadline)
+
+    def __user_snapshot(self):
+        """Takes the user name
+
+        Returns the current plans, the two-step upgrade path and the latest
+        bills of the user as a dict keyed by SNAPSHOT_KINDS
         """
-        driver = GraphDatabase.driver(
-            NEO4J_URL,
-            auth=basic_auth(USERNAME, PASSWORD))
-        session = driver.session()
-        response={}
-        results = session.run(cypher,parameters)
+        return backends.user_backend().user_snapshot(self.name, self.period,
+                                                     self.deadline)
 
-        for record in results:
-            res=record.items()
-            for k,v in res:
-                response[k]=v
+    def preload(self, **found):
+        """Seeds query results fetched elsewhere (e.g. by batch.py) by kind,
+        so the get_*_response methods render them without querying
+        """
+        self.__results.update(found)
 
-        return response
+    def fetched(self, kinds):
+        """Returns the results of the kinds fetched or preloaded so far"""
+        return dict((kind, self.__results[kind]) for kind in kinds
+                    if kind in self.__results)
 
     def get_current_response(self):
-        direc = self.check
-        print(direc)
+        direc = self.current_plan
+        logs.debug_payload('current plan', direc)
         text = "Greetings, "+self.name+"! It seems it's time to recharge your plan!\n"
         text_message=self.fb_text(text)
         output=[text_message]
-        for k,v in direc.items():
-            url=v["url"]
-            title= "Your current plan is " + v["name"] +", and the monthly fee is " + v["fee"]
-            button1_text = "Recharge Now"
-            postback1 = None
-            button2_text = "Find a New Plan"
-            postback2=None
-            button3_text = "Analyze my Usage"
-            postback3 =None
-            card_message=self.fb_card(title, url, button1_text, postback1, button2_text, postback2, button3_text, postback3)
-            output.append(card_message)
+        for v in direc:
+            output.append(render.plan_card('current', v, self.__current_card).render())
         # button1_text = "Recharge Now"
         # button2_text = "Find a New Plan"
         # button3_text = "Analyze my Usage"
@@ -120,46 +291,60 @@ class Check_Bill(object):
         # output=[text_message,card_message]
         return output
 
+    @staticmethod
+    def __current_card(v):
+        title= "Your current plan is " + v["name"] +", and the monthly fee is " + v["fee"]
+        buttons = (("Recharge Now", None), ("Find a New Plan", None),
+                   ("Analyze my Usage", None))
+        return render.CardTemplate(v["url"], buttons, title)
+
     def get_recommendation_response(self):
         text = "Based on your historical usage, we recommend you the following plan:\n"
         text_message=self.fb_text(text)
-        plans = self.recommendation()
         output=[text_message]
-        for k,v in plans.items():
-            url=v["url"]
-            title= "Recommended!" + v["name"] +", and the monthly fee is " + v["fee"]
-            button1_text = "Why this plan?"
-            postback1 = "How about " + v["name"]
-            button2_text = "No, I will use my existing plan"
-            postback2="recharge exisiting plan"
-            button3_text = "Talk to an agent"
-            postback3 =None
-            card_message=self.fb_card(title, url, button1_text, postback1, button2_text, postback2, button3_text, postback3)
-            output.append(card_message)
+        history = self.usage_history
+        amounts = history.get('amounts') or []
+        catalog = self.plan_catalog if amounts else None
+        if not catalog:
+            plans = self.upgrade_path
+            for v in plans:
+                output.append(self.__recommendation_card(v, None))
+            return output
+
+        current = catalog.cost_of(history.get('plan'), amounts)
+        for plan, cost in catalog.top_k(amounts, RECOMMENDATION_COUNT,
+                                        exclude=history.get('plan')):
+            saving = current - cost if current is not None else None
+            output.append(self.__recommendation_card(plan, cost, saving))
         return output
 
+    def __recommendation_card(self, v, cost, saving=None):
+        title= "Recommended!" + v["name"] +", and the monthly fee is " + v["fee"]
+        if cost is not None:
+            title += ". For your usage that is about $%.2f a month" % cost
+        if saving is not None and saving > 0:
+            title += ", saving you $%.2f" % saving
+        return render.plan_card('recommendation', v, self.__recommendation_template).render(title)
+
+    @staticmethod
+    def __recommendation_template(v):
+        buttons = (("Why this plan?", "How about " + v["name"]),
+                   ("No, I will use my existing plan", "recharge exisiting plan"),
+                   ("Talk to an agent", None))
+        return render.CardTemplate(v["url"], buttons)
+
     def recommendation(self):
-        """Takes a date or date period and a city
+        """Takes the user name
 
-        raises an exception when dates are outside what can be forecasted
-        Returns the weather for the period and city as a dict
+        Returns the plans one and two upgrades up from the current ones
         """
-        cypher =\
-        '''\
-            MATCH((u:User)-[:subscribe]->(p:Plan)<-[:plan]-(dp:Plans))\
-            Where u.name = {name}\
-            OPTIONAL MATCH((p)-[:upgrade]->(up1)-[:upgrade]->(up2))\
-            RETURN up1 AS rec1, up2 AS rec2
-        '''
-        parameters={'name':self.name}
-        response = self.__call_neo4j_api(cypher,parameters)
-        return response
+        return backends.user_backend().upgrade_path(self.name, self.deadline)
 
     def get_recharge_response(self):
 
         output=[]
-        plan = self.recharge()
-        for k,v in plan.items():
+        plan = self.latest_bill
+        for v in plan:
             text= "Ok, your charge is " + v["fee"]
             text_message=self.fb_text(text)
             output.append(text_message)
@@ -170,98 +355,165 @@ class Check_Bill(object):
         output.append(text_message)
         return output
 
+    def get_confirm_recharge_response(self):
+        bills = self.latest_bill
+        if not bills:
+            text = "I couldn't find a bill to pay for " + self.period + ", " + self.name + "."
+            return [self.fb_text(text)]
+        months = []
+        for v in bills:
+            month = v.get("Month") or self.period
+            if month not in months:
+                months.append(month)
+                if not self.record_recharge(v):
+                    return [self.fb_text(WRITE_FAILED_TEXT % "record your payment")]
+        text = "Done! Your payment of " + ", ".join(v["fee"] for v in bills) + \
+               " is on its way. Anything else I can help you with?"
+        return [self.fb_text(text)]
+
+    def get_change_plan_response(self):
+        catalog = self.plan_catalog
+        if self.plan not in catalog.index:
+            text = "Sorry, I don't know the plan " + self.plan + "."
+            return [self.fb_text(text)]
+        if not self.change_plan(self.plan):
+            return [self.fb_text(WRITE_FAILED_TEXT % "switch your plan")]
+        text = "Done! You are switching to " + self.plan + \
+               ", starting with your next bill."
+        return [self.fb_text(text)]
+
+    def record_recharge(self, bill):
+        """Queues a recharge of bill for writing (see writer.py), keyed by
+        the Dialogflow responseId and the bill's month so a retried request
+        is only charged once per month
+
+        Returns False when the recharge could not be queued, e.g. for a
+        request without a responseId
+        """
+        import writer
+        if not self.response_id:
+            return False
+        month = bill.get('Month') or self.period
+        return writer.submit(writer.event('%s:%s' % (self.response_id, month),
+                                          'recharge', self.name, month=month,
+                                          amount=bill.get('fee')))
+
+    def change_plan(self, plan):
+        """Queues a switch to the plan called plan for writing (see
+        writer.py), keyed by the Dialogflow responseId
+
+        Returns False when the switch could not be queued, e.g. for a
+        request without a responseId
+        """
+        import writer
+        if not self.response_id:
+            return False
+        return writer.submit(writer.event(self.response_id, 'plan_change', self.name,
+                                          plan=plan))
+
     def recharge(self):
-        """Takes a date or date period and a city
+        """Takes the user name
 
-        raises an exception when dates are outside what can be forecasted
-        Returns the weather for the period and city as a dict
+        Returns the user's bills for the billing period
         """
-        cypher =\
-        '''\
-            Match(u:User)-[:Bill]->(b)-[:Month]->(m:Bill{Month:"2019-01"})\
-            Where u.name = {name}\
-            Return m\
-        '''
-        parameters={'name':self.name}
-        response = self.__call_neo4j_api(cypher,parameters)
-        return response
+        return backends.user_backend().bill(self.name, self.period, self.deadline)
 
     def get_analyze_response(self):
-
+        history = self.usage_history
+        months = history.get('months') or []
+        if not months:
+            text = "I couldn't find any usage for you yet, " + self.name + "."
+            return [self.fb_text(text)]
+
+        import analytics  # numpy is imported on first use, see warmup.py
+        stats = analytics.summarize_one(history['amounts'],
+                                        history.get('allowance'))
         output=[]
-        historical_data = self.analyze()
-        hist_fig=generate_figure(historical_data)
+        text = "Over the last %d months you used %.1f %s a month on average, " \
+               "peaking at %.1f %s in %s." % (
+                   stats['months'], stats['average'], USAGE_UNIT,
+                   stats['peak'], USAGE_UNIT, months[stats['peak_index']])
+        output.append(self.fb_text(text))
+
+        if stats['trend'] > 0:
+            text = "Your usage is growing by about %.1f %s every month." % (
+                stats['trend'], USAGE_UNIT)
+        else:
+            text = "Your usage is steady or going down (%.1f %s a month)." % (
+                stats['trend'], USAGE_UNIT)
+        output.append(self.fb_text(text))
+
+        if history.get('allowance') is None:
+            title = "I don't know your plan's allowance, so I can't tell whether " \
+                    "you went over it. 90%% of your months stay under %.1f %s." % (
+                        stats['p90'], USAGE_UNIT)
+        elif stats['over_months']:
+            title = "You went over your plan in %d of %d months, by %.1f %s " \
+                    "on average. 90%% of your months stay under %.1f %s." % (
+                        stats['over_months'], stats['months'],
+                        stats['mean_overage'], USAGE_UNIT,
+                        stats['p90'], USAGE_UNIT)
+        else:
+            title = "You stayed within your plan every month. 90%% of your " \
+                    "months stay under %.1f %s." % (stats['p90'], USAGE_UNIT)
+        button1_text = "Find a New Plan"
+        postback1 = None
+        button2_text = "Recharge Now"
+        postback2 = "recharge exisiting plan"
+        button3_text = "Talk to an agent"
+        postback3 = None
+        url = history.get('url')
+        if CHARTS_ENABLED:
+            url = charts.chart_url(self.name, history) or url
+        card_message=self.fb_card(title, url, button1_text, postback1, button2_text, postback2, button3_text, postback3)
+        output.append(card_message)
+        return output
 
-        for k,v in plan.items():
-            text= "Ok, your charge is " + v["fee"]
-            text_message=self.fb_text(text)
-            output.append(text_message)
+    def plans(self):
+        """Takes no parameters
 
-        text = "I see we have your VISA credit card ending with 9231 in your information. \
-        Should I complete the payment with the same card?\n"
-        text_message=self.fb_text(text)
-        output.append(text_message)
-        return output
+        Returns the whole plan catalog as a recommend.PlanCatalog
+        """
+        import recommend  # numpy is imported on first use, see warmup.py
+        return recommend.PlanCatalog(backends.plan_backend().plan_catalog(self.deadline))
 
     def analyze(self):
-        """Takes a date or date period and a city
+        """Takes the user name
 
-        raises an exception when dates are outside what can be forecasted
-        Returns the weather for the period and city as a dict
+        Returns the user's monthly usage as a dict with the months in order,
+        the matching usage amounts, and the allowance, image url and name of
+        the current plan
         """
-        cypher =\
-        '''\
-            Match(u:User)-[:usage]->(b)-[:Month]->(m)\
-            Where u.name = {name}\
-            Return m\
-        '''
-        parameters={'name':self.name}
-        response = self.__call_neo4j_api(cypher,parameters)
-        return response
-
-    def fb_text(self, text):
-        text_message={
-          "text": {
-            "text": [
-              text
-            ]
-          },
-          "platform": "FACEBOOK"
-        }
-        return text_message
-
-    def fb_card(self,title, url, button1_text,postback1, button2_text,postback2, button3_text,postback3):
-
-        if(postback1 is None):
-            postback1=button1_text
-        if(postback2 is None):
-            postback2=button2_text
-        if(postback3 is None):
-            postback3=button3_text
-
-        card_message = {
-                "card": {
-                  "title": title,
-                  "imageUri": url,
-                  "buttons": [
-                    {
-                      "text": button1_text,
-                      "postback": postback1
-                    },
-                    {
-                      "text": button2_text,
-                      "postback": postback2
-                    },
-                    {
-                      "text": button3_text,
-                      "postback": postback3
-                    }
-                  ]
-                },
-                "platform": "FACEBOOK"
-                }
-        return card_message
+        return backends.user_backend().usage_series(self.name, self.deadline)
+
+    @staticmethod
+    @metrics.timed_function('render')
+    def fb_text(text):
+        """Returns a text message (see render.py)"""
+        return render.text(text)
+
+    @staticmethod
+    @metrics.timed_function('render')
+    def fb_card(title, url, button1_text,postback1, button2_text,postback2, button3_text,postback3):
+        """Returns a card message with three buttons (see render.py); a
+        postback of None posts the button text
+        """
+        return render.card(title, url, ((button1_text, postback1),
+                                        (button2_text, postback2),
+                                        (button3_text, postback3)))
+
+def billing_period(date=None):
+    """Takes a datetime.date, or None for today
+
+    Returns the billing period (Bill.Month, "YYYY-MM") of that date, or
+    BILL_MONTH when it is set
+    """
+    if BILL_MONTH:
+        return BILL_MONTH
+    return (date or dt.now().date()).strftime('%Y-%m')
+
 
+@metrics.timed_function('validate')
 def validate_params(parameters):
     """Takes a list of parameters from a HTTP request and validates them
 
@@ -285,5 +537,19 @@ def validate_params(parameters):
         params['given-name'] = None
         #error_response += 'please specify whose bill '
 
+    # Plan to switch to; a list when the entity allows several values
+    plan = parameters.get('plan')
+    if isinstance(plan, list):
+        plan = plan[0] if plan else None
+    if plan:
+        params['plan'] = plan
+
+    # Date (e.g. "2019-01-15T12:00:00+05:30" from @sys.date)
+    params['date'] = None
+    if parameters.get('date'):
+        try:
+            params['date'] = dt.strptime(parameters.get('date')[:10], '%Y-%m-%d').date()
+        except (TypeError, ValueError):
+            error_response += 'please specify a valid date '
 
     return error_response.strip(), params
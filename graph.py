@@ -0,0 +1,221 @@
+# -*- coding:utf8 -*-
+"""Module that runs read queries on the pooled neo4j driver
+
+Every query of a webhook call carries the call's Deadline; the time left is
+handed to neo4j as the transaction timeout so a slow query cannot outlive
+the request.  run_query() materializes a whole result, stream_query() hands
+out long results chunk by chunk.
+
+Concurrent run_query() calls with the same Cypher, parameters and shape are
+coalesced: the first one runs the query and the others wait for its result,
+so a retried webhook or a double-tapped card button costs neo4j one query.
+This holds in the async app as well, whose handlers run on executor threads.
+Results are shared between the callers and must not be modified.
+
+Every execution goes through the neo4j circuit breaker (see breaker.py), so
+while neo4j is down run_query() raises CircuitOpen right away.  A socket
+error on the Bolt connection is raised as ServiceUnavailable, one of the
+breaker.UNAVAILABLE errors the handlers answer without a 500.
+
+The queries of a request that is being profiled (see profiling.py) run with
+PROFILE, on their own rather than coalesced, and their plans are added to
+the request's trace.
+"""
+
+import socket
+import threading
+import time
+
+from neo4j.exceptions import ServiceUnavailable
+
+import breaker
+import driver
+import metrics
+import profiling
+import results
+from config import RESULT_FETCH_SIZE, GRAPH_COALESCE
+
+
+class DeadlineExceeded(Exception):
+    """Raised when a request runs out of its time budget"""
+
+
+class Deadline(object):
+    """The point in time by which a webhook call has to be answered
+
+    Attributes:
+        expires (float): the deadline as a time.time() timestamp
+    """
+
+    def __init__(self, budget):
+        self.expires = time.time() + budget
+
+    def remaining(self):
+        """Returns the seconds left before the deadline, never negative"""
+        return max(self.expires - time.time(), 0.0)
+
+    def expired(self):
+        return time.time() >= self.expires
+
+
+class _Call(object):
+    """A query in flight and, once done, its result or error"""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.waiters = 0
+
+
+class SingleFlight(object):
+    """Shares one execution among concurrent calls with the same key
+
+    Attributes:
+        calls (dict): key -> _Call of the executions in flight
+        executed (int): calls that ran the function
+        coalesced (int): calls that got the result of another call
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+        self.executed = 0
+        self.coalesced = 0
+
+    def do(self, key, function, timeout=None):
+        """Runs function, or waits up to timeout seconds for the call with
+        the same key already running it
+
+        raises the error of the shared execution, and DeadlineExceeded when
+        the wait times out
+        Returns the function's result
+        """
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = _Call()
+                self.executed += 1
+            else:
+                call.waiters += 1
+                self.coalesced += 1
+        if leader:
+            try:
+                call.result = function()
+            except BaseException as error:
+                call.error = error
+                raise
+            finally:
+                with self.lock:
+                    del self.calls[key]
+                call.done.set()
+            return call.result
+
+        metrics.inc('graph_queries_coalesced_total', metrics.current_action())
+        start = time.perf_counter()
+        finished = call.done.wait(timeout)
+        metrics.record('coalesced', time.perf_counter() - start)
+        if not finished:
+            raise DeadlineExceeded('gave up waiting for a coalesced neo4j query')
+        if call.error is not None:
+            raise call.error
+        return call.result
+
+    def stats(self):
+        with self.lock:
+            return {'executed': self.executed, 'coalesced': self.coalesced,
+                    'in_flight': len(self.calls)}
+
+
+flights = SingleFlight()
+
+
+def _freeze(value):
+    """Returns a hashable stand-in for query parameters"""
+    if isinstance(value, dict):
+        return tuple(sorted((key, _freeze(item)) for key, item in value.items()))
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(item) for item in value)
+    if isinstance(value, set):
+        return frozenset(_freeze(item) for item in value)
+    return value
+
+
+def run_query(cypher, parameters, shape='rows', deadline=None):
+    """Runs a read query on the pooled driver
+
+    The time left until deadline (if any) is handed to neo4j as the
+    transaction timeout; a call made while an identical query is in flight
+    waits for that query's result instead (see SingleFlight)
+    raises an exception for network errors and DeadlineExceeded when the
+    deadline passes before or while the query runs, CircuitOpen while the
+    neo4j breaker is open
+    Returns every record, as a list of rows or a dict of columns depending
+    on shape (see results.py)
+    """
+    if deadline is not None and deadline.expired():
+        raise DeadlineExceeded('no time left to query neo4j')
+    trace = profiling.current()
+    if trace is not None:
+        return _execute(cypher, parameters, shape, deadline, trace)
+    if not GRAPH_COALESCE:
+        return _execute(cypher, parameters, shape, deadline)
+    try:
+        key = (cypher, shape, _freeze(parameters))
+        hash(key)
+    except TypeError:
+        return _execute(cypher, parameters, shape, deadline)
+    return flights.do(key, lambda: _execute(cypher, parameters, shape, deadline),
+                      deadline.remaining() if deadline is not None else None)
+
+
+def _execute(cypher, parameters, shape, deadline, trace=None):
+    return breaker.neo4j.call(_transaction, cypher, parameters, shape, deadline,
+                              trace, timed=deadline is not None)
+
+
+def _transaction(cypher, parameters, shape, deadline, trace=None):
+    timeout = None
+    if deadline is not None:
+        if deadline.expired():
+            raise DeadlineExceeded('no time left to query neo4j')
+        timeout = deadline.remaining()
+
+    try:
+        start = time.perf_counter()
+        with driver.session(timeout) as session:
+            with session.begin_transaction(timeout=timeout) as tx:
+                started = time.perf_counter()
+                metrics.record('acquire', started - start)
+                result = tx.run(cypher if trace is None else 'PROFILE ' + cypher,
+                                parameters)
+                result.keys()
+                executed = time.perf_counter()
+                metrics.record('execute', executed - started)
+
+                response = results.SHAPES[shape](result)
+                metrics.record('materialize', time.perf_counter() - executed)
+                if trace is not None:
+                    trace.query(cypher, parameters, result,
+                                time.perf_counter() - started)
+    except Exception as error:
+        if deadline is not None and deadline.expired():
+            raise DeadlineExceeded('neo4j query ran past the deadline') from error
+        if isinstance(error, socket.error) and not isinstance(error, driver.PoolTimeout):
+            raise ServiceUnavailable('lost the connection to neo4j: %s' % error) from error
+        raise
+
+    return response
+
+
+def stream_query(cypher, parameters, fetch_size=RESULT_FETCH_SIZE):
+    """Runs a read query and yields its records in lists of fetch_size rows
+
+    Records are read from neo4j as the chunks are consumed; the session is
+    held until the generator is exhausted or closed
+    """
+    with driver.session() as session:
+        with session.begin_transaction() as tx:
+            for chunk in results.chunks(tx.run(cypher, parameters), fetch_size):
+                yield chunk
@@ -0,0 +1,41 @@
+# -*- coding:utf8 -*-
+"""gunicorn settings for the webhook
+
+Run with: gunicorn -c gunicorn.conf.py main:app
+"""
+
+bind = '0.0.0.0:8000'
+workers = 4
+
+
+def worker_exit(server, worker):
+    """Closes the neo4j driver so pooled connections are released cleanly"""
+    import driver
+    driver.close_driver()
+
+
+def on_starting(server):
+    """Checks the conversation store settings and creates the neo4j indexes
+    the lookups need before workers start
+    """
+    import conversation
+    conversation.store()
+    from config import SCHEMA_ON_STARTUP
+    if not SCHEMA_ON_STARTUP:
+        return
+    import driver
+    import schema
+    try:
+        schema.ensure_schema()
+    except Exception as error:
+        server.log.error('schema check failed: %s', error)
+    finally:
+        driver.close_driver()
+
+
+def post_fork(server, worker):
+    """Warms the new worker up in the background; see /ready"""
+    from config import WARMUP_ON_START
+    if WARMUP_ON_START:
+        import warmup
+        warmup.start()
@@ -0,0 +1,130 @@
+# -*- coding:utf8 -*-
+"""Module that writes structured request logs off the request path
+
+Every webhook call produces at most one JSON line (action, user, stage
+timings and outcome).  Successful calls are sampled with LOG_SAMPLE_RATE;
+failures are always kept.  Records are handed to a bounded queue and
+formatted and written to stdout by a background listener thread, so a
+request never waits on stdout.  When the queue is full records are dropped
+and counted rather than blocking.
+
+Payload dumps (Dialogflow parameters, query results) are only produced when
+LOG_DEBUG_PAYLOADS is switched on in config.py.
+"""
+
+import atexit
+import json
+import logging
+import os
+import queue
+import random
+import sys
+import threading
+import time
+from logging.handlers import QueueHandler, QueueListener
+
+from config import LOG_SAMPLE_RATE, LOG_DEBUG_PAYLOADS, LOG_QUEUE_SIZE
+
+logger = logging.getLogger('webhook.requests')
+logger.propagate = False
+logger.setLevel(logging.DEBUG)
+
+_listener = None
+_listener_pid = None
+_listener_lock = threading.Lock()
+
+
+class JsonFormatter(logging.Formatter):
+    """Formats a record's fields (or its message) as one JSON line"""
+
+    def format(self, record):
+        fields = getattr(record, 'fields', None)
+        if fields is None:
+            fields = {'level': record.levelname, 'message': record.getMessage()}
+        return json.dumps(fields, default=str, separators=(',', ':'))
+
+
+class DroppingQueueHandler(QueueHandler):
+    """Queue handler that never blocks and never formats in the caller
+
+    Attributes:
+        dropped (int): records discarded because the queue was full
+    """
+
+    def __init__(self, log_queue):
+        QueueHandler.__init__(self, log_queue)
+        self.dropped = 0
+        self.dropped_lock = threading.Lock()
+
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            with self.dropped_lock:
+                self.dropped += 1
+
+
+handler = DroppingQueueHandler(queue.Queue(LOG_QUEUE_SIZE))
+logger.addHandler(handler)
+
+
+def _ensure_listener():
+    """Starts the writer thread of this process on first use"""
+    global _listener, _listener_pid
+    if _listener_pid == os.getpid():
+        return
+    with _listener_lock:
+        if _listener_pid != os.getpid():
+            stream = logging.StreamHandler(sys.stdout)
+            stream.setFormatter(JsonFormatter())
+            _listener = QueueListener(handler.queue, stream)
+            _listener.start()
+            _listener_pid = os.getpid()
+
+
+def _stop_listener():
+    if _listener is not None and _listener_pid == os.getpid():
+        _listener.stop()
+
+
+def log_request(action, user, stages, outcome):
+    """Queues the summary line of one webhook call
+
+    Takes the action, the resolved user name (or None), the stage timings
+    in seconds and the outcome ('ok', 'deadline', 'error', ...)
+    """
+    if outcome == 'ok' and random.random() >= LOG_SAMPLE_RATE:
+        return
+    _ensure_listener()
+    fields = {
+        'ts': time.time(),
+        'action': action,
+        'user': user,
+        'outcome': outcome,
+        'ms': dict((stage, round(seconds * 1000, 3))
+                   for stage, seconds in stages.items()),
+    }
+    level = logging.INFO if outcome == 'ok' else logging.WARNING
+    logger.log(level, 'request', extra={'fields': fields})
+
+
+def debug_payload(label, payload):
+    """Queues a dump of payload when LOG_DEBUG_PAYLOADS is on
+
+    The payload is serialized right away since callers keep mutating it
+    """
+    if not LOG_DEBUG_PAYLOADS:
+        return
+    _ensure_listener()
+    fields = {
+        'ts': time.time(),
+        'debug': label,
+        'payload': json.loads(json.dumps(payload, default=str)),
+    }
+    logger.debug('payload', extra={'fields': fields})
+
+
+atexit.register(_stop_listener)
@@ -22,15 +22,29 @@ This sample uses the neo4j api and requires an WWO API key
 
 """
 
-import json
-
-from flask import Flask, request, make_response, jsonify
-
-from get_response import Check_Bill, validate_params
+import time
+
+from flask import Flask, Response, request, make_response, jsonify
+
+import actions
+import breaker
+import charts
+import driver
+import graph
+import logs
+import metrics
+import names
+import profiling
+import render
+import warmup
+from get_response import Check_Bill, query_cache
+from graph import Deadline, DeadlineExceeded
+from config import WEBHOOK_BUDGET, PROFILE_HEADER
 
 app = Flask(__name__)
 log = app.logger
-customer_name=""
+
+DEADLINE_TEXT = "Sorry, that is taking longer than expected. Please ask me again in a moment."
 
 @app.route('/', methods=['POST'])
 def webhook():
@@ -38,157 +52,169 @@ def webhook():
 
     This is meant to be used in conjunction with the weather Dialogflow agent
     """
+    start = time.perf_counter()
     req = request.get_json(silent=True, force=True)
+    parsed = time.perf_counter() - start
     try:
         action = req.get('queryResult').get('action')
     except AttributeError:
+        metrics.inc('webhook_json_errors_total')
         return 'json error'
 
-    if action == 'check_bill':
-        res = check_bill(req)
-    elif action == 'recommendation':
-        res = recommendation(req)
-    elif action == 'recharge_exisiting_plan':
-        res = recharge(req)
-    elif action == 'analyze_usage':
-        res = analyze(req)
-    else:
-        log.error('Unexpected action.')
+    handler = actions.lookup(action)
+    action = handler.name
+    profile = profiling.requested(request.headers.get(PROFILE_HEADER))
+    outcome = 'error'
+    current = None
+    try:
+        with metrics.request(action) as current:
+            metrics.record('parse', parsed)
+            deadline = Deadline(WEBHOOK_BUDGET)
+            try:
+                if profile:
+                    res = profiling.profiled(action, handler.fulfill, req, deadline)
+                else:
+                    res = handler.fulfill(req, deadline)
+                outcome = 'ok'
+            except actions.ActionBusy:
+                outcome = 'busy'
+                res = actions.busy_response(action)
+            except DeadlineExceeded:
+                outcome = 'deadline'
+                res = deadline_response(action)
+            except breaker.UNAVAILABLE:
+                outcome = 'unavailable'
+                res = actions.unavailable_response(action)
+            except Exception:
+                metrics.inc('webhook_errors_total', action)
+                raise
+
+            with metrics.timed('render'):
+                response = Response(render.fulfillment(res), mimetype='application/json')
+    finally:
+        logs.log_request(action, request_user(req), current.stages, outcome)
+
+    return response
 
-    print('Action: ' + action)
 
-    return make_response(jsonify({'fulfillmentMessages': res}))
+def request_user(req):
+    """Returns the customer name a Dialogflow request refers to, if any"""
+    names = (req['queryResult'].get('parameters') or {}).get('given-name')
+    if not names:
+        names = actions.context_value(req, 'given-name')
+    return names[0] if names else None
 
 
-def check_bill(req):
-    """Returns a string containing text with a response to the user
-    with his/her billing information
+def deadline_response(action):
+    """Counts a deadline miss for the action
 
-    Takes the city for the forecast and (optional) dates
-    uses the template responses found in weather_responses.py as templates
+    Returns a short but valid fulfillment telling the user to try again
     """
-    parameters = req['queryResult']['parameters']
+    metrics.inc('webhook_deadline_misses_total', action)
+    return [Check_Bill.fb_text(DEADLINE_TEXT)]
 
-    print('Dialogflow Parameters:')
-    print(json.dumps(parameters, indent=4))
 
-    # validate request parameters, return an error if there are issues
-    error, check_bill_params = validate_params(parameters)
-    if error:
-        return error
+@app.route('/charts/<chart>.png', methods=['GET'])
+def chart(chart):
+    """Returns a usage chart linked from an analyze_usage card"""
+    image = charts.load(chart)
+    if image is None:
+        return make_response('not found', 404)
+    return Response(image, mimetype=charts.CONTENT_TYPE,
+                    headers={'Cache-Control': 'public, max-age=86400'})
 
-    if (check_bill_params["given-name"]) is not None:
-        customer_name = check_bill_params["given-name"][0]
-    print("customer name is : " + customer_name)
-    # create a forecast object which retrieves the forecast from a external API
-    try:
-        checkbill = Check_Bill(check_bill_params)
-    # return an error if there is an error getting the forecast
-    except (ValueError, IOError) as error:
-        return error
 
-    # If the user requests a datetime period (a date/time range), get the
-    # response
-    #response="Hello World!"
-    response = checkbill.get_current_response()
+@app.route('/ready', methods=['GET'])
+def ready():
+    """Answers 200 once this worker is warmed up, 503 until then"""
+    return make_response(jsonify(warmup.state.snapshot()),
+                         200 if warmup.state.ready else 503)
 
-    return response
 
-def recommendation(req):
-    """Returns a string containing text with a response to the user
-    with his/her billing information
+@app.route('/admin/profiles', methods=['GET'])
+def profile_list():
+    """Lists the request profiles kept by this worker, newest first"""
+    if not profiling.authorized(request.headers.get(PROFILE_HEADER)):
+        return make_response('not found', 404)
+    return jsonify(profiling.listing())
 
-    Takes the city for the forecast and (optional) dates
-    uses the template responses found in weather_responses.py as templates
-    """
-    parameters = req['queryResult']['parameters']
-
-    print('Dialogflow Parameters:')
-    print(json.dumps(parameters, indent=4))
-    context=req['queryResult']['outputContexts']
-    # validate request parameters, return an error if there are issues
-    error, recommend_params = validate_params(parameters)
-    if error:
-        return error
-    recommend_params["given-name"]=context[0]["parameters"]["given-name"]
-    print(recommend_params)
-    # create a forecast object which retrieves the forecast from a external API
-    try:
-        recommd = Check_Bill(recommend_params)
-    # return an error if there is an error getting the forecast
-    except (ValueError, IOError) as error:
-        return error
-
-    # If the user requests a datetime period (a date/time range), get the
-    # response
-    #response="Hello World!"
-    response = recommd.get_recommendation_response()
-    print(response)
-    return response
 
-def recharge(req):
-    """Returns a string containing text with a response to the user
-    with his/her billing information
+@app.route('/admin/profiles/<int:trace_id>', methods=['GET'])
+def profile_trace(trace_id):
+    """Returns one request profile with its queries' plans as JSON"""
+    trace = profiling.find(trace_id)
+    if trace is None or not profiling.authorized(request.headers.get(PROFILE_HEADER)):
+        return make_response('not found', 404)
+    return jsonify(trace.to_dict())
 
-    Takes the city for the forecast and (optional) dates
-    uses the template responses found in weather_responses.py as templates
-    """
-    parameters = req['queryResult']['parameters']
-
-    print('Dialogflow Parameters:')
-    print(json.dumps(parameters, indent=4))
-    context=req['queryResult']['outputContexts']
-    # validate request parameters, return an error if there are issues
-    error, params = validate_params(parameters)
-    if error:
-        return error
-    params["given-name"]=context[0]["parameters"]["given-name"]
-    print(params)
-    # create a forecast object which retrieves the forecast from a external API
-    try:
-        recharge = Check_Bill(params)
-    # return an error if there is an error getting the forecast
-    except (ValueError, IOError) as error:
-        return error
-
-    # If the user requests a datetime period (a date/time range), get the
-    # response
-    #response="Hello World!"
-    response = recharge.get_recharge_response()
-    print(response)
-    return response
 
-def analyze(req):
-    """Returns a string containing text with a response to the user
-    with his/her billing information
+@app.route('/admin/profiles/<int:trace_id>.prof', methods=['GET'])
+def profile_stats(trace_id):
+    """Returns one request profile as a pstats file"""
+    trace = profiling.find(trace_id)
+    if trace is None or not profiling.authorized(request.headers.get(PROFILE_HEADER)):
+        return make_response('not found', 404)
+    return Response(trace.stats, mimetype='application/octet-stream',
+                    headers={'Content-Disposition':
+                             'attachment; filename=profile-%d.prof' % trace_id})
 
-    Takes the city for the forecast and (optional) dates
-    uses the template responses found in weather_responses.py as templates
+
+# /metrics/<name> -> the function returning those counters of this worker,
+# served as JSON here and by asgi.py
+METRICS_JSON = {
+    'pool': driver.metrics.snapshot,
+    'cache': query_cache.stats,
+    'deadlines': lambda: metrics.counter_values('webhook_deadline_misses_total'),
+}
+PROMETHEUS_CONTENT_TYPE = 'text/plain; version=0.0.4'
+
+
+@app.route('/metrics/pool', methods=['GET'])
+def pool_metrics():
+    """Returns the neo4j connection pool counters of this worker as JSON"""
+    return jsonify(METRICS_JSON['pool']())
+
+
+@app.route('/metrics/cache', methods=['GET'])
+def cache_metrics():
+    """Returns the graph lookup cache counters of this worker as JSON"""
+    return jsonify(METRICS_JSON['cache']())
+
+
+@app.route('/metrics/deadlines', methods=['GET'])
+def deadline_metrics():
+    """Returns the deadline misses per action of this worker as JSON"""
+    return jsonify(METRICS_JSON['deadlines']())
+
+
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    """Returns the latency histograms and counters of this worker in the
+    Prometheus text format, together with the pool and cache counters
     """
-    parameters = req['queryResult']['parameters']
-
-    print('Dialogflow Parameters:')
-    print(json.dumps(parameters, indent=4))
-    context=req['queryResult']['outputContexts']
-    # validate request parameters, return an error if there are issues
-    error, params = validate_params(parameters)
-    if error:
-        return error
-    params["given-name"]=context[0]["parameters"]["given-name"]
-    print(params)
-    # create a forecast object which retrieves the forecast from a external API
-    try:
-        analyze = Check_Bill(params)
-    # return an error if there is an error getting the forecast
-    except (ValueError, IOError) as error:
-        return error
-
-    # If the user requests a datetime period (a date/time range), get the
-    # response
-    #response="Hello World!"
-    response = analyze.get_analyze_response()
-    print(response)
-    return response
+    return make_response(prometheus_text(), 200,
+                         {'Content-Type': PROMETHEUS_CONTENT_TYPE})
+
+
+def prometheus_text():
+    """Returns the body of /metrics (see prometheus_metrics)"""
+    gauges = {}
+    for key, value in driver.metrics.snapshot().items():
+        gauges['neo4j_pool_' + key] = value
+    for key, value in query_cache.stats().items():
+        gauges['query_cache_' + key] = value
+    for key, value in render.plan_templates.stats().items():
+        gauges['plan_card_cache_' + key] = value
+    for key, value in breaker.neo4j.stats().items():
+        gauges['neo4j_breaker_' + key] = value
+    for key, value in names.index.stats().items():
+        gauges['name_index_' + key] = value
+    for key, value in graph.flights.stats().items():
+        gauges['graph_queries_' + key] = value
+    gauges['log_records_dropped'] = logs.handler.dropped
+    return metrics.render(gauges)
+
+
 # def weather_activity(req):
 #     """Returns a string containing text with a response to the user
 #     with a indication if the activity provided is appropriate for the
@@ -310,4 +336,5 @@ def analyze(req):
 
 
 if __name__ == '__main__':
+    warmup.start()
     app.run(debug=True, host='0.0.0.0')
@@ -0,0 +1,185 @@
+# -*- coding:utf8 -*-
+"""Module that records per-stage webhook latency and request counters
+
+A webhook call is wrapped in request(action).  Code on the request path marks
+its stages with timed(stage) (or the timed_function decorator); stage times
+are summed per request and folded into per-(action, stage) histograms once
+the request ends, so the hot path only pays for two clock reads per stage.
+render() returns everything in the Prometheus text exposition format.
+"""
+
+import bisect
+import contextvars
+import functools
+import threading
+import time
+from contextlib import contextmanager
+
+# Upper bounds (seconds) of the latency histogram buckets
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+           1.0, 2.5, 5.0)
+
+_lock = threading.Lock()
+_histograms = {}
+_counters = {}
+_current = contextvars.ContextVar('webhook_request', default=None)
+
+
+class _Histogram(object):
+    """Cumulative-bucket latency histogram for one (action, stage)"""
+
+    __slots__ = ('counts', 'sum', 'count')
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(BUCKETS, seconds)] += 1
+        self.sum += seconds
+        self.count += 1
+
+
+class _Request(object):
+    """Stage times collected while serving one webhook call
+
+    Work abandoned after a deadline may still run on an executor thread and
+    record stages; once the request has ended its stages no longer change.
+    """
+
+    __slots__ = ('action', 'stages', 'ended', 'lock')
+
+    def __init__(self, action):
+        self.action = action
+        self.stages = {}
+        self.ended = False
+        self.lock = threading.Lock()
+
+    def add(self, stage, seconds):
+        with self.lock:
+            if not self.ended:
+                self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+
+    def end(self):
+        """Stops recording; returns a copy of the stages"""
+        with self.lock:
+            self.ended = True
+            return dict(self.stages)
+
+
+def current_action():
+    """Returns the action of the request being served, if any"""
+    current = _current.get()
+    return current.action if current is not None else None
+
+
+@contextmanager
+def request(action):
+    """Times a whole webhook call for action
+
+    Stage times recorded inside are kept under the same action and the
+    total is recorded as the 'total' stage
+    """
+    current = _Request(action)
+    token = _current.set(current)
+    start = time.perf_counter()
+    try:
+        yield current
+    finally:
+        current.add('total', time.perf_counter() - start)
+        stages = current.end()
+        _current.reset(token)
+        with _lock:
+            for stage, seconds in stages.items():
+                key = (current.action, stage)
+                histogram = _histograms.get(key)
+                if histogram is None:
+                    histogram = _histograms[key] = _Histogram()
+                histogram.observe(seconds)
+
+
+@contextmanager
+def timed(stage):
+    """Adds the time spent in the block to stage of the current request"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        current = _current.get()
+        if current is not None:
+            current.add(stage, time.perf_counter() - start)
+
+
+def record(stage, seconds):
+    """Adds seconds to stage of the current request"""
+    current = _current.get()
+    if current is not None:
+        current.add(stage, seconds)
+
+
+def timed_function(stage):
+    """Decorator that records every call of the function under stage"""
+    def decorate(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                record(stage, time.perf_counter() - start)
+        return wrapper
+    return decorate
+
+
+def inc(name, action=None, amount=1):
+    """Increments the counter name (optionally labelled with an action)"""
+    key = (name, action)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + amount
+
+
+def counter_values(name):
+    """Returns {action: value} for the counter name"""
+    with _lock:
+        return dict((action, value) for (counter, action), value
+                    in _counters.items() if counter == name)
+
+
+def render(gauges=None):
+    """Returns all metrics in the Prometheus text format
+
+    gauges is an optional dict of extra {name: value} gauges to include,
+    e.g. the connection pool and cache counters; gauges whose value is None
+    (unknown) are left out
+    """
+    lines = ['# TYPE webhook_stage_seconds histogram']
+    with _lock:
+        histograms = sorted(_histograms.items())
+        counters = sorted(_counters.items(), key=lambda item: (item[0][0], str(item[0][1])))
+        for (action, stage), histogram in histograms:
+            labels = 'action="%s",stage="%s"' % (action, stage)
+            cumulative = 0
+            for bound, count in zip(BUCKETS + ('+Inf',), histogram.counts):
+                cumulative += count
+                lines.append('webhook_stage_seconds_bucket{%s,le="%s"} %d'
+                             % (labels, bound, cumulative))
+            lines.append('webhook_stage_seconds_sum{%s} %f' % (labels, histogram.sum))
+            lines.append('webhook_stage_seconds_count{%s} %d' % (labels, histogram.count))
+
+    typed = set()
+    for (name, action), value in counters:
+        if name not in typed:
+            lines.append('# TYPE %s counter' % name)
+            typed.add(name)
+        if action is None:
+            lines.append('%s %d' % (name, value))
+        else:
+            lines.append('%s{action="%s"} %d' % (name, action, value))
+
+    for name, value in sorted((gauges or {}).items()):
+        if value is None:
+            continue
+        lines.append('# TYPE %s gauge' % name)
+        lines.append('%s %s' % (name, value))
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,251 @@
+# -*- coding:utf8 -*-
+"""Module that resolves the customer name Dialogflow heard to a User
+
+Every lookup anchors on an exact User.name, so a misheard or misspelled
+name used to find nothing.  NameIndex keeps every User.name of the graph in
+memory with trigram postings: the names sharing the most trigrams with the
+spoken one are shortlisted and ranked by edit distance, which gives each a
+confidence between 0 and 1.  User.name is unique (see schema.py), so the
+resolved name is the id the queries are sent with.
+
+The index is loaded by the warm-up (or on first use) and reloaded every
+NAMES_REFRESH seconds; a reload only adds and removes the names that
+changed.  Until it is loaded, names are passed through unchanged.
+"""
+
+import heapq
+import logging
+import os
+import re
+import threading
+import time
+import unicodedata
+from collections import defaultdict
+
+import backends
+from config import NAMES_MIN_CONFIDENCE, NAMES_CANDIDATES, NAMES_REFRESH
+
+log = logging.getLogger(__name__)
+
+# Names ranked by edit distance, out of those sharing the most trigrams
+SHORTLIST = 20
+
+# Trigrams in more names than this (e.g. the "  j" of every John) are only
+# counted when a name has no rarer ones
+COMMON_POSTINGS = 1000
+
+_SEPARATORS = re.compile(r'[^0-9a-z]+')
+
+
+def normalize(name):
+    """Returns name lowercased, without accents and with single spaces"""
+    name = unicodedata.normalize('NFKD', name)
+    name = ''.join(char for char in name if not unicodedata.combining(char))
+    return _SEPARATORS.sub(' ', name.lower()).strip()
+
+
+def trigrams(text):
+    """Returns the set of trigrams of a normalized name, padded so the
+    start and end of the name count
+    """
+    padded = '  ' + text + ' '
+    return set(padded[index:index + 3] for index in range(len(padded) - 2))
+
+
+def distance(first, second):
+    """Returns the Levenshtein distance between two strings"""
+    if len(first) < len(second):
+        first, second = second, first
+    previous = list(range(len(second) + 1))
+    for row, char in enumerate(first, 1):
+        current = [row]
+        for column, other in enumerate(second, 1):
+            current.append(min(previous[column] + 1, current[column - 1] + 1,
+                               previous[column - 1] + (char != other)))
+        previous = current
+    return previous[-1]
+
+
+def _owned(table, key, touched):
+    """Returns table[key] as a set the current change may modify: the shared
+    set is replaced by a copy the first time key is touched
+    """
+    if key not in touched or key not in table:
+        table[key] = set(table.get(key, ()))
+        touched.add(key)
+    return table[key]
+
+
+class NameIndex(object):
+    """Trigram index over the User names of the graph
+
+    The tables are copied on write: a change builds new ones outside the
+    lock, copying only the entries it touches, and swaps them in, so
+    searches never wait for a reload.
+
+    Attributes:
+        names (dict): normalized name -> set of User names
+        postings (dict): trigram -> set of normalized names containing it
+        ready (bool): True once the names were loaded
+        loaded_at (float): when the names were last (re)loaded
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.update_lock = threading.Lock()
+        self.names = {}
+        self.postings = {}
+        self.ready = False
+        self.loaded_at = 0.0
+
+    def add(self, name):
+        with self.update_lock:
+            self._apply([name], ())
+
+    def remove(self, name):
+        with self.update_lock:
+            self._apply((), [name])
+
+    def _apply(self, added, removed):
+        """Swaps in tables with the names added and removed; the caller
+        holds update_lock, so the published tables do not change meanwhile
+        """
+        names, postings = dict(self.names), dict(self.postings)
+        touched_names, touched_grams = set(), set()
+        for name in removed:
+            key = normalize(name)
+            if key not in names:
+                continue
+            found = _owned(names, key, touched_names)
+            found.discard(name)
+            if found:
+                continue
+            del names[key]
+            for gram in trigrams(key):
+                if gram in postings:
+                    keys = _owned(postings, gram, touched_grams)
+                    keys.discard(key)
+                    if not keys:
+                        del postings[gram]
+        for name in added:
+            key = normalize(name)
+            if not key:
+                continue
+            if key not in names:
+                for gram in trigrams(key):
+                    _owned(postings, gram, touched_grams).add(key)
+            _owned(names, key, touched_names).add(name)
+        with self.lock:
+            self.names, self.postings = names, postings
+
+    def update(self, names):
+        """Makes the index hold exactly names, touching only the ones that
+        were added or removed since the last update
+
+        Returns the number of names added and removed
+        """
+        names = set(name for name in names if name)
+        with self.update_lock:
+            current = set(name for found in self.names.values() for name in found)
+            added, removed = names - current, current - names
+            if added or removed:
+                self._apply(added, removed)
+            with self.lock:
+                self.ready = True
+                self.loaded_at = time.time()
+        return len(added), len(removed)
+
+    def search(self, spoken, limit=NAMES_CANDIDATES):
+        """Takes a name as heard
+
+        Returns up to limit [(User name, confidence)], best first; an exact
+        match (up to case, accents and punctuation) has confidence 1.0
+        """
+        key = normalize(spoken)
+        if not key:
+            return []
+        grams = trigrams(key)
+        with self.lock:
+            names, postings = self.names, self.postings
+        exact = names.get(key)
+        if exact:
+            return [(name, 1.0) for name in sorted(exact)][:limit]
+        postings = sorted((postings[gram] for gram in grams if gram in postings), key=len)
+        rare = [found for found in postings if len(found) <= COMMON_POSTINGS]
+        shared = defaultdict(int)
+        for found in rare or postings[:1]:
+            for other in found:
+                shared[other] += 1
+        # Dice coefficient; a name of n characters has about n + 1 trigrams
+        shortlist = heapq.nlargest(SHORTLIST, shared, key=lambda other: 2.0
+                                   * shared[other] / (len(grams) + len(other) + 1))
+        candidates = [(other, names[other]) for other in shortlist]
+        found = []
+        for other, users in candidates:
+            confidence = 1.0 - distance(key, other) / float(max(len(key), len(other)))
+            found.extend((name, round(confidence, 3)) for name in users)
+        found.sort(key=lambda match: (-match[1], match[0]))
+        return found[:limit]
+
+    def stats(self):
+        with self.lock:
+            return {'names': len(self.names), 'trigrams': len(self.postings),
+                    'age': round(time.time() - self.loaded_at, 1) if self.ready else -1}
+
+
+index = NameIndex()
+_thread = None
+_thread_pid = None
+_lock = threading.Lock()
+
+
+def refresh():
+    """Reloads the User names from the user backend into the index"""
+    added, removed = index.update(backends.user_backend().user_names())
+    if added or removed:
+        log.info('names: %d added, %d removed', added, removed)
+
+
+def _keep_fresh():
+    """Reloads the names once they are NAMES_REFRESH seconds old, retrying
+    a failed load every few seconds
+    """
+    while True:
+        if time.time() - index.loaded_at >= NAMES_REFRESH:
+            try:
+                refresh()
+            except Exception as error:
+                log.warning('loading user names failed: %s', error)
+        time.sleep(min(NAMES_REFRESH, 5.0))
+
+
+def start():
+    """Loads the index and keeps reloading it on a background thread, once
+    per process
+    """
+    global _thread, _thread_pid
+    with _lock:
+        if _thread is None or _thread_pid != os.getpid():
+            _thread = threading.Thread(target=_keep_fresh, name='names')
+            _thread.daemon = True
+            _thread.start()
+            _thread_pid = os.getpid()
+
+
+def resolve(spoken):
+    """Takes a name as heard by Dialogflow
+
+    Returns the User name and the candidates found: the name is None
+    unless exactly one user matched with at least NAMES_MIN_CONFIDENCE, and
+    the candidates are [(User name, confidence)] to offer instead.  While
+    the index is not loaded, spoken is returned unchanged
+    """
+    if not index.ready:
+        start()
+        return spoken, []
+    candidates = index.search(spoken)
+    if not candidates or candidates[0][1] < NAMES_MIN_CONFIDENCE:
+        return None, candidates
+    if len(candidates) > 1 and candidates[1][1] == candidates[0][1]:
+        return None, candidates
+    return candidates[0][0], candidates
@@ -0,0 +1,183 @@
+# -*- coding:utf8 -*-
+"""Module that profiles single webhook requests on demand
+
+A request is profiled when it carries the PROFILE_HEADER with the value of
+PROFILE_TOKEN, or when it is picked by PROFILE_SAMPLE_RATE.  Its action then
+runs under cProfile, and every query it sends to neo4j runs with PROFILE so
+the operators, rows and db hits of its plan are kept too.  The last
+PROFILE_BUFFER traces of a worker are listed on /admin/profiles (with the
+same token); a trace downloads as JSON or as a .prof file for pstats or
+snakeviz:
+
+    curl -H 'X-Profile: <token>' localhost:8000/admin/profiles
+    curl -H 'X-Profile: <token>' localhost:8000/admin/profiles/<id>.prof > t.prof
+    python -m pstats t.prof
+
+A request that is not profiled pays for one random() call when sampling is
+on and nothing else; run_query() checks current() once per query.  Only one
+request of a worker is profiled at a time (a second cProfile profiler cannot
+be enabled while one is running); requests that ask while one is running are
+served without profiling.
+"""
+
+import contextvars
+import cProfile
+import hmac
+import io
+import itertools
+import marshal
+import pstats
+import random
+import threading
+import time
+from collections import deque
+
+from config import (PROFILE_HEADER, PROFILE_TOKEN, PROFILE_SAMPLE_RATE,
+                    PROFILE_BUFFER, PROFILE_TOP)
+
+_current = contextvars.ContextVar('profile_trace', default=None)
+_ids = itertools.count(1)
+_lock = threading.Lock()
+_running = threading.Lock()
+
+# The last PROFILE_BUFFER traces of this worker, oldest first
+traces = deque(maxlen=PROFILE_BUFFER)
+
+
+class Trace(object):
+    """The profile of one webhook request
+
+    Attributes:
+        id (int): the trace's number in this worker
+        action (str): the Dialogflow action
+        started (float): when the request started, as a time.time() timestamp
+        seconds (float): how long the action took
+        queries (list): a dict per neo4j query with its Cypher, parameters
+            and PROFILE plan
+        stats (bytes): the cProfile stats, marshalled like pstats dump_stats
+        text (str): the PROFILE_TOP functions by cumulative time
+    """
+
+    def __init__(self, action):
+        self.id = next(_ids)
+        self.action = action
+        self.started = time.time()
+        self.seconds = None
+        self.queries = []
+        self.stats = None
+        self.text = None
+
+    def query(self, cypher, parameters, result, seconds):
+        """Adds a query that ran with PROFILE and the plan from its summary"""
+        entry = {'cypher': cypher, 'parameters': parameters,
+                 'ms': round(seconds * 1000, 3)}
+        try:
+            plan = result.summary().profile
+        except Exception as error:
+            plan = None
+            entry['error'] = '%s: %s' % (type(error).__name__, error)
+        if plan is not None:
+            entry['plan'] = _plan(plan)
+            entry['db_hits'] = _db_hits(plan)
+        self.queries.append(entry)
+
+    def summary(self):
+        return {'id': self.id, 'action': self.action, 'started': self.started,
+                'ms': round(self.seconds * 1000, 3) if self.seconds is not None else None,
+                'queries': len(self.queries),
+                'db_hits': sum(query.get('db_hits', 0) for query in self.queries)}
+
+    def to_dict(self):
+        trace = self.summary()
+        trace['queries'] = self.queries
+        trace['profile'] = self.text
+        return trace
+
+
+def _plan(plan):
+    """Returns a PROFILE plan tree as nested dicts"""
+    return {'operator': plan.operator_type, 'identifiers': list(plan.identifiers),
+            'rows': getattr(plan, 'rows', None), 'db_hits': getattr(plan, 'db_hits', None),
+            'children': [_plan(child) for child in plan.children]}
+
+
+def _db_hits(plan):
+    return (getattr(plan, 'db_hits', 0) or 0) + sum(_db_hits(child)
+                                                     for child in plan.children)
+
+
+def authorized(token):
+    """Returns True when token is the configured PROFILE_TOKEN, comparing in
+    constant time
+    """
+    if not PROFILE_TOKEN or token is None:
+        return False
+    return hmac.compare_digest(token.encode('utf8'), PROFILE_TOKEN.encode('utf8'))
+
+
+def requested(token=None):
+    """Takes the value of the request's PROFILE_HEADER, if any
+
+    Returns True when the request is to be profiled
+    """
+    if token is not None and authorized(token):
+        return True
+    return PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE
+
+
+def current():
+    """Returns the Trace of the request being profiled, if any"""
+    return _current.get()
+
+
+def profiled(action, function, *args):
+    """Runs function(*args) under cProfile, recording a Trace of it for the
+    action into traces; runs it unprofiled when another request is being
+    profiled
+
+    Returns what function returns
+    """
+    if not _running.acquire(False):
+        return function(*args)
+    try:
+        return _profiled(action, function, *args)
+    finally:
+        _running.release()
+
+
+def _profiled(action, function, *args):
+    trace = Trace(action)
+    token = _current.set(trace)
+    profiler = cProfile.Profile()
+    start = time.perf_counter()
+    try:
+        profiler.enable()
+        try:
+            return function(*args)
+        finally:
+            profiler.disable()
+    finally:
+        trace.seconds = time.perf_counter() - start
+        _current.reset(token)
+        profiler.create_stats()
+        trace.stats = marshal.dumps(profiler.stats)
+        text = io.StringIO()
+        pstats.Stats(profiler, stream=text).sort_stats('cumulative').print_stats(PROFILE_TOP)
+        trace.text = text.getvalue()
+        with _lock:
+            traces.append(trace)
+
+
+def find(trace_id):
+    """Returns the kept Trace with trace_id, or None"""
+    with _lock:
+        for trace in traces:
+            if trace.id == trace_id:
+                return trace
+    return None
+
+
+def listing():
+    """Returns the summaries of the kept traces, newest first"""
+    with _lock:
+        return [trace.summary() for trace in reversed(traces)]
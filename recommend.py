@@ -0,0 +1,97 @@
+# -*- coding:utf8 -*-
+"""Module that scores plans against a user's usage for recommendations
+
+The plan catalog is turned once into a feature matrix (monthly fee,
+allowance, overage price).  Scoring a user then estimates the monthly cost of
+every plan for every month of their usage history in one broadcast
+operation and picks the cheapest plans.
+"""
+
+import re
+
+import numpy as np
+
+from config import (PLAN_ALLOWANCE_PROPERTY, PLAN_OVERAGE_PROPERTY,
+                    DEFAULT_OVERAGE_PRICE)
+
+
+def parse_amount(value):
+    """Takes a number or a string such as "$25" or "10GB"
+
+    Returns it as a float, or NaN when there is no number in it
+    """
+    if value is None:
+        return np.nan
+    if isinstance(value, (int, float)):
+        return float(value)
+    match = re.search(r'\d+(?:\.\d+)?', str(value).replace(',', ''))
+    return float(match.group()) if match else np.nan
+
+
+class PlanCatalog(object):
+    """Feature matrix of all plans, built once and reused for every user
+
+    Attributes:
+        plans (list): the plan properties as dicts, in matrix row order
+        features (numpy.ndarray): (plans, 3) array of monthly fee, allowance
+            and overage price per unit; a missing allowance counts as
+            unlimited, and a missing or unparseable fee as an infinite cost
+            so that the plan is never recommended
+    """
+
+    def __init__(self, plans):
+        self.plans = [dict(plan) for plan in plans]
+        self.features = np.array(
+            [[parse_amount(plan.get('fee')),
+              parse_amount(plan.get(PLAN_ALLOWANCE_PROPERTY)),
+              parse_amount(plan.get(PLAN_OVERAGE_PROPERTY))]
+             for plan in self.plans], dtype=float).reshape(-1, 3)
+        self.features[:, 0] = np.where(np.isnan(self.features[:, 0]),
+                                       np.inf, self.features[:, 0])
+        self.features[:, 1] = np.where(np.isnan(self.features[:, 1]),
+                                       np.inf, self.features[:, 1])
+        self.features[:, 2] = np.where(np.isnan(self.features[:, 2]),
+                                       DEFAULT_OVERAGE_PRICE,
+                                       self.features[:, 2])
+        self.index = dict((plan.get('name'), row)
+                          for row, plan in enumerate(self.plans))
+
+    def __len__(self):
+        return len(self.plans)
+
+    def monthly_costs(self, amounts):
+        """Takes a user's monthly usage amounts
+
+        Returns the estimated average monthly cost under every plan
+        """
+        usage = np.asarray(amounts, dtype=float)
+        usage = usage[~np.isnan(usage)]
+        fee, allowance, price = self.features.T
+        if not len(usage):
+            return fee.copy()
+        over = np.maximum(usage[None, :] - allowance[:, None], 0.0)
+        return fee + (over * price[:, None]).mean(axis=1)
+
+    def top_k(self, amounts, k, exclude=None):
+        """Returns [(plan, estimated monthly cost)] for the k cheapest plans
+
+        exclude is the name of a plan to leave out, e.g. the current one
+        """
+        costs = self.monthly_costs(amounts)
+        if exclude in self.index:
+            costs[self.index[exclude]] = np.inf
+        k = min(k, int(np.isfinite(costs).sum()))
+        if k <= 0:
+            return []
+        best = np.argpartition(costs, k - 1)[:k]
+        best = best[np.argsort(costs[best])]
+        return [(self.plans[row], float(costs[row])) for row in best]
+
+    def cost_of(self, name, amounts):
+        """Returns the estimated monthly cost of the named plan, or None when
+        the plan is unknown or has no fee
+        """
+        if name not in self.index:
+            return None
+        cost = self.monthly_costs(amounts)[self.index[name]]
+        return float(cost) if np.isfinite(cost) else None
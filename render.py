@@ -0,0 +1,165 @@
+# -*- coding:utf8 -*-
+"""Module that renders and serializes fulfillment messages
+
+Every message is a Message: a plain dict (so it can still be inspected or
+passed to json.dumps) that also carries its own JSON encoding.  A card's
+fixed parts (image, buttons) are encoded once into a CardTemplate, and a
+response only encodes the title it splices in.  Plan cards are the same for
+every user on a plan, so their templates are cached by plan.
+
+fulfillment() joins the encoded messages into the response body without
+walking the dicts again.  Messages are shared between responses and must
+not be modified.
+"""
+
+import json
+import threading
+from collections import OrderedDict
+
+from config import RENDER_CACHE_SIZE
+
+PLATFORM = 'FACEBOOK'
+
+# Compact, ASCII-only encoding; the C encoder is used where available
+_encoder = json.JSONEncoder(ensure_ascii=True, check_circular=False,
+                            separators=(',', ':'))
+_encode_string = json.encoder.encode_basestring_ascii
+
+
+def encode(value):
+    """Returns value as compact JSON bytes"""
+    if isinstance(value, Message):
+        return value.encoded
+    return _encoder.encode(value).encode('ascii')
+
+
+def encode_string(value):
+    """Returns the JSON encoding of a str as bytes"""
+    return _encode_string(value).encode('ascii')
+
+
+class Message(dict):
+    """A fulfillment message and its JSON encoding
+
+    Attributes:
+        encoded (bytes): the message as compact JSON
+    """
+
+    __slots__ = ('encoded',)
+
+    def __init__(self, fields, encoded=None):
+        dict.__init__(self, fields)
+        self.encoded = encoded if encoded is not None else encode(fields)
+
+
+_TEXT_HEAD = b'{"text":{"text":['
+_TEXT_TAIL = b']},"platform":"' + PLATFORM.encode('ascii') + b'"}'
+
+
+def text(value):
+    """Returns a text Message"""
+    return Message({'text': {'text': [value]}, 'platform': PLATFORM},
+                   _TEXT_HEAD + encode_string(value) + _TEXT_TAIL)
+
+
+class CardTemplate(object):
+    """A card whose image and buttons are encoded once
+
+    A button is a (text, postback) pair; a postback of None posts the text.
+
+    Attributes:
+        card (dict): the fixed fields of the card
+        head (bytes): the encoded message up to the title
+        tail (bytes): the encoded message after the title
+        message (Message): the rendered card when the title is fixed too
+    """
+
+    _TITLE = '\x00title\x00'
+
+    def __init__(self, url, buttons, title=None):
+        self.card = {
+            'imageUri': url,
+            'buttons': [{'text': button_text,
+                         'postback': button_text if postback is None else postback}
+                        for button_text, postback in buttons],
+        }
+        encoded = encode({'card': dict(self.card, title=self._TITLE),
+                          'platform': PLATFORM})
+        self.head, self.tail = encoded.split(encode_string(self._TITLE))
+        self.message = self.render(title) if title is not None else None
+
+    def render(self, title=None):
+        """Returns the card as a Message with title, or the prebuilt card
+        when the template has a fixed title and none is given
+        """
+        if title is None:
+            return self.message
+        return Message({'card': dict(self.card, title=title), 'platform': PLATFORM},
+                       self.head + encode_string(title) + self.tail)
+
+
+def card(title, url, buttons):
+    """Returns a card Message that is not worth caching"""
+    return CardTemplate(url, buttons).render(title)
+
+
+class _TemplateCache(object):
+    """CardTemplates of plan cards, least recently used ones dropped first"""
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, build):
+        with self.lock:
+            template = self.entries.get(key)
+            if template is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return template
+            self.misses += 1
+        template = build()
+        with self.lock:
+            self.entries[key] = template
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        return template
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        with self.lock:
+            return {'entries': len(self.entries), 'hits': self.hits,
+                    'misses': self.misses}
+
+
+plan_templates = _TemplateCache(RENDER_CACHE_SIZE)
+
+
+def plan_key(plan):
+    """The cache key of a plan node: its id together with the properties a
+    card shows, so an edited plan gets a fresh card
+    """
+    return (getattr(plan, 'id', None), plan.get('name'), plan.get('fee'),
+            plan.get('url'))
+
+
+def plan_card(kind, plan, build):
+    """Takes a card kind, a plan node and build(plan), which returns the
+    plan's CardTemplate for that kind
+
+    Returns the cached CardTemplate, building it on first use
+    """
+    return plan_templates.get((kind,) + plan_key(plan), lambda: build(plan))
+
+
+def fulfillment(messages):
+    """Returns the webhook response body for a list of messages as bytes"""
+    return (b'{"fulfillmentMessages":['
+            + b','.join([encode(message) for message in messages])
+            + b']}')
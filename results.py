@@ -0,0 +1,81 @@
+# -*- coding:utf8 -*-
+"""Module that turns neo4j query results into compact Python values
+
+Every record of a result is kept.  Callers pick the shape they need:
+
+    rows(result)        list of slotted namedtuple rows, one per record
+    columns(result)     dict of column name -> list of values
+    chunks(result, n)   generator of row lists of at most n records, read
+                        from the server as they are consumed
+"""
+
+from collections import namedtuple
+
+_row_types = {}
+
+
+def row_type(keys):
+    """Returns the (cached) namedtuple class for a result with these keys
+
+    Keys that are not valid identifiers (e.g. "p.name") get positional
+    field names, see namedtuple's rename option
+    """
+    keys = tuple(keys)
+    Row = _row_types.get(keys)
+    if Row is None:
+        Row = _row_types[keys] = namedtuple('Row', keys, rename=True)
+    return Row
+
+
+def rows(result):
+    """Returns every record of the result as a namedtuple row"""
+    Row = row_type(result.keys())
+    return [Row._make(record.values()) for record in result]
+
+
+def columns(result):
+    """Returns the result as a dict of column name -> list of values"""
+    keys = list(result.keys())
+    values = [[] for _ in keys]
+    appends = [column.append for column in values]
+    for record in result:
+        for append, value in zip(appends, record.values()):
+            append(value)
+    return dict(zip(keys, values))
+
+
+def chunks(result, fetch_size):
+    """Yields the result's records as lists of at most fetch_size rows
+
+    Records are only pulled from the connection as the chunks are consumed,
+    so a long result never has to be held in memory at once
+    """
+    Row = row_type(result.keys())
+    chunk = []
+    for record in result:
+        chunk.append(Row._make(record.values()))
+        if len(chunk) >= fetch_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def distinct(values):
+    """Returns the non-null values in order, without repeated nodes"""
+    seen = set()
+    found = []
+    for value in values:
+        if value is None:
+            continue
+        key = getattr(value, 'id', None)
+        if key is None:
+            key = id(value)
+        if key not in seen:
+            seen.add(key)
+            found.append(value)
+    return found
+
+
+# Shapes a whole result can be materialized in, by name
+SHAPES = {'rows': rows, 'columns': columns}
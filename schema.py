@@ -0,0 +1,175 @@
+# -*- coding:utf8 -*-
+"""Module that manages the neo4j indexes the lookups rely on
+
+Every per-user lookup starts from a User found by name, bills are matched
+by Month, plans by name and recorded events (see writer.py) by key; without
+indexes each of those is a label scan
+that grows with the graph.  ensure_schema() creates what is missing and
+waits for it to come online.  gunicorn runs it on startup when
+SCHEMA_ON_STARTUP is set (see gunicorn.conf.py).
+
+check_queries() runs EXPLAIN (or PROFILE) on every lookup query and reports
+the ones that scan a whole label or touch too many records:
+
+    python schema.py ensure
+    python schema.py check --user alice --profile
+"""
+
+import argparse
+import logging
+import re
+import sys
+
+import driver
+from backends import Neo4jBackend
+from config import SCHEMA_INDEX_TIMEOUT, SCHEMA_MAX_DB_HITS
+
+log = logging.getLogger(__name__)
+
+# (label, property, unique) of the indexes the lookups need
+INDEXES = (
+    ('User', 'name', True),
+    ('Bill', 'Month', False),
+    ('Plan', 'name', False),
+    ('Event', 'key', True),
+)
+
+# Plan operators that read every node (of a label)
+SCAN_OPERATORS = ('AllNodesScan', 'NodeByLabelScan')
+
+_INDEX_DESCRIPTION = re.compile(r':`?(\w+)`?\s*\(`?(\w+)`?\)')
+
+
+def _run(statement, parameters=None):
+    with driver.session() as session:
+        return list(session.run(statement, parameters or {}))
+
+
+def existing_indexes():
+    """Returns {(label, property): state} of the indexes in the database"""
+    found = {}
+    for record in _run('CALL db.indexes()'):
+        fields = dict(zip(record.keys(), record.values()))
+        labels = fields.get('tokenNames') or [fields.get('label')]
+        properties = fields.get('properties') or []
+        if not labels[0] or not properties:
+            match = _INDEX_DESCRIPTION.search(fields.get('description') or '')
+            if match is None:
+                continue
+            labels, properties = [match.group(1)], [match.group(2)]
+        found[(labels[0], properties[0])] = fields.get('state')
+    return found
+
+
+def ensure_schema(timeout=SCHEMA_INDEX_TIMEOUT):
+    """Creates the missing INDEXES and waits up to timeout seconds for them
+
+    A unique constraint that cannot be created (e.g. because of duplicate
+    names) falls back to a plain index.  Returns the list of statements run
+    """
+    existing = existing_indexes()
+    created = []
+    for label, prop, unique in INDEXES:
+        if (label, prop) in existing:
+            continue
+        index = 'CREATE INDEX ON :%s(%s)' % (label, prop)
+        statement = index
+        if unique:
+            statement = 'CREATE CONSTRAINT ON (n:%s) ASSERT n.%s IS UNIQUE' % (label, prop)
+        try:
+            _run(statement)
+        except Exception as error:
+            if statement == index:
+                raise
+            log.warning('%s failed (%s), creating a plain index', statement, error)
+            statement = index
+            _run(statement)
+        log.info('schema: %s', statement)
+        created.append(statement)
+    _run('CALL db.awaitIndexes({timeout})', {'timeout': int(timeout)})
+    offline = [key for key, state in existing_indexes().items()
+               if state not in (None, 'ONLINE')]
+    if offline:
+        log.error('schema: indexes not online: %s', offline)
+    return created
+
+
+def _operators(plan):
+    """Yields every operator of a plan tree"""
+    yield plan
+    for child in plan.children:
+        for operator in _operators(child):
+            yield operator
+
+
+def check_query(name, cypher, parameters, profile=False,
+                max_db_hits=SCHEMA_MAX_DB_HITS):
+    """Takes a query's name, Cypher and parameters
+
+    Returns a list of the problems found in its plan: label or full scans,
+    planner notifications and, when profiling, more than max_db_hits
+    database hits
+    """
+    prefix = 'PROFILE ' if profile else 'EXPLAIN '
+    with driver.session() as session:
+        result = session.run(prefix + cypher, parameters)
+        list(result)
+        summary = result.summary()
+    plan = summary.profile if profile else summary.plan
+    problems = []
+    for operator in _operators(plan):
+        operator_type = operator.operator_type.split('@')[0]
+        if operator_type in SCAN_OPERATORS:
+            problems.append('%s: %s over %s' % (
+                name, operator_type, ', '.join(operator.identifiers)))
+    for notification in summary.notifications or ():
+        problems.append('%s: %s' % (name, notification.get('title')
+                                    if isinstance(notification, dict)
+                                    else notification.title))
+    if profile:
+        hits = sum(operator.db_hits for operator in _operators(plan))
+        log.info('%s: %d db hits, %d rows', name, hits, plan.rows)
+        if hits > max_db_hits:
+            problems.append('%s: %d db hits (limit %d)' % (name, hits, max_db_hits))
+    return problems
+
+
+def check_queries(user, month, profile=False, max_db_hits=SCHEMA_MAX_DB_HITS):
+    """Runs check_query() on every lookup query for the user and billing
+    month
+
+    Returns the list of problems found
+    """
+    parameters = Neo4jBackend.parameters(user, month)
+    problems = []
+    for name in Neo4jBackend.QUERIES:
+        problems.extend(check_query(name, getattr(Neo4jBackend, name), parameters,
+                                    profile, max_db_hits))
+    return problems
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Manage and check the neo4j schema')
+    parser.add_argument('command', choices=['ensure', 'check'])
+    parser.add_argument('--user', default='', help='user name the queries are checked for')
+    parser.add_argument('--month', help='billing period, YYYY-MM; defaults to the current one')
+    parser.add_argument('--profile', action='store_true',
+                        help='run the queries with PROFILE and count db hits')
+    parser.add_argument('--max-db-hits', type=int, default=SCHEMA_MAX_DB_HITS)
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+
+    if args.command == 'ensure':
+        for statement in ensure_schema():
+            print(statement)
+        return 0
+    from get_response import billing_period
+    problems = check_queries(args.user, args.month or billing_period(),
+                             args.profile, args.max_db_hits)
+    for problem in problems:
+        print(problem)
+    return 1 if problems else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
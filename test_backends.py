@@ -0,0 +1,37 @@
+# -*- coding:utf8 -*-
+"""Checks the lookups of the in-memory backend
+
+    python -m pytest -q
+"""
+
+from backends import MemoryBackend
+from config import USAGE_PROPERTY, PLAN_ALLOWANCE_PROPERTY
+
+
+def backend(allowance):
+    """A graph of one user on a plan with allowance, using 30 and 40 GB"""
+    nodes = [{'id': 1, 'labels': ['User'], 'properties': {'name': 'ann'}},
+             {'id': 2, 'labels': ['Plan'], 'properties': {'name': 'Basic',
+                                                          PLAN_ALLOWANCE_PROPERTY: allowance}},
+             {'id': 3, 'labels': ['Usage'], 'properties': {}},
+             {'id': 4, 'labels': ['Month'], 'properties': {'Month': '2019-01',
+                                                           USAGE_PROPERTY: '30'}},
+             {'id': 5, 'labels': ['Month'], 'properties': {'Month': '2019-02',
+                                                           USAGE_PROPERTY: 40}}]
+    relationships = [{'start': 1, 'type': 'subscribe', 'end': 2},
+                     {'start': 1, 'type': 'usage', 'end': 3},
+                     {'start': 3, 'type': 'Month', 'end': 4},
+                     {'start': 3, 'type': 'Month', 'end': 5}]
+    return MemoryBackend(nodes, relationships)
+
+
+def test_usage_series_parses_an_allowance_with_a_unit():
+    series = backend('10GB').usage_series('ann')
+
+    assert series['months'] == ['2019-01', '2019-02']
+    assert series['amounts'] == [30.0, 40.0]
+    assert series['allowance'] == 10.0
+
+
+def test_usage_series_has_no_allowance_without_a_number():
+    assert backend('unlimited').usage_series('ann')['allowance'] is None
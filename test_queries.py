@@ -0,0 +1,116 @@
+# -*- coding:utf8 -*-
+"""Counts the neo4j statements each action issues against the fake driver
+
+    python -m pytest -q
+"""
+
+import json
+import time
+
+import pytest
+
+from bench import payloads
+from bench.fake_graph import FakeGraph
+from bench.run import install_fake_graph
+
+import actions
+import breaker
+import conversation
+import get_response
+import names
+
+READ_ONLY = sorted(name for name, action in actions.REGISTRY.items()
+                   if action.read_only)
+
+
+@pytest.fixture
+def graph():
+    """A fresh fake graph behind the driver, with empty caches, a closed
+    breaker and the plan catalog already cached
+    """
+    fake = FakeGraph(users=10, latency=0.0)
+    install_fake_graph(fake)
+    breaker.neo4j.state = breaker.CLOSED
+    breaker.neo4j.failed = 0
+    get_response.query_cache.clear()
+    get_response.stale_results.clear()
+    conversation.store().clear()
+    names.index.update('user%d' % index for index in range(fake.users))
+    get_response.Check_Bill({'given-name': ['user0']}).plan_catalog
+    return fake
+
+
+def statements(fake, function, *args):
+    """Returns the statements function(*args) sends to the fake graph"""
+    before = fake.statements
+    function(*args)
+    return fake.statements - before
+
+
+@pytest.mark.parametrize('action', READ_ONLY)
+def test_each_action_runs_one_query(graph, action):
+    params = {'given-name': ['user7'], 'session': None, 'deadline': None}
+    assert statements(graph, actions.REGISTRY[action].render, params) == 1
+
+
+@pytest.mark.parametrize('action', READ_ONLY)
+def test_repeated_action_is_served_from_the_cache(graph, action):
+    params = {'given-name': ['user7'], 'session': None, 'deadline': None}
+    actions.REGISTRY[action].render(dict(params))
+    assert statements(graph, actions.REGISTRY[action].render, dict(params)) == 0
+
+
+def test_plan_catalog_is_shared_by_every_user(graph):
+    for user in ('user1', 'user2', 'user3'):
+        assert statements(graph, lambda: get_response.Check_Bill(
+            {'given-name': [user]}).plan_catalog) == 0
+
+
+def test_conversation_turns_reuse_the_session_state(graph):
+    counts = [statements(graph, actions.dispatch, req)
+              for req in payloads.conversation('user7')
+              if actions.lookup(req['queryResult']['action']).read_only]
+    # check_bill fetches the snapshot, recommendation adds the usage
+    # history; the later turns find everything in the conversation state
+    assert counts == [1, 1, 0, 0]
+
+
+def test_a_new_billing_period_is_not_served_from_the_session_state(graph):
+    session = 'period-session'
+    turns = [('check_bill', 'Check Bill', '2018-12-01'),
+             ('recharge_exisiting_plan', 'Recharge', '2018-06-01'),
+             ('recharge_exisiting_plan', 'Recharge', '2018-12-01')]
+    fees = []
+    for index, (action, intent, date) in enumerate(turns):
+        req = payloads.request(action, intent, intent, 'user7', session, index == 0,
+                               {'date': date})
+        fees.append(actions.dispatch(req)[0]['text']['text'][0])
+    # user7 is on Plan 7 ($45); June's bill is six months back
+    assert fees[1:] == ['Ok, your charge is $51', 'Ok, your charge is $45']
+
+
+def test_an_open_breaker_serves_the_last_known_answer(graph):
+    params = {'given-name': ['user7'], 'session': None, 'deadline': None}
+    fresh = actions.REGISTRY['check_bill'].render(dict(params))
+    get_response.query_cache.clear()
+    breaker.neo4j.state = breaker.OPEN
+    breaker.neo4j.opened_at = time.time()
+
+    served = actions.REGISTRY['check_bill'].render(dict(params))
+
+    assert served == fresh + [get_response.Check_Bill.fb_text(actions.STALE_TEXT)]
+
+
+def test_a_dropped_connection_is_answered_as_unavailable(graph, monkeypatch):
+    import main
+
+    def dropped(cypher, parameters):
+        raise ConnectionResetError('connection reset by peer')
+
+    monkeypatch.setattr(graph, 'run', dropped)
+    req = payloads.conversation('user7')[0]
+    response = main.app.test_client().post('/', data=json.dumps(req),
+                                           content_type='application/json')
+
+    assert response.status_code == 200
+    assert actions.UNAVAILABLE_TEXT in response.get_data(as_text=True)
@@ -0,0 +1,32 @@
+# -*- coding:utf8 -*-
+"""Checks how the plan catalog scores plans against a user's usage
+
+    python -m pytest -q
+"""
+
+from config import PLAN_ALLOWANCE_PROPERTY
+from recommend import PlanCatalog
+
+PLANS = [
+    {'name': 'Basic', 'fee': '$20', PLAN_ALLOWANCE_PROPERTY: '10GB'},
+    {'name': 'Plus', 'fee': '$35', PLAN_ALLOWANCE_PROPERTY: '50GB'},
+    {'name': 'Unpriced', PLAN_ALLOWANCE_PROPERTY: '100GB'},
+    {'name': 'Call us', 'fee': 'ask', PLAN_ALLOWANCE_PROPERTY: '100GB'},
+]
+
+
+def test_plans_without_a_fee_are_never_recommended():
+    catalog = PlanCatalog(PLANS)
+
+    best = catalog.top_k([5.0, 8.0], 4)
+
+    assert [plan['name'] for plan, cost in best] == ['Basic', 'Plus']
+    assert best[0][1] == 20.0
+
+
+def test_plans_without_a_fee_have_no_cost():
+    catalog = PlanCatalog(PLANS)
+
+    assert catalog.cost_of('Unpriced', [5.0]) is None
+    assert catalog.cost_of('Call us', [5.0]) is None
+    assert catalog.cost_of('Plus', [5.0]) == 35.0
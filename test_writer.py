@@ -0,0 +1,95 @@
+# -*- coding:utf8 -*-
+"""Checks how the batch writer queues and commits events, without a graph
+
+    python -m pytest -q
+"""
+
+from contextlib import contextmanager
+
+import pytest
+
+import writer
+
+
+class Recorder(object):
+    """Stands in for a session and its transaction, keeping every statement;
+    raises failure from each run() when it is set
+    """
+
+    def __init__(self, failure=None):
+        self.statements = []
+        self.failure = failure
+
+    def begin_transaction(self, timeout=None):
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def run(self, cypher, parameters):
+        if self.failure is not None:
+            raise self.failure
+        self.statements.append((cypher, parameters))
+        if cypher == writer.EVENTS:
+            return [{'key': item['key']} for item in parameters['events']]
+        return self
+
+    def consume(self):
+        pass
+
+
+@pytest.fixture
+def recorder(monkeypatch):
+    recorder = Recorder()
+
+    @contextmanager
+    def session():
+        yield recorder
+
+    monkeypatch.setattr(writer.driver, 'session', session)
+    monkeypatch.setattr(writer, 'forget', lambda users: None)
+    monkeypatch.setattr(writer.time, 'sleep', lambda seconds: None)
+    return recorder
+
+
+@pytest.fixture
+def batch_writer(monkeypatch):
+    """A BatchWriter whose queue is drained by the test, not a thread"""
+    batch_writer = writer.BatchWriter()
+    monkeypatch.setattr(batch_writer, '_ensure_thread', lambda: None)
+    return batch_writer
+
+
+def test_a_duplicate_key_is_queued_once(batch_writer):
+    event = writer.event('response-1:2019-01', 'recharge', 'ann', month='2019-01')
+
+    assert batch_writer.submit(event)
+    assert batch_writer.submit(dict(event))
+    assert batch_writer.events.qsize() == 1
+
+
+def test_only_the_last_plan_change_of_a_user_is_applied(recorder):
+    batch = [writer.event('r1', 'plan_change', 'ann', plan='Basic'),
+             writer.event('r2', 'plan_change', 'bob', plan='Basic'),
+             writer.event('r3', 'plan_change', 'ann', plan='Plus')]
+
+    writer.commit(batch)
+
+    changes = [parameters['changes'] for cypher, parameters in recorder.statements
+               if cypher == writer.PLAN_CHANGES]
+    assert [(item['user'], item['plan']) for item in changes[0]] == [
+        ('bob', 'Basic'), ('ann', 'Plus')]
+
+
+def test_a_failed_batch_can_be_queued_again(recorder, batch_writer):
+    event = writer.event('response-2', 'plan_change', 'ann', plan='Plus')
+    assert batch_writer.submit(event)
+    recorder.failure = IOError('neo4j is gone')
+
+    assert batch_writer.write([batch_writer.events.get_nowait()]) == []
+
+    assert batch_writer.submit(dict(event))
+    assert batch_writer.events.qsize() == 1
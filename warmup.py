@@ -0,0 +1,147 @@
+# -*- coding:utf8 -*-
+"""Module that warms a worker up before it reports ready
+
+The first request of a fresh worker would otherwise pay for importing
+numpy, connecting to neo4j, having neo4j plan every query and fetching the
+plan catalog.  warm_up() does all of that ahead of time:
+
+    imports   the modules the handlers import on first use
+    pool      opens WARMUP_CONNECTIONS pooled connections
+    plans     loads the plan catalog into the query cache (and the memory
+              backend's snapshot when a backend uses it)
+    names     loads the customer name index (see names.py)
+    queries   renders every read-only action for WARMUP_USER, so each lookup query is
+              planned by neo4j and every code path has run once
+
+gunicorn starts it in post_fork and uvicorn in the lifespan startup;
+/ready answers 503 until it is done.  A failed warm-up is retried every
+WARMUP_RETRY seconds, so a worker started while neo4j is down becomes
+ready once it is back.
+"""
+
+import logging
+import os
+import threading
+import time
+from contextlib import ExitStack
+
+import backends
+import driver
+from config import (WARMUP_USER, WARMUP_CONNECTIONS, WARMUP_RETRY,
+                    GRAPH_BACKEND, PLAN_BACKEND)
+
+log = logging.getLogger(__name__)
+
+
+class WarmUpState(object):
+    """Progress of the warm-up of this worker
+
+    Attributes:
+        status (str): 'cold', 'warming', 'ready' or 'failed'
+        steps (dict): step -> seconds it took
+        attempts (int): warm-ups started
+        error (str): why the last attempt failed, if it did
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        """Starts over, e.g. in a worker forked from a warm parent"""
+        self.status = 'cold'
+        self.steps = {}
+        self.attempts = 0
+        self.error = None
+        self.pid = os.getpid()
+
+    @property
+    def ready(self):
+        return self.status == 'ready' and self.pid == os.getpid()
+
+    def snapshot(self):
+        return {'status': self.status if self.pid == os.getpid() else 'cold',
+                'steps': dict(self.steps), 'attempts': self.attempts,
+                'error': self.error}
+
+
+state = WarmUpState()
+_lock = threading.Lock()
+
+
+def _imports():
+    import analytics
+    import recommend  # noqa: F401, imported for its numpy import
+    analytics.summarize_one([1.0, 2.0], 1.5)
+
+
+def _pool():
+    """Holds WARMUP_CONNECTIONS sessions at once so each gets a connection"""
+    with ExitStack() as stack:
+        for _ in range(WARMUP_CONNECTIONS):
+            session = stack.enter_context(driver.session())
+            list(session.run('RETURN 1'))
+
+
+def _plans():
+    from get_response import Check_Bill
+    for name in set([GRAPH_BACKEND, PLAN_BACKEND]):
+        backends.get_backend(name)
+    Check_Bill({'given-name': [WARMUP_USER]}).plan_catalog
+
+
+def _names():
+    import names
+    names.refresh()
+    names.start()
+
+
+def _queries():
+    import actions
+    from get_response import billing_period
+    backends.user_backend().user_snapshot(WARMUP_USER, billing_period())
+    for action in actions.REGISTRY.values():
+        if action.read_only:
+            action.render({'given-name': [WARMUP_USER], 'session': None,
+                           'deadline': None})
+
+
+STEPS = (('imports', _imports), ('pool', _pool), ('plans', _plans),
+         ('names', _names), ('queries', _queries))
+
+
+def warm_up():
+    """Runs every step once; returns True when the worker is ready"""
+    with _lock:
+        if state.ready:
+            return True
+        if state.pid != os.getpid():
+            state.reset()
+        state.status = 'warming'
+        state.attempts += 1
+        try:
+            for step, function in STEPS:
+                start = time.perf_counter()
+                function()
+                state.steps[step] = round(time.perf_counter() - start, 4)
+        except Exception as error:
+            state.status = 'failed'
+            state.error = '%s: %s' % (type(error).__name__, error)
+            log.warning('warm-up failed: %s', state.error)
+            return False
+        state.status = 'ready'
+        state.error = None
+        log.info('warm-up done: %s', state.steps)
+        return True
+
+
+def _keep_warming():
+    while not warm_up():
+        time.sleep(WARMUP_RETRY)
+
+
+def start():
+    """Warms up on a background thread, retrying until it succeeds"""
+    thread = threading.Thread(target=_keep_warming, name='warmup')
+    thread.daemon = True
+    thread.start()
+    return thread
@@ -0,0 +1,237 @@
+# -*- coding:utf8 -*-
+"""Module that writes recharge and plan change events to the graph
+
+The webhook answers as soon as an event is queued; a background thread per
+worker collects the queued events for up to WRITER_FLUSH_INTERVAL seconds
+(or WRITER_BATCH_SIZE events) and commits them in one explicit transaction.
+
+Every event carries an idempotency key, the Dialogflow responseId of the
+request that caused it.  Dialogflow sends the same responseId when it
+retries a webhook call, and an Event node is only created (and its side
+effects applied) for a key that is not in the graph yet and a user that is,
+so a retry never charges or switches plans twice.  schema.py makes Event.key
+unique.  Events still failing after WRITER_RETRIES are dropped and their keys
+forgotten, so Dialogflow's retry of the request queues them again.
+
+Once a batch is committed, the cached lookups and conversation states of its
+users are dropped in this worker; other workers see the change when their
+cached entries expire (CACHE_USER_TTL).
+"""
+
+import atexit
+import logging
+import os
+import queue
+import threading
+import time
+
+import driver
+import metrics
+from cache import TTLCache
+from config import (WRITER_BATCH_SIZE, WRITER_FLUSH_INTERVAL, WRITER_QUEUE_SIZE,
+                    WRITER_RETRIES, WRITER_TX_TIMEOUT, CACHE_SESSION_TTL)
+
+log = logging.getLogger(__name__)
+
+# Creates the Event nodes whose keys are new, for users that exist, and
+# returns those events
+EVENTS = '''\
+    UNWIND {events} AS e\
+    MATCH (u:User) WHERE u.name = e.user\
+    MERGE (ev:Event {key: e.key})\
+    ON CREATE SET ev.kind = e.kind, ev.user = e.user, ev.month = e.month,\
+                  ev.amount = e.amount, ev.plan = e.plan, ev.at = e.at,\
+                  ev.pending = true\
+    WITH u, e, ev WHERE ev.pending\
+    REMOVE ev.pending\
+    CREATE (u)-[:event]->(ev)\
+    RETURN e.key AS key\
+'''
+
+# Marks the bills paid by new recharge events
+RECHARGES = '''\
+    UNWIND {recharges} AS r\
+    MATCH (u:User) WHERE u.name = r.user\
+    MATCH (u)-[:Bill]->(b)-[:Month]->(m:Bill) WHERE m.Month = r.month\
+    SET m.paid_at = r.at\
+'''
+
+# Moves the users of new plan change events to their new plan; at most one
+# change per user, see latest_changes()
+PLAN_CHANGES = '''\
+    UNWIND {changes} AS c\
+    MATCH (u:User) WHERE u.name = c.user\
+    MATCH (p:Plan) WHERE p.name = c.plan\
+    OPTIONAL MATCH (u)-[old:subscribe]->(:Plan)\
+    DELETE old\
+    WITH DISTINCT u, p\
+    MERGE (u)-[:subscribe]->(p)\
+'''
+
+
+def event(key, kind, user, month=None, amount=None, plan=None):
+    """Returns an event as the dict the writer queues"""
+    return {'key': key, 'kind': kind, 'user': user, 'month': month,
+            'amount': amount, 'plan': plan, 'at': time.time()}
+
+
+class BatchWriter(object):
+    """Commits queued events in batches on a background thread
+
+    Attributes:
+        events (queue.Queue): events waiting to be written
+        seen (TTLCache): keys queued recently by this worker
+    """
+
+    def __init__(self):
+        self.events = queue.Queue(WRITER_QUEUE_SIZE)
+        self.seen = TTLCache(WRITER_QUEUE_SIZE)
+        self.lock = threading.Lock()
+        self.thread = None
+        self.pid = None
+
+    def submit(self, item):
+        """Queues an event for writing
+
+        raises ValueError for an event without an idempotency key
+        Returns False when the event could not be queued because the queue
+        is full; an event whose key this worker queued before counts as
+        queued
+        """
+        if not item['key']:
+            raise ValueError('event without an idempotency key')
+        self._ensure_thread()
+        with self.lock:
+            found, _ = self.seen.get(item['key'])
+            if found:
+                metrics.inc('writer_duplicates_total')
+                return True
+            try:
+                self.events.put_nowait(item)
+            except queue.Full:
+                metrics.inc('writer_dropped_total')
+                log.error('writer queue full, dropped %s event %s',
+                          item['kind'], item['key'])
+                return False
+            self.seen.set(item['key'], True, CACHE_SESSION_TTL)
+        metrics.inc('writer_events_total')
+        return True
+
+    def _ensure_thread(self):
+        with self.lock:
+            if self.thread is None or self.pid != os.getpid():
+                if self.pid != os.getpid():
+                    self.events = queue.Queue(WRITER_QUEUE_SIZE)
+                self.thread = threading.Thread(target=self._run, name='writer')
+                self.thread.daemon = True
+                self.thread.start()
+                self.pid = os.getpid()
+
+    def _next_batch(self):
+        """Blocks for the first event, then collects more for up to
+        WRITER_FLUSH_INTERVAL seconds
+        """
+        batch = [self.events.get()]
+        flush_at = time.time() + WRITER_FLUSH_INTERVAL
+        while len(batch) < WRITER_BATCH_SIZE:
+            remaining = flush_at - time.time()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self.events.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            try:
+                self.write(batch)
+            finally:
+                for _ in batch:
+                    self.events.task_done()
+
+    def write(self, batch):
+        """Commits a batch, retrying up to WRITER_RETRIES times
+
+        Returns the keys of the events that were new to the graph
+        """
+        for attempt in range(WRITER_RETRIES + 1):
+            try:
+                created = commit(batch)
+                break
+            except Exception as error:
+                if attempt == WRITER_RETRIES:
+                    metrics.inc('writer_failures_total', amount=len(batch))
+                    log.error('dropped %d events after %d attempts: %s',
+                              len(batch), attempt + 1, error)
+                    # so Dialogflow's retry of these requests is queued again
+                    keys = set(item['key'] for item in batch)
+                    self.seen.invalidate(lambda key: key in keys)
+                    return []
+                time.sleep(0.1 * 2 ** attempt)
+        metrics.inc('writer_batches_total')
+        forget(set(item['user'] for item in batch))
+        return created
+
+    def flush(self, timeout=None):
+        """Waits until every queued event is written (or timeout seconds)"""
+        if self.thread is None or self.pid != os.getpid():
+            return
+        deadline = None if timeout is None else time.time() + timeout
+        while self.events.unfinished_tasks:
+            if deadline is not None and time.time() > deadline:
+                return
+            time.sleep(0.01)
+
+
+def commit(batch):
+    """Writes a batch of events in one transaction
+
+    Returns the keys of the events that were new to the graph
+    """
+    with driver.session() as session:
+        with session.begin_transaction(timeout=WRITER_TX_TIMEOUT) as tx:
+            created = set(record['key'] for record in tx.run(EVENTS, {'events': batch}))
+            new = [item for item in batch if item['key'] in created]
+            recharges = [item for item in new if item['kind'] == 'recharge']
+            changes = [item for item in new if item['kind'] == 'plan_change']
+            if recharges:
+                tx.run(RECHARGES, {'recharges': recharges}).consume()
+            if changes:
+                tx.run(PLAN_CHANGES, {'changes': latest_changes(changes)}).consume()
+    return created
+
+
+def latest_changes(changes):
+    """Takes plan change events in queue order
+
+    Returns the last change of each user, so one statement never deletes
+    and merges subscriptions for the same user twice
+    """
+    latest = {}
+    for item in changes:
+        latest.pop(item['user'], None)
+        latest[item['user']] = item
+    return list(latest.values())
+
+
+def forget(users):
+    """Drops the cached lookups and conversation states of users"""
+    import conversation
+    from get_response import invalidate_user
+    for user in users:
+        invalidate_user(user)
+        conversation.store().forget_user(user)
+
+
+writer = BatchWriter()
+
+
+def submit(item):
+    """Queues an event on the worker's writer, see BatchWriter.submit"""
+    return writer.submit(item)
+
+
+atexit.register(writer.flush, 5.0)